@@ -18,9 +18,11 @@ def main(level=2):
     if not args.gui and args.collection is None:
         if args.file is not None:
             # perform most basic server testing, using a given file only.
-            st, so = rts.initialise_server(datafile=args.file, loop=loop)
+            st, so = rts.initialise_server(datafile=args.file, loop=loop, precache=args.cache,
+                                           broadcast=args.broadcast, slow_subscriber=args.slow)
         else: # no args.file given, use the default
-            st, so = rts.initialise_server(datafile=datafile, loop=loop)
+            st, so = rts.initialise_server(datafile=datafile, loop=loop, precache=args.cache,
+                                           broadcast=args.broadcast, slow_subscriber=args.slow)
 
         print('Starting first server thread.')
         st.start()
@@ -28,6 +30,10 @@ def main(level=2):
         # let the server keep serving, verbosely
         while st.is_alive():
             print("Server still alive; emulating file '{}' with looping set to {}.".format(so.datafile, so.server_loop))
+            for client, stats in so.give_command_stats().items():
+                print('Commands from {}: {}'.format(client, stats))
+            for client, stats in so.give_broadcast_stats().items():
+                print('Broadcast to {}: {}'.format(client, stats))
             try:
                 time.sleep(30)
             except KeyboardInterrupt:
@@ -60,6 +66,10 @@ if __name__ == "__main__":
     group.add_argument("-c", "--collection", help="specify a text file with EMA datafiles for switching")
     group.add_argument("-f", "--file", help="stream a single file only ")
     parser.add_argument("-g", "--gui", help="use the GUI", action="store_true")
+    parser.add_argument("--cache", help="parse the datafile once and stream it from memory", action="store_true")
+    parser.add_argument("--broadcast", help="send one paced stream to all streaming clients", action="store_true")
+    parser.add_argument("--slow", help="in broadcast mode, drop frames for or disconnect clients that cannot keep up",
+                        choices=['drop', 'disconnect'], default='drop')
     args = parser.parse_args()
     print(args)
 
@@ -240,7 +240,7 @@ def update():
             # choose if multiple DataFrames, choose that with greatest timestamp
             if bsh.latest_df is None or m.give_timestamp_secs() >= bsh.latest_df.give_timestamp_secs():
                 bsh.latest_df = m
-            print(m.give_coils()[0].__dict__)
+            print(m.give_coils()[0].give_fields())
         elif type(m) == tuple:
             bsh.head_inversion = m
         elif type(m) == str:
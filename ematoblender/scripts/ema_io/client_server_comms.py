@@ -3,8 +3,9 @@ __author__ = 'Kristy'
 ############## PROTOCOL FOR COMMUNICATION (SETTING UP, SENDING/RECEIVING) BETWEEN CLIENT AND SERVER #############
 import socket
 import sys
+from collections import deque
 
-from .rtc3d_parser import RTC3DPacketParser
+from .rtc3d_parser import RTC3DPacketParser, RTC3DStreamParser
 
 
 class BasicConnection(object):
@@ -14,6 +15,9 @@ class BasicConnection(object):
     def __init__(self, *args):
         # ONLY COMMUNICATIONS PROTOCOL SUPPORTED IS RTC3D
         self.protocol = RTC3DPacketParser
+        self.parser = RTC3DStreamParser()  # splits the received bytes into packets
+        self._packets = deque()  # whole packets (memoryviews with header) received but not yet returned
+        self.closed = False
 
     ############ SIMPLE SEND AND RECEIVE ###########
     def send_verbatim(self, message):
@@ -30,13 +34,55 @@ class BasicConnection(object):
         self.send_verbatim(outbound_packet)
 
     def receive_verbatim(self):
-        '''Ask about the length of the packet, receive the whole packet.
-        Allow extra 8 bytes to check for another packet header.'''
-        h = self.protocol.HEADER_LEN
-        chunks = []; bytesreceived = 0; reply = None
-        # receive the message header
+        '''Return the next whole packet as bytes (header included), see receive_packet.'''
+        packet = self._receive_whole_packet()
+        if packet is None or packet == b'':
+            return packet
+        return bytes(packet)  # the only copy, of the packet as received
+
+    def receive_packet(self):
+        '''Return the next (size, type, body) packet, receiving from the socket if none is buffered.
+        Returns None on timeout (partially received packets stay buffered), and b'' if the connection was closed.'''
+        packet = self._receive_whole_packet()
+        if packet is None or packet == b'':
+            return packet
+        return self._unwrap(packet)
+
+    def _receive_whole_packet(self):
+        '''Return the next packet as a memoryview with its header, like receive_packet.'''
+        while not self._packets:
+            packets = self._receive_into_parser(whole=True)
+            if packets is None:
+                if self.closed:
+                    if self.parser.has_partial():
+                        raise RuntimeError("socket connection broken")
+                    return b''
+                return None
+            self._packets.extend(packets)
+        return self._packets.popleft()
+
+    def _unwrap(self, packet):
+        '''Return a whole packet memoryview as a (size, type, body) tuple, without copying.'''
+        size, atype = self.protocol.HEADER_PACKER.unpack_from(packet)
+        return size, atype, packet[self.protocol.HEADER_LEN:]
+
+    def receive_packets(self):
+        '''Return the buffered packets and all packets completed by one large recv_into call,
+        as (size, type, body) tuples with memoryview bodies.
+        Returns None on timeout or if the connection was closed.'''
+        packets = self._receive_into_parser(whole=False)
+        if packets is None:
+            return None
+        if self._packets:
+            packets = [self._unwrap(p) for p in self._packets] + packets
+            self._packets.clear()
+        return packets
+
+    def _receive_into_parser(self, whole):
+        '''Return the packets completed by one large recv_into call (see RTC3DStreamParser.buffer_updated),
+        or None on timeout or if the connection was closed.'''
         try:
-            reply = self.s.recv(h); chunks.append(reply)
+            nbytes = self.s.recv_into(self.parser.get_buffer())
         except socket.timeout:
             return None
         except BlockingIOError:
@@ -46,18 +92,12 @@ class BasicConnection(object):
             #import traceback
             #print(traceback.print_tb())
             self.s.close()
+            self.closed = True
+            return None
+        if nbytes == 0:
+            self.closed = True
             return None
-        finally:
-            rsize, rtype = self.protocol.get_size_type(reply)
-            bytesreceived = h
-        # receive the message body
-        while bytesreceived < rsize:
-            chunk = self.s.recv(min(int(rsize-bytesreceived), 2048))  # get either 2048 bytes or what is waiting+8
-            if chunk==b'':
-                raise RuntimeError("socket connection broken")
-            chunks.append(chunk)
-            bytesreceived += len(chunk)
-        return b''.join(chunks[:rsize])
+        return self.parser.buffer_updated(nbytes, whole)
 
     ######### FUNCTIONS TO HANDLE DIALOG (and encoding/decoding the messages) #######
 
@@ -80,8 +120,12 @@ class BasicConnection(object):
         #translate message into packet format
         outbound_packet = self.protocol.pack_wrapper(message, atype=msgtype)
         print("I'm sending: {}".format(message[:50]))
-        inbound_packets = self.send_rcv_verbatim(outbound_packet, maxreplies=maxreplies)
-        ascii_replies = [self.protocol.unpack_wrapper(inbound_packet) for inbound_packet in inbound_packets]
+        self.send_verbatim(outbound_packet)
+        ascii_replies = []
+        for reply in range(maxreplies):
+            response = self.receive_packet()
+            if response is not None and response != b'':
+                ascii_replies.append(response)
         print("ASCII reply received: {}\n\n".format(str(ascii_replies)), file=sys.stderr)
         return ascii_replies
 
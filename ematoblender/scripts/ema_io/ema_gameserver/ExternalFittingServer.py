@@ -90,6 +90,6 @@ class ExternalFittingServer:
 
     def __extract_time_stamp_from(self, dataFrame):
 
-        return dataFrame.components[0].timestamp / 1000000
+        return dataFrame.give_timestamp() / 1000000
 
     #--------------------------------------------------------------------------#
@@ -21,6 +21,12 @@ class GameServerSettings:
     smoothMs = 20
     smoothFrames = 4
 
+    # per coil role filters, see filters.py, None to use the smoothFrames/smoothMs average
+    filters = None
+
+    # extrapolation of the sent locations to the display time, see prediction.py, None to send them unchanged
+    prediction = None
+
     bitePlateFrontIsBack = False
 
     bitePlane = {
@@ -32,6 +32,12 @@ class SettingsReader:
         if settings["useHeadCorrection"]:
             GameServerSettings.bitePlane = settings["bitePlane"]
 
+        if "filters" in settings:
+            GameServerSettings.filters = settings["filters"]
+
+        if "prediction" in settings:
+            GameServerSettings.prediction = settings["prediction"]
+
     def set_external_fitting_server_settings(settings):
 
         ExternalFittingServerSettings.host = settings["host"]
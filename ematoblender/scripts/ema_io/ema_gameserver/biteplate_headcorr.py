@@ -52,8 +52,8 @@ class HeadCorrector(object):
         tsv_name = os.path.normpath(os.getcwd() + os.sep + tsv_name) \
         if not os.path.isabs(tsv_name) else tsv_name
         if os.path.isfile(tsv_name):
-            from ..ema_staticserver.mocap_file_parser  import TSVParser
-            bytesdfs = TSVParser(tsv_name).give_all_motion_frames()
+            from ..ema_staticserver.mocap_file_parser import MakeMocapParser
+            bytesdfs = MakeMocapParser.factory(tsv_name).give_all_motion_frames()  # from the recording cache
             dfs = [DataFrame(rawdf=b) for b in bytesdfs]
             if len(dfs) > 1:
                 av = self.process_frames_pre_calc(dfs)
@@ -51,10 +51,10 @@ def remove_outliers(df_list):
 def remove_first_ms_of_list(df_list, ms=100):
     print('THIS IS MY DATAFRAME LIST', df_list)
     microsecs = ms * 1000
-    first_ts = df_list[0].components[0].timestamp
+    first_ts = df_list[0].give_timestamp()
     limit = microsecs + first_ts
     print('limit is', limit)
-    return [df for df in df_list if df.components[0].timestamp >= limit]
+    return [df for df in df_list if df.give_timestamp() >= limit]
 
 
 def head_corr_bp_correct(df, biteplate_refspace, headpos_refspace):
@@ -0,0 +1,363 @@
+__author__ = 'Kristy'
+
+"""
+Causal filters for the streamed coil locations, applied in the gameserver before the data is sent to Blender.
+Each filter works on an (n_coils, 3) array of locations at once, keeping its own state between frames.
+Rotations are not filtered, they are passed on from the newest frame.
+
+The filters are selected per coil role (the names used in the coilSettings of the settings JSON),
+in an optional "filters" entry of the gameServerSettings, eg:
+    "filters": {
+        "default": {"type": "boxcar", "frames": 4},
+        "tongueTip": {"type": "oneEuro", "minCutoff": 1.0, "beta": 0.05},
+        "tongueBack": {"type": "kalman", "processNoise": 500, "measurementNoise": 0.05},
+        "upperLip": {"type": "savitzkyGolay", "frames": 9, "order": 2}
+    }
+Coils without a role of their own use the "default" filter (unfiltered if there is none).
+The entry is optional and not in example.json: without it the frames are smoothed by the average over the
+smoothFrames/smoothMs window (which the gameserver GUI changes). With it, the filtered frames replace that average,
+so the smoothing window has no effect; a boxcar "default" filter gives the old smoothing for the other coils.
+Each entry gives the "type" (none, boxcar, oneEuro, kalman or savitzkyGolay) and the arguments of that filter class.
+
+Each filter reports its effective added latency as the steady-state lag (in seconds) when following
+a coil moving at a constant velocity, which is the delay most visible in live articulatory feedback.
+"""
+
+import math
+import numpy
+
+from ..rtc3d_parser import ComponentXD, Component6D, DataFrame, CoilBuilder6D
+
+
+def give_locations(df):
+    """Return the locations of all coils in the frame's 3D/6D components as one (n_coils, 3) float64 array."""
+    arrays = [c.give_coil_array()[:, c.__class__.GET_INNER_BUILDER().LOC_COLUMNS]
+              for c in df.components if isinstance(c, ComponentXD)]
+    if len(arrays) == 0:
+        return numpy.zeros((0, 3))
+    return numpy.concatenate(arrays).astype(numpy.float64)
+
+
+def with_locations(df, locs):
+    """Return a copy of the frame with the coil locations replaced by the (n_coils, 3) array locs
+    (in the order of give_locations), the rotations and flags are kept."""
+    newdf = df.copy()
+    start = 0
+    for component in newdf.components:
+        if isinstance(component, ComponentXD):
+            newarray = component.give_coil_array().copy()
+            newarray[:, component.__class__.GET_INNER_BUILDER().LOC_COLUMNS] = locs[start:start+len(newarray)]
+            component.set_array(newarray)
+            start += len(newarray)
+    return newdf
+
+
+class CoilFilter(object):
+    """Base class for the filters, which pass the locations through unchanged."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Forget the filter state, eg when the coil structure of the stream changes."""
+        pass
+
+    def apply(self, locs, dt):
+        """Return the filtered (n, 3) locations, given the new measured ones and the seconds since the last frame."""
+        return locs
+
+    def latency(self, dt):
+        """Return the added lag in seconds for a coil moving at constant velocity, with frames every dt seconds."""
+        return 0.0
+
+
+class BoxcarFilter(CoilFilter):
+    """Mean of the last frames, the filter that was used before. Lags half of the window."""
+
+    def __init__(self, frames=4):
+        self.frames = max(1, int(frames))
+        super().__init__()
+
+    def reset(self):
+        self.history = None
+        self.count = 0
+
+    def apply(self, locs, dt):
+        if self.history is None:
+            self.history = numpy.zeros((self.frames,) + locs.shape)
+        self.history[self.count % self.frames] = locs
+        self.count += 1
+        return self.history[:min(self.count, self.frames)].mean(axis=0)
+
+    def latency(self, dt):
+        return (self.frames - 1) / 2 * dt
+
+
+class OneEuroFilter(CoilFilter):
+    """
+    The One Euro filter (Casiez et al. 2012), an exponential smoother whose cutoff frequency rises with speed,
+    so there is little jitter when the coil is still and little lag when it moves fast.
+    """
+
+    def __init__(self, minCutoff=1.0, beta=0.01, dCutoff=1.0):
+        self.min_cutoff = float(minCutoff)
+        self.beta = float(beta)
+        self.d_cutoff = float(dCutoff)
+        super().__init__()
+
+    def reset(self):
+        self.previous = None
+        self.previous_speed = None
+        self.cutoff = None
+
+    @staticmethod
+    def smoothing_factor(cutoff, dt):
+        tau = 1 / (2 * math.pi * cutoff)
+        return 1 / (1 + tau / dt)
+
+    def apply(self, locs, dt):
+        if self.previous is None or dt <= 0:
+            self.previous = locs.copy()
+            self.previous_speed = numpy.zeros(locs.shape)
+            self.cutoff = numpy.full((len(locs), 1), self.min_cutoff)
+            return self.previous
+
+        speed = (locs - self.previous) / dt
+        a_d = self.smoothing_factor(self.d_cutoff, dt)
+        self.previous_speed = a_d * speed + (1 - a_d) * self.previous_speed
+
+        # one cutoff per coil, from the speed of the coil (not per axis, so the direction of motion is kept)
+        self.cutoff = self.min_cutoff + self.beta * numpy.linalg.norm(self.previous_speed, axis=1, keepdims=True)
+        tau = 1 / (2 * math.pi * self.cutoff)
+        a = 1 / (1 + tau / dt)
+        self.previous = a * locs + (1 - a) * self.previous
+        return self.previous
+
+    def latency(self, dt):
+        cutoff = self.min_cutoff if self.cutoff is None else float(self.cutoff.mean())
+        return 1 / (2 * math.pi * cutoff)
+
+
+class KalmanFilter(CoilFilter):
+    """
+    Constant-velocity Kalman filter, with the state (location, velocity) per coil and axis.
+    As the covariance only depends on the noise settings and the frame times, one 2x2 covariance is shared by all.
+    processNoise is the acceleration variance (mm^2/s^4 for mm data), measurementNoise the location variance.
+    """
+
+    def __init__(self, processNoise=500.0, measurementNoise=0.05):
+        self.q = float(processNoise)
+        self.r = float(measurementNoise)
+        super().__init__()
+
+    def reset(self):
+        self.loc = None
+        self.vel = None
+        self.p = None
+
+    def apply(self, locs, dt):
+        if self.loc is None or dt <= 0:
+            self.loc, self.vel = locs.copy(), numpy.zeros(locs.shape)
+            self.p = numpy.array([[self.r, 0], [0, self.r / max(dt, 1e-3) ** 2]])
+            return self.loc
+
+        # predict
+        f = numpy.array([[1, dt], [0, 1]])
+        q = self.q * numpy.array([[dt ** 4 / 4, dt ** 3 / 2], [dt ** 3 / 2, dt ** 2]])
+        loc = self.loc + self.vel * dt
+        p = f @ self.p @ f.T + q
+
+        # update with the measured location
+        k_loc, k_vel = p[:, 0] / (p[0, 0] + self.r)
+        innovation = locs - loc
+        self.loc = loc + k_loc * innovation
+        self.vel = self.vel + k_vel * innovation
+        self.p = p - numpy.outer([k_loc, k_vel], p[0])
+        return self.loc
+
+    def latency(self, dt):
+        return 0.0  # the velocity state follows constant velocity motion without lag
+
+
+class SavitzkyGolayFilter(CoilFilter):
+    """
+    Causal Savitzky-Golay filter: fits a polynomial of the given order to the last frames (by least squares)
+    and takes its value at the newest frame. Presumes regularly spaced frames.
+    With order >= 1 constant velocity motion is followed without lag, at the cost of less smoothing.
+    """
+
+    def __init__(self, frames=9, order=2):
+        self.frames = max(2, int(frames))
+        self.order = min(int(order), self.frames - 1)
+        # the fitted polynomial at t = 0 is a fixed weighted sum of the samples at t = -(frames - 1)...0
+        t = numpy.arange(-(self.frames - 1), 1)
+        self.weights = numpy.linalg.pinv(numpy.vander(t, self.order + 1, increasing=True))[0]
+        super().__init__()
+
+    def reset(self):
+        self.history = None
+        self.count = 0
+
+    def apply(self, locs, dt):
+        if self.history is None:
+            self.history = numpy.zeros((self.frames,) + locs.shape)
+        self.history[self.count % self.frames] = locs
+        self.count += 1
+        if self.count < self.frames:  # not enough frames yet to fit
+            return locs
+        # weights are ordered oldest to newest, the oldest frame is the next one to be overwritten
+        order = (numpy.arange(self.frames) + self.count) % self.frames
+        return numpy.tensordot(self.weights, self.history[order], axes=1)
+
+    def latency(self, dt):
+        t = numpy.arange(-(self.frames - 1), 1)
+        return float(-numpy.dot(self.weights, t)) * dt
+
+
+FILTER_TYPES = {'none': CoilFilter,
+                'boxcar': BoxcarFilter,
+                'oneEuro': OneEuroFilter,
+                'kalman': KalmanFilter,
+                'savitzkyGolay': SavitzkyGolayFilter}
+
+
+def filter_from_settings(filtersettings):
+    """Create a filter from its settings dictionary, eg {"type": "oneEuro", "beta": 0.05}."""
+    options = dict(filtersettings)
+    filtertype = options.pop('type')
+    if filtertype not in FILTER_TYPES:
+        raise ValueError('Unknown filter type {}, choose from {}'.format(filtertype, ', '.join(FILTER_TYPES)))
+    return FILTER_TYPES[filtertype](**options)
+
+
+class FilterPipeline(object):
+    """Apply a filter per coil role to each streamed data frame."""
+
+    DEFAULT_DT = 0.01  # presumed frame interval until two frames have been seen
+
+    def __init__(self, role_filters, role_indices, default=None):
+        """role_filters maps role names to filters, role_indices maps role names to coil indices
+        (as in the coilSettings), coils without a filtered role use the default filter."""
+        self.role_filters = role_filters
+        self.role_indices = role_indices
+        self.default = CoilFilter() if default is None else default
+        self.n_coils = None
+        self.groups = []
+        self.last_timestamp = None
+        self.dt = self.__class__.DEFAULT_DT
+
+    @classmethod
+    def from_settings(cls, filtersettings, role_indices):
+        """Create the pipeline from the "filters" entry of the gameServerSettings."""
+        filtersettings = dict(filtersettings)
+        default = filter_from_settings(filtersettings.pop('default')) if 'default' in filtersettings else None
+        return cls({role: filter_from_settings(f) for role, f in filtersettings.items()}, role_indices, default)
+
+    def _group_coils(self, n_coils):
+        """Set up the (filter, coil indices) groups for frames with n_coils coils."""
+        self.n_coils = n_coils
+        unassigned = numpy.ones(n_coils, dtype=bool)
+        self.groups = []
+        for role, coilfilter in self.role_filters.items():
+            index = self.role_indices.get(role)
+            if index is None or not 0 <= index < n_coils:
+                print('No coil {} to filter for the role {}'.format(index, role))
+                continue
+            coilfilter.reset()
+            self.groups.append((role, coilfilter, numpy.array([index])))
+            unassigned[index] = False
+        self.default.reset()
+        self.groups.append(('default', self.default, numpy.flatnonzero(unassigned)))
+
+    def apply(self, df):
+        """Filter the locations of the new frame, return them in a copy of the frame."""
+        locs = give_locations(df)
+        if len(locs) != self.n_coils:
+            self._group_coils(len(locs))
+
+        timestamp = df.give_timestamp_secs()
+        if self.last_timestamp is not None and timestamp is not None and timestamp > self.last_timestamp:
+            self.dt = timestamp - self.last_timestamp
+        self.last_timestamp = timestamp
+
+        filtered = locs.copy()
+        for role, coilfilter, indices in self.groups:
+            if len(indices) > 0:
+                filtered[indices] = coilfilter.apply(locs[indices], self.dt)
+
+        newdf = with_locations(df, filtered)
+        newdf.smoothed = True
+        return newdf
+
+    def latency_report(self):
+        """Return a dict of the added latency in seconds for each role (and the default), at the current frame rate."""
+        report = {role: coilfilter.latency(self.dt) for role, coilfilter in self.role_filters.items()}
+        report['default'] = self.default.latency(self.dt)
+        return report
+
+
+def main():
+    # some unit tests, with a step and a ramp input of known response
+    dt = 0.01
+    step = [numpy.full((2, 3), 0.0 if i < 5 else 1.0) for i in range(300)]
+    velocity = 50.0  # of the ramp, in units per second
+    ramp = [numpy.full((2, 3), velocity * i * dt) for i in range(300)]
+
+    def run(coilfilter, inputs):
+        coilfilter.reset()
+        return [coilfilter.apply(locs, dt).copy() for locs in inputs]
+
+    print('Testing the step responses')
+    assert all((out == locs).all() for out, locs in zip(run(CoilFilter(), step), step))
+
+    out = run(BoxcarFilter(frames=4), step)
+    assert [float(o[0, 0]) for o in out[4:10]] == [0.0, 0.25, 0.5, 0.75, 1.0, 1.0]
+
+    out = run(OneEuroFilter(minCutoff=1.0, beta=0.0), step)  # without beta, a fixed exponential smoother
+    a = OneEuroFilter.smoothing_factor(1.0, dt)
+    assert out[4][0, 0] == 0 and numpy.isclose(out[5][0, 0], a) and numpy.isclose(out[6][0, 0], a + (1 - a) * a)
+    assert all(0 <= o[0, 0] <= 1 for o in out) and all(x[0, 0] <= y[0, 0] for x, y in zip(out, out[1:]))
+    out = run(OneEuroFilter(minCutoff=1.0, beta=0.05), step)
+    assert out[5][0, 0] > a  # responds faster to the fast movement
+
+    out = run(KalmanFilter(), step)
+    assert out[4][0, 0] == 0 and 0 < out[5][0, 0] < 1 and abs(out[-1][0, 0] - 1) < 1e-3
+
+    sg = SavitzkyGolayFilter(frames=9, order=2)
+    assert numpy.isclose(sg.weights.sum(), 1)
+    out = run(sg, step)
+    assert all((o == locs).all() for o, locs in zip(out[:8], step[:8]))  # passed through until 9 frames are seen
+    assert all(numpy.allclose(o, 1) for o in out[13:])
+    out = run(SavitzkyGolayFilter(frames=4, order=0), step)  # order 0 is the boxcar
+    assert numpy.allclose([o[0, 0] for o in out[5:9]], [0.25, 0.5, 0.75, 1.0])
+
+    print('Testing the latencies against the lag behind a ramp')
+    for coilfilter in [CoilFilter(), BoxcarFilter(frames=4), OneEuroFilter(minCutoff=1.0, beta=0.01),
+                       KalmanFilter(), SavitzkyGolayFilter(frames=9, order=2), SavitzkyGolayFilter(frames=5, order=0)]:
+        out = run(coilfilter, ramp)
+        lag = (ramp[-1] - out[-1]) / velocity
+        assert numpy.allclose(lag, coilfilter.latency(dt), atol=1e-4), (coilfilter, lag, coilfilter.latency(dt))
+
+    print('Testing the pipeline')
+
+    def make_frame(i, loc):
+        array = numpy.zeros((3, CoilBuilder6D.EACH_FIELDS), dtype=CoilBuilder6D.ARRAY_DTYPE)
+        array[:, 0] = 1
+        array[:, 4:7] = loc
+        array[:, -1:].view(CoilBuilder6D.FLAG_DTYPE)[:, 0] = 7
+        component = Component6D(framenum=i, timestamp=i * 20000)  # frames every 20 ms
+        component.set_array(array)
+        return DataFrame(components=[component])
+
+    pipeline = FilterPipeline.from_settings({'tongueTip': {'type': 'boxcar', 'frames': 2}}, {'tongueTip': 1})
+    filtered = [pipeline.apply(make_frame(i, 0.0 if i < 3 else 1.0)) for i in range(5)]
+    assert [give_locations(df)[:, 0].tolist() for df in filtered[2:]] == [[0, 0, 0], [1, 0.5, 1], [1, 1, 1]]
+    assert all(df.smoothed for df in filtered) and numpy.isclose(pipeline.dt, 0.02)
+    assert (CoilBuilder6D.give_flags(filtered[-1].give_coil_array()) == 7).all()
+    assert (filtered[-1].give_coil_array()[:, 0] == 1).all()  # rotations are kept
+    assert numpy.isclose(pipeline.latency_report()['tongueTip'], 0.01) and pipeline.latency_report()['default'] == 0
+    assert isinstance(filter_from_settings({'type': 'none'}), CoilFilter)
+
+
+if __name__ == "__main__":
+    main()
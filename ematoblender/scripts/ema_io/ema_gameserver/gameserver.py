@@ -11,7 +11,8 @@ This script is generally run independently from the command line,
  though it may be started using Popen, and persists in the background.
  There are plans to later include a GUI for this module instead. #TODO
 Because the BlenderGE script will only display the raw data it is given, filtering, headcorr need to happen here.
-- filtering: currently just an average over the last n frames
+- filtering: an average over the last n frames, or per coil role filters set in the settings (see filters.py)
+- prediction: optional extrapolation of the locations to the display time (see prediction.py)
 - head correction: based on an initial stream conducted upon startup.
 """
 
@@ -34,6 +35,9 @@ from .tongue_model import TongueModel
 from .ExternalFittingServer import ExternalFittingServer
 from .GameServerSettings import GameServerSettings as settings
 from .ReferencePointBuilder import ReferencePointBuilder
+from .CoilSettings import CoilSettings
+from .filters import FilterPipeline
+from .prediction import MotionPredictor
 
 # global properties, coil definitions
 from ...ema_shared import properties as pps
@@ -132,6 +136,8 @@ class GameServer(socketserver.UDPServer):
 
         # determine the amount of smoothing on streaming dataframes
         self.set_smoothing_n()
+        self.set_filters()
+        self.set_prediction()
 
         self.last_status = 'INITIALISED'
 
@@ -171,6 +177,28 @@ class GameServer(socketserver.UDPServer):
         self.repl.change_smoothing_length(self.smooth_n)
 
 
+    def set_filters(self, filtersettings=None):
+        """Set the per coil role filters from the settings (see filters.py), replacing the smoothing average."""
+        if filtersettings is None:
+            filtersettings = settings.filters
+        if filtersettings is None:
+            self.repl.set_filters(None)
+            return
+        pipeline = FilterPipeline.from_settings(filtersettings, CoilSettings.coils)
+        self.repl.set_filters(pipeline)
+        print('Filtering streamed data, added latency per role (ms):',
+              {role: round(lag * 1000, 1) for role, lag in pipeline.latency_report().items()})
+
+    def set_prediction(self, predictionsettings=None):
+        """Set the extrapolation of the sent locations to the display time from the settings (see prediction.py)."""
+        if predictionsettings is None:
+            predictionsettings = settings.prediction
+        if predictionsettings is None:
+            self.repl.set_predictor(None)
+            return
+        self.repl.set_predictor(MotionPredictor.from_settings(predictionsettings))
+        print('Predicting streamed locations', predictionsettings)
+
     def n_frames_smoothed(self, ms=None, frames=None):
         """
         Smoothing takes the form of a rolling average over the last n frames to filter random error.
@@ -275,21 +303,19 @@ class MyUDPHandler(socketserver.BaseRequestHandler):
             data_to_send = 'streaming started'  # returns nothing, just issues command
 
         elif self.data == b'STREAM_DF':
-            newest_x = rtc.get_last_streamed_dfs()
-            #data_to_send = newest_x[-1] # simplest output for debugging
+            #data_to_send = rtc.get_last_streamed_dfs()[-1] # simplest output for debugging
             """
             This step represents the live filtering
-            - input must be a list of some DataFrame objects
+            - input is the smoothing window of the latest DataFrame objects (a CoilRingBuffer)
             - output must be a single DataFrame
-            This currently uses the default fromlist construction
-            which is simply the average of the values in each dimension,
-            and average rotation values using the average_quaternions fn.
+            This is the average of the values in each dimension, and the average rotation,
+            which the window keeps running sums for, so the cost does not grow with the window length.
             """
-            data_to_send = DataFrame(fromlist=newest_x)  # returns averaged data from the latest x dfs
+            data_to_send = rtc.get_smoothed_df()  # returns averaged (or filtered) data from the latest x dfs
 
         elif self.data == b'STREAM_STOP':
-            newest_x = self.server.gs_stop_streaming()
-            data_to_send = DataFrame(fromlist=newest_x)  # returns averaged data from the latest x dfs
+            self.server.gs_stop_streaming()
+            data_to_send = self.server.repl.give_smoothed_df()  # returns averaged data from the latest x dfs
 
         # qualitative data, no manipulation
         elif self.data == b'PARAMETERS':
@@ -313,6 +339,14 @@ class MyUDPHandler(socketserver.BaseRequestHandler):
             print('choosing data', self.server.last_cam_trans, server.cam_pos)
             data_to_send = [self.server.last_cam_trans, self.server.cam_pos]
 
+        elif self.data == b'FILTER_LATENCY':
+            filters = self.server.repl.filters
+            data_to_send = filters.latency_report() if filters is not None else {}
+
+        elif self.data == b'PREDICTION_ERROR':
+            predictor = self.server.repl.predictor
+            data_to_send = predictor.error_report() if predictor is not None else {}
+
         elif self.data == b'SET_MODEL_VERTEX_INDICES':
             self.server.externalFittingServer.set_model_vertex_indices()
             data_to_send = b'SET MODEL VERTEX INDICES.'
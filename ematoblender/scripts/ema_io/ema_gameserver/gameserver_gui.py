@@ -121,6 +121,9 @@ class Application(tk.Frame):
             else:
                 self.frameentry.delete(0, tk.END)
 
+        if GameServerSettings.smoothFrames is not None:
+            self.servobj.set_smoothing_n(GameServerSettings.smoothFrames)  # resize the window, keeping its data
+
     def createMenuBar(self):
         """Create a manubar with pulldown menus"""
         # create a menubar
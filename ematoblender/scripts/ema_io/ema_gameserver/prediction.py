@@ -0,0 +1,194 @@
+__author__ = 'Kristy'
+
+"""
+Latency-compensating prediction of the coil locations, applied in the gameserver to the frames sent to Blender.
+Between the sensor and the screen the data is delayed by the WAVE itself, the smoothing/filters,
+the polling of the gameserver by the game loop and the unpickling in Blender.
+The predictor fits a low order polynomial (constant velocity or constant acceleration) to the locations
+of the most recently streamed frames and extrapolates every coil to the expected display time.
+
+It is set with an optional "prediction" entry of the gameServerSettings, eg:
+    "prediction": {"horizonMs": 30, "model": "velocity", "frames": 5, "maxDistance": 3, "maxHorizonMs": 100}
+horizonMs is the latency to compensate, besides the time the newest frame already waited in the gameserver,
+which is added automatically. The horizon is clamped to maxHorizonMs, and each coil is moved by at most
+maxDistance (in the units of the data, mm for the WAVE), so a jump in the data cannot overshoot far.
+
+To see whether prediction helps, each prediction is later compared with the measured location at its target time,
+giving the RMS error of the predicted locations against that of just sending the newest locations (error_report).
+"""
+
+import threading
+import time
+from collections import deque
+
+import numpy
+
+from .filters import give_locations, with_locations
+from ..rtc3d_parser import Component6D, DataFrame, CoilBuilder6D
+
+
+class MotionPredictor(object):
+    """Extrapolate the coil locations of a data frame to the expected display time."""
+
+    MODELS = {'velocity': 1, 'acceleration': 2}  # polynomial order fitted for each model
+    MAX_PENDING = 200  # predictions waiting to be compared with the measured locations
+
+    def __init__(self, horizonMs=30, model='velocity', frames=5, maxDistance=3.0, maxHorizonMs=100):
+        if model not in self.__class__.MODELS:
+            raise ValueError('Unknown prediction model {}, choose from {}'
+                             .format(model, ', '.join(self.__class__.MODELS)))
+        self.order = self.__class__.MODELS[model]
+        self.horizon = horizonMs / 1000
+        self.max_horizon = maxHorizonMs / 1000
+        self.max_distance = float(maxDistance)
+        self.frames = max(self.order + 1, int(frames))
+        self._lock = threading.Lock()
+        self.reset()
+
+    @classmethod
+    def from_settings(cls, predictionsettings):
+        """Create the predictor from the "prediction" entry of the gameServerSettings."""
+        return cls(**predictionsettings)
+
+    def reset(self):
+        """Forget the frame history and the error statistics."""
+        with self._lock:
+            self.times = deque(maxlen=self.frames)  # sensor timestamps in seconds
+            self.locs = deque(maxlen=self.frames)  # (n_coils, 3) location arrays
+            self.last_arrival = None  # local clock time the newest frame was observed
+            self.pending = deque(maxlen=self.__class__.MAX_PENDING)  # (target time, predicted, unpredicted)
+            self.n_compared = 0
+            self.predicted_sq_error = 0.0
+            self.unpredicted_sq_error = 0.0
+
+    def observe(self, df):
+        """Add a newly streamed (unsmoothed) frame to the history, comparing earlier predictions against it."""
+        timestamp = df.give_timestamp_secs()
+        if timestamp is None:
+            return
+        locs = give_locations(df)
+        with self._lock:
+            if len(self.locs) > 0 and (self.locs[-1].shape != locs.shape or timestamp <= self.times[-1]):
+                # different coils, or the stream restarted
+                self.times.clear()
+                self.locs.clear()
+                self.pending.clear()
+            self.times.append(timestamp)
+            self.locs.append(locs)
+            self.last_arrival = time.perf_counter()
+            self._compare(timestamp, locs)
+
+    def _compare(self, timestamp, locs):
+        """Score the predictions whose target time has been reached, against the measured locations."""
+        while len(self.pending) > 0 and self.pending[0][0] <= timestamp:
+            target, predicted, unpredicted = self.pending.popleft()
+            if predicted.shape != locs.shape:
+                continue
+            self.n_compared += len(locs)
+            self.predicted_sq_error += float(numpy.sum((predicted - locs) ** 2))
+            self.unpredicted_sq_error += float(numpy.sum((unpredicted - locs) ** 2))
+
+    def displacement(self, horizon):
+        """Return the (n_coils, 3) extrapolated movement over horizon seconds past the newest frame,
+        clamped to max_distance per coil. Returns None until enough frames have been seen."""
+        if len(self.locs) <= self.order:
+            return None
+        t = numpy.array(self.times) - self.times[-1]
+        locs = numpy.array(self.locs)
+        # least squares fit of all coils and axes at once, coefficients are highest order first
+        coefs = numpy.polyfit(t, locs.reshape(len(t), -1), self.order)
+        powers = horizon ** numpy.arange(self.order, 0, -1)
+        moved = numpy.dot(powers, coefs[:-1]).reshape(locs.shape[1:])
+
+        distance = numpy.linalg.norm(moved, axis=1, keepdims=True)
+        scale = numpy.minimum(1, self.max_distance / numpy.maximum(distance, 1e-12))
+        return moved * scale
+
+    def predict(self, df):
+        """Return a copy of the frame (eg the smoothed one to be sent) moved by the extrapolated displacement,
+        or the frame itself while there is too little history to predict."""
+        with self._lock:
+            if self.last_arrival is None:
+                return df
+            waited = time.perf_counter() - self.last_arrival
+            horizon = min(self.horizon + waited, self.max_horizon)
+            moved = self.displacement(horizon)
+            if moved is None:
+                return df
+            locs = give_locations(df)
+            if locs.shape != moved.shape:
+                return df
+            predicted = locs + moved
+            self.pending.append((self.times[-1] + horizon, predicted, locs))
+
+        return with_locations(df, predicted)
+
+    def error_report(self):
+        """Return the number of compared coil locations and the RMS error of the predicted and of the
+        unpredicted locations against the locations measured at the target time."""
+        with self._lock:
+            n = self.n_compared
+            return {'compared': n,
+                    'predicted_rms': (self.predicted_sq_error / n) ** 0.5 if n else None,
+                    'unpredicted_rms': (self.unpredicted_sq_error / n) ** 0.5 if n else None}
+
+
+def main():
+    # some unit tests, with motion the models fit exactly
+    def make_frame(i, locs):
+        array = numpy.zeros((len(locs), CoilBuilder6D.EACH_FIELDS), dtype=CoilBuilder6D.ARRAY_DTYPE)
+        array[:, 0] = 1
+        array[:, 4:7] = locs
+        component = Component6D(framenum=i, timestamp=i * 10000)  # frames every 10 ms
+        component.set_array(array)
+        return DataFrame(components=[component])
+
+    velocity = numpy.array([[20.0, 0, -10], [0, 0, 0]])  # units per second, of two coils
+    acceleration = numpy.array([[0.0, 400, 0], [-200, 0, 0]])
+    linear = [make_frame(i, velocity * i / 100) for i in range(20)]
+    quadratic = [make_frame(i, acceleration * (i / 100) ** 2 / 2) for i in range(20)]
+
+    print('Testing the extrapolation')
+    predictor = MotionPredictor(horizonMs=50, model='velocity', frames=5, maxDistance=100, maxHorizonMs=50)
+    predictor.observe(linear[0])
+    assert predictor.predict(linear[0]) is linear[0]  # too little history to predict
+    for df in linear[1:]:
+        predictor.observe(df)
+    assert numpy.allclose(predictor.displacement(0.05), velocity * 0.05, atol=1e-4)
+    # the horizon is clamped to maxHorizonMs, however long the frame waited
+    predicted = predictor.predict(linear[-1])
+    assert numpy.allclose(give_locations(predicted), give_locations(linear[-1]) + velocity * 0.05, atol=1e-4)
+    assert (predicted.give_coil_array()[:, 0] == 1).all()  # rotations are kept
+
+    predictor = MotionPredictor(horizonMs=50, model='acceleration', frames=5, maxDistance=100, maxHorizonMs=50)
+    for df in quadratic:
+        predictor.observe(df)
+    t = 0.19
+    assert numpy.allclose(predictor.displacement(0.05), acceleration * ((t + 0.05) ** 2 - t ** 2) / 2, atol=1e-3)
+
+    print('Testing the clamping')
+    predictor = MotionPredictor(horizonMs=50, model='velocity', frames=5, maxDistance=0.5, maxHorizonMs=50)
+    for df in linear:
+        predictor.observe(df)
+    moved = predictor.displacement(0.05)
+    assert numpy.isclose(numpy.linalg.norm(moved[0]), 0.5) and numpy.allclose(moved[1], 0)
+    assert numpy.allclose(moved[0] / numpy.linalg.norm(moved[0]), velocity[0] / numpy.linalg.norm(velocity[0]))
+
+    print('Testing the error report')
+    predictor = MotionPredictor(horizonMs=50, model='velocity', frames=5, maxDistance=100, maxHorizonMs=50)
+    for df in linear:
+        predictor.observe(df)
+        predictor.predict(df)
+    report = predictor.error_report()
+    # compared with the first frame at or after the target time, so not exact
+    assert report['compared'] > 0 and report['predicted_rms'] < report['unpredicted_rms'] / 5
+
+    print('Testing a restarted stream')
+    predictor.observe(linear[0])  # earlier timestamp, the history starts again
+    assert len(predictor.locs) == 1 and predictor.predict(linear[0]) is linear[0]
+    predictor.reset()
+    assert predictor.error_report()['compared'] == 0
+
+
+if __name__ == "__main__":
+    main()
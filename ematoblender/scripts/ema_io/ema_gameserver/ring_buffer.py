@@ -0,0 +1,225 @@
+__author__ = 'Kristy'
+
+"""
+Sliding window of the most recently streamed data frames, used for smoothing in the gameserver.
+The coil locations (and the quaternion outer products) of the window are held in preallocated NumPy arrays
+with running sums that are updated as frames enter and leave the window,
+so the window mean costs the same whatever the window length.
+"""
+
+import threading
+import numpy
+
+from ..rtc3d_parser import ComponentXD, Component6D, DataFrame, MessageBuilder, CoilBuilder6D
+from ...ema_shared.general_maths import quaternion_outer_products, average_quaternions_from_outer_sum
+
+
+class ComponentWindow(object):
+    """Ring buffer of the location and rotation data of one component position over the window."""
+
+    def __init__(self, capacity, builder, n_coils):
+        self.builder = builder
+        self.n_coils = n_coils
+        self.locs = numpy.zeros((capacity, n_coils, 3))
+        self.loc_sum = numpy.zeros((n_coils, 3))
+        if builder.ROT_COLUMNS is not None:
+            self.rots = numpy.zeros((capacity, n_coils, 4, 4))  # outer products q q^T
+            self.rot_sum = numpy.zeros((n_coils, 4, 4))
+        else:
+            self.rots, self.rot_sum = None, None
+
+    def fits(self, component):
+        return component.__class__.GET_INNER_BUILDER() is self.builder and \
+               len(component.give_coil_array()) == self.n_coils
+
+    def put(self, i, array, replacing):
+        """Write the coil array into slot i, updating the running sums. If replacing, slot i held a frame before."""
+        if replacing:
+            self.loc_sum -= self.locs[i]
+        self.locs[i] = array[:, self.builder.LOC_COLUMNS]
+        self.loc_sum += self.locs[i]
+        if self.rots is not None:
+            if replacing:
+                self.rot_sum -= self.rots[i]
+            self.rots[i] = quaternion_outer_products(array[:, self.builder.ROT_COLUMNS].astype(numpy.float64))
+            self.rot_sum += self.rots[i]
+
+    def resum(self, n):
+        """Recompute the running sums over the first n slots, removing accumulated rounding (and old NaNs)."""
+        self.loc_sum = self.locs[:n].sum(axis=0)
+        if self.rots is not None:
+            self.rot_sum = self.rots[:n].sum(axis=0)
+
+    def mean_array(self, n, latest):
+        """Return the window mean as a coil array, with the flags of the latest coil array."""
+        mean = numpy.empty(latest.shape, dtype=self.builder.ARRAY_DTYPE)
+        mean[:, self.builder.LOC_COLUMNS] = self.loc_sum / n
+        if self.rots is not None:
+            mean[:, self.builder.ROT_COLUMNS] = average_quaternions_from_outer_sum(
+                self.rot_sum, latest[:, self.builder.ROT_COLUMNS].astype(numpy.float64))
+        mean[:, -1] = latest[:, -1]  # same dtype, so the flag bits are copied unchanged
+        return mean
+
+
+class CoilRingBuffer(object):
+    """
+    Keeps the last maxlen data frames (like a deque with maxlen, which it replaces in NonBlockingStreamReader),
+    plus the running sums needed to give their mean data frame in O(coils) with mean_dataframe.
+    A window of one frame keeps no sums, so its (lazy) frames are only decoded if they are used.
+    If the structure of the streamed frames changes (eg a different number of coils) the window restarts.
+    Appending, reading and resizing are thread-safe.
+    """
+
+    def __init__(self, maxlen=5):
+        self._lock = threading.RLock()
+        self._maxlen = max(1, maxlen)
+        self._reset()
+
+    def _reset(self):
+        self._frames = [None] * self._maxlen
+        self._windows = None
+        self._next = 0  # slot written by the next append
+        self._count = 0
+
+    @property
+    def maxlen(self):
+        return self._maxlen
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        """Iterate over the frames, oldest first."""
+        with self._lock:
+            return iter([self._frames[i] for i in self._order()])
+
+    def __getitem__(self, index):
+        with self._lock:
+            return self._frames[self._order()[index]]
+
+    def _order(self):
+        """Slot indices from oldest to newest."""
+        start = (self._next - self._count) % self._maxlen
+        return [(start + i) % self._maxlen for i in range(self._count)]
+
+    def clear(self):
+        with self._lock:
+            self._reset()
+
+    def append(self, df):
+        """Add a data frame to the window, dropping the oldest frame if the window is full."""
+        with self._lock:
+            if self._maxlen == 1:  # the mean of one frame is that frame, so a lazy frame is not decoded here
+                self._frames[0], self._windows, self._count = df, None, 1
+                return
+            components = df.components
+            if self._windows is None or len(self._windows) != len(components) or \
+                    not all(w is None or w.fits(c) for w, c in zip(self._windows, components)):
+                self._reset()
+                self._windows = [ComponentWindow(self._maxlen, c.__class__.GET_INNER_BUILDER(),
+                                                 len(c.give_coil_array()))
+                                 if isinstance(c, ComponentXD) else None for c in components]
+
+            replacing = self._count == self._maxlen
+            for window, component in zip(self._windows, components):
+                if window is not None:
+                    window.put(self._next, component.give_coil_array(), replacing)
+            self._frames[self._next] = df
+            self._next = (self._next + 1) % self._maxlen
+            self._count = min(self._count + 1, self._maxlen)
+
+            if self._next == 0:  # once per pass around the ring
+                for window in self._windows:
+                    if window is not None:
+                        window.resum(self._count)
+
+    def resize(self, maxlen):
+        """Change the window length, keeping the newest frames (as many as fit)."""
+        maxlen = max(1, maxlen)
+        with self._lock:
+            if maxlen == self._maxlen:
+                return
+            kept = list(self)[-maxlen:]
+            self._maxlen = maxlen
+            self._reset()
+            for df in kept:
+                self.append(df)
+
+    def mean_dataframe(self):
+        """Return a smoothed copy of the newest frame, holding the mean over the window.
+        Locations are the mean, rotations the quaternion average. Returns None if the window is empty.
+        """
+        with self._lock:
+            if self._count == 0:
+                return None
+            latest = self._frames[(self._next - 1) % self._maxlen]
+            meanobj = latest.copy()
+            meanobj.smoothed = True
+            if self._windows is None:  # a window of one frame
+                return meanobj
+            for window, component in zip(self._windows, meanobj.components):
+                if window is not None:
+                    component.set_array(window.mean_array(self._count, component.give_coil_array()))
+            return meanobj
+
+
+def main():
+    # some unit tests, comparing the running means with MessageBuilder.average_dataframes of the same frames
+    rng = numpy.random.RandomState(0)
+
+    def make_frame(i):
+        """A frame of 6 coils moving around (100, -50, 20), rotated a little from one orientation."""
+        array = numpy.zeros((6, CoilBuilder6D.EACH_FIELDS), dtype=CoilBuilder6D.ARRAY_DTYPE)
+        quats = numpy.array([0.8, 0.2, -0.4, 0.4]) + rng.normal(0, 0.05, (6, 4))
+        array[:, 0:4] = quats / numpy.linalg.norm(quats, axis=1, keepdims=True)
+        array[:, 4:7] = numpy.array([100, -50, 20]) + rng.normal(0, 5, (6, 3))
+        component = Component6D(framenum=i, timestamp=i * 10000)
+        component.set_array(array)
+        return DataFrame(components=[component])
+
+    def check(ring, frames):
+        """Assert the ring buffer holds the frames and its mean is their average."""
+        assert len(ring) == len(frames) and list(ring) == frames
+        expected = MessageBuilder.average_dataframes(frames).give_coil_array()
+        mean = ring.mean_dataframe()
+        assert mean.smoothed and mean.give_timestamp() == frames[-1].give_timestamp()
+        got = mean.give_coil_array()
+        assert numpy.allclose(got[:, 4:7], expected[:, 4:7], atol=1e-3)
+        # quaternions q and -q are the same rotation
+        assert numpy.allclose(numpy.abs(numpy.sum(got[:, 0:4] * expected[:, 0:4], axis=1)), 1, atol=1e-4)
+        assert (CoilBuilder6D.give_flags(got) == CoilBuilder6D.give_flags(expected)).all()
+
+    frames = [make_frame(i) for i in range(40)]
+
+    print('Testing the running sums over several passes around the ring')
+    ring = CoilRingBuffer(maxlen=5)
+    assert ring.mean_dataframe() is None
+    for i in range(23):
+        ring.append(frames[i])
+        check(ring, frames[max(0, i - 4):i + 1])
+
+    print('Testing resizing the window')
+    ring.resize(3)
+    check(ring, frames[20:23])
+    ring.resize(8)
+    check(ring, frames[20:23])
+    for i in range(23, 40):
+        ring.append(frames[i])
+        check(ring, frames[max(20, i - 7):i + 1])
+
+    print('Testing a window of one frame')
+    ring.resize(1)
+    check(ring, frames[39:])
+    lazy = DataFrame(rawdf=frames[0].pack_all(), lazy=True)
+    ring.append(lazy)
+    assert ring.mean_dataframe().pack_all() == frames[0].pack_all() and not lazy.is_decoded()
+    ring.resize(4)
+    check(ring, [lazy])
+
+    print('Testing clearing the window')
+    ring.clear()
+    assert len(ring) == 0 and ring.mean_dataframe() is None
+
+
+if __name__ == "__main__":
+    main()
@@ -8,15 +8,14 @@ Depends on the rtc3d_parser module to unwrap the binary packages.
 # communication with the server, parsing the objects to and from Coil/DataFrame etc
 from ..rtc3d_parser import RTC3DPacketParser, DataFrame
 from ..client_server_comms import ClientConnection
+from .ring_buffer import CoilRingBuffer
 
 # threading of replies
 from threading import Thread
 from queue import Queue, Empty
-from collections import deque
 
 # debugging
 import time
-import copy
 
 # global variables
 connection = None
@@ -25,9 +24,11 @@ replies = None
 
 class NonBlockingStreamReader():
 
-    def __init__(self, stream, last_x=5):
+    def __init__(self, stream, last_x=5, start_threads=True):
         """Stream: The stream to read from, here received from the server.
         Stream is a Clientconnection object, so NBSR make use of the methods.
+        If start_threads is False, no threads read the stream, the packets are given to _sort_into_queue
+        by the caller (see rtclient_async.LoopStreamReader).
 
         self.latest_df contains a DataFrame object, wiht the latest coil coordinates.
         Coils are accessed as self.latest_df.components[n].coils[m],
@@ -42,7 +43,10 @@ class NonBlockingStreamReader():
         # Dataframe related objects
         self.no_data = False  # begin presuming there is data to be read
         self.latest_df = None
-        self.last_x_dfs = deque(maxlen=last_x)
+        self.last_x_dfs = CoilRingBuffer(maxlen=last_x)  # smoothing window, with running sums of the coil data
+        self.filters = None  # optional FilterPipeline, applied to every streamed frame
+        self.filtered_df = None  # the latest frame after the filters
+        self.predictor = None  # optional MotionPredictor, extrapolating the frames given by give_smoothed_df
 
         # Queues for different types of sever responses
         self._q01 = Queue()  # status
@@ -56,6 +60,11 @@ class NonBlockingStreamReader():
         self.starting_timestamp = None
         self.wave_sampnum_deque = None
 
+        self.threads = []
+        if start_threads:
+            self._start_threads()
+
+    def _start_threads(self):
         # the heart of this class. Must run for client functionality
         self._t = Thread(target=self._populateQueue, )
         self._t.daemon = True
@@ -79,36 +88,44 @@ class NonBlockingStreamReader():
         """Collect lines from stream and put in queue.
         Thread is always receiving."""
         while self.alive:
-            #print('!!!!!!!!!!!\n\n\n\n unpacking wrapper')
-            # TIME IS DEPENDENT ON RECEIVE VERBATIM TIME
-            line = self._s.protocol.unpack_wrapper(self._s.receive_verbatim())
-            if line is not None:
-                #print("Line is not none")
-                rsize, rtype, rmsg = line
-
-                if rtype == 0 or rtype == 1:
-                    self._q01.put(line)
-                elif rtype == 2:
-                    self._q2.put(line)
-                elif rtype == 3 or rtype == 4:
-                    self._q34.put(line)
-                    if rtype == 3 and self.print_tsv:
-                        if self.starting_timestamp is None:
-                            self.starting_timestamp = DataFrame(rawdf=rmsg).components[0].timestamp
-                        if self.print_fo is not None and not self.print_fo.closed:
-                            # write a dataframe, with an audio sample number included
-                            self.print_fo.write(DataFrame(rawdf=rmsg)
-                                                .to_tsv(relative_timestamp_to=self.starting_timestamp,
-                                                        closest_sound_sample=self.wave_sampnum_deque
-                                                        if self.wave_sampnum_deque is not None else [0]))
-                else:
-                    self._q5.put(line)
+            # TIME IS DEPENDENT ON RECEIVE TIME, one recv_into call may complete several packets
+            packets = self._s.receive_packets()
+            if packets is not None:
+                for packet in packets:
+                    self._sort_into_queue(packet)
             else:
                 print(time.strftime('%x %X %Z'), "\t\tClient socket timeout, remains open. \r")
                 time.sleep(0.5)
                 # Previously closed script here, but rather it may be due to not starting streaming
         print("Queue-populating thread closing.")
 
+    def _sort_into_queue(self, line):
+        """Put the unwrapped packet (size, type, body) in the queue for its type, writing data frames to tsv."""
+        rsize, rtype, rmsg = line
+
+        if rtype == 0 or rtype == 1:
+            self._q01.put(line)
+        elif rtype == 2:
+            self._q2.put(line)
+        elif rtype == 3 or rtype == 4:
+            self._q34.put(line)
+            if rtype == 3 and self.print_tsv:
+                self._write_tsv(rmsg)
+        else:
+            self._q5.put(line)
+
+    def _write_tsv(self, rmsg):
+        """Write the data frame message to the print file."""
+        df = DataFrame(rawdf=rmsg)  # coils stay as an array, no coil objects are built here
+        if self.starting_timestamp is None:
+            self.starting_timestamp = df.give_timestamp()
+        if self.print_fo is not None and not self.print_fo.closed:
+            # write a dataframe, with an audio sample number included
+            self.print_fo.write(df
+                                .to_tsv(relative_timestamp_to=self.starting_timestamp,
+                                        closest_sound_sample=self.wave_sampnum_deque
+                                        if self.wave_sampnum_deque is not None else [0]))
+
     def _printReplies(self):
         """If there is something in a queue, print it."""
         while self.alive:
@@ -126,9 +143,7 @@ class NonBlockingStreamReader():
                 #print(type(msg))
                 if type(msg) == DataFrame:
                     #print('!!!!!!!!!!!! updating current dataframe')
-                    self.no_data = False
-                    self.latest_df = msg
-                    self.last_x_dfs.append(self.latest_df)
+                    self._update_current(msg)
                 else:
                     #print('No data at this point.')
                     continue
@@ -137,6 +152,18 @@ class NonBlockingStreamReader():
                 # updating is turned off
         print("Thread closing")
 
+    def _update_current(self, df):
+        """Make the DataFrame df the latest, adding it to the smoothing window, filters and predictor.
+        The coils of a lazy df are only decoded here if the window is longer than one frame,
+        or if filters or a predictor are set."""
+        self.no_data = False
+        self.latest_df = df
+        self.last_x_dfs.append(df)
+        if self.filters is not None:
+            self.filtered_df = self.filters.apply(df)
+        if self.predictor is not None:
+            self.predictor.observe(df)
+
     def readq(self, q, timeout=0.1):
         """Waits 0.1 seconds if the queue is empty, else returns None"""
         try:
@@ -158,7 +185,7 @@ class NonBlockingStreamReader():
         """Return the next XML string as a string, discarding size and type info"""
         params = self.readq(self._q2)
         if params is not None:
-            xmlstring = params[2].decode('utf-8').replace('\x00', '')
+            xmlstring = str(params[2], 'utf-8').replace('\x00', '')
             return xmlstring
         else:
             return None
@@ -169,8 +196,11 @@ class NonBlockingStreamReader():
         data = self.readq(self._q34)
         if data is None:
             return data
-        else:
-            rsize, rtype, rmsg = data
+        return self._decode_data(data)
+
+    def _decode_data(self, data):
+        """Return a type 3/4 packet as a DataFrame, or as the ascii message if there is no data (setting no_data)."""
+        rsize, rtype, rmsg = data
 
         if rtype == 4:  # no data, return message
             self.no_data = True
@@ -178,7 +208,7 @@ class NonBlockingStreamReader():
 
         else:  # data frame, return coils object
             #print("###################\nTHIS IS THE RAW DATAFRAME MESSAGE", rmsg)
-            return DataFrame(rawdf=rmsg)
+            return DataFrame(rawdf=rmsg, lazy=True)  # coils are only decoded if they are used
 
     def readrubbish(self):
         """Return the raw message from the type=5 object (C3D object)"""
@@ -186,31 +216,50 @@ class NonBlockingStreamReader():
         return rubbish
         
     def change_smoothing_length(self, newnframes):
-        """Replace the self.last_x_dfs deque with a deque with the same
-        contents, but with a new maxlen of newnframes
-        """
-        currentd = self.last_x_dfs
+        """Resize the self.last_x_dfs smoothing window to newnframes, keeping the latest frames."""
         print('Changing smoothing to {} frames'.format(newnframes))
-        
-        if newnframes > currentd.maxlen:
-            self.last_x_dfs = deque(currentd, maxlen=newnframes)
-            
-        elif newnframes == currentf.maxlen:
-            return
-            
+        self.last_x_dfs.resize(newnframes)
+
+    def give_smoothed_df(self):
+        """Return the latest filtered frame if filters are set,
+        else the mean of the frames in the smoothing window (see CoilRingBuffer.mean_dataframe).
+        If a predictor is set, the locations are extrapolated to the expected display time."""
+        if self.filters is not None and self.filtered_df is not None:
+            df = self.filtered_df
         else:
-            # deque method takes latest elements if longer then maxlen
-            self.last_x_dfs = deque(currentd, maxlen=newnframes)
+            df = self.last_x_dfs.mean_dataframe()
+        if self.predictor is not None and df is not None:
+            df = self.predictor.predict(df)
+        return df
+
+    def set_filters(self, pipeline):
+        """Filter every streamed frame with the FilterPipeline (or stop filtering if None)."""
+        self.filtered_df = None
+        self.filters = pipeline
+
+    def set_predictor(self, predictor):
+        """Extrapolate the smoothed frames with the MotionPredictor (or stop predicting if None)."""
+        if predictor is not None:
+            predictor.reset()
+        self.predictor = predictor
 
 
 class UnexpectedEndOfStream(Exception):
     pass
 
 
-def init_connection(retain_last=1, print_to=None, wave_to=None, wavehost=None, waveport=None):
-    """Start the connection, set up objects to handle the soon-to-be-incoming data."""
-    # create the connection object to handle communication
+def init_connection(retain_last=1, print_to=None, wave_to=None, wavehost=None, waveport=None, use_asyncio=False):
+    """Start the connection, set up objects to handle the soon-to-be-incoming data.
+    If use_asyncio, the replies are received on one event loop thread (see rtclient_async.LoopStreamReader),
+    which is then both the connection and the reply-reader."""
     global connection, replies
+    if use_asyncio:
+        from .rtclient_async import LoopStreamReader
+        replies = LoopStreamReader(wavehost, waveport, last_x=retain_last)
+        connection = replies
+        return connection, replies
+
+    # create the connection object to handle communication
     connection = ClientConnection(RTC3DPacketParser)
     # replies object listens for replies and places in queues based on type
     replies = NonBlockingStreamReader(connection, last_x=retain_last)
@@ -234,6 +283,9 @@ def close_connection(conn, restart=False):
     if restart:
         conn.send_packed('BYE', 1)
         # TODO: Implement BYE as making server restart data again/close it too
+    if hasattr(conn, 'close'):  # the event loop reader closes its own connection
+        conn.close()
+        return
     replies.alive = False  # should close threads when they complete a loop
     time.sleep(2)  # make sure all the threads could close
     conn.s.close()
@@ -264,10 +316,12 @@ def get_parameters(conn, *args):
 
 def get_one_df(conn, replies, *args):
     """Wait until a df is queued and return it. Return None if the end of the data file was reached."""
-    prev_df = copy.copy(replies.latest_df)
+    prev_df = replies.latest_df
     conn.send_packed("sendcurrentframe", 1)
-    # wait while the data is received from the server
-    while replies.latest_df is None or (prev_df is not None and replies.latest_df == prev_df):
+    # wait while the data is received from the server, comparing headers only so stale frames are not decoded
+    while replies.latest_df is None or (prev_df is not None and
+                                        replies.latest_df.give_timestamp() == prev_df.give_timestamp() and
+                                        replies.latest_df.give_frame_number() == prev_df.give_frame_number()):
         #print('!!!!!!!!!!!!replies.no_data is', replies.no_data)
         if replies.no_data:
             return None
@@ -286,10 +340,18 @@ def get_last_streamed_dfs():
     return replies.last_x_dfs
 
 
+def get_smoothed_df():
+    """Wait until the last_x_dfs is populated, return the mean data frame over it."""
+    get_last_streamed_dfs()
+    return replies.give_smoothed_df()
+
+
 def start_streaming(conn, repl, *args):
     """Give the df object.
     """
     repl.last_x_dfs.clear()
+    if repl.predictor is not None:
+        repl.predictor.reset()
     conn.send_packed("streamframes frequency:100", 1)
     print('just started streaming')
 
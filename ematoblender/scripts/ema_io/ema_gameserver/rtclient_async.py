@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Kristy'
+
+"""
+Asyncio client of the NDI Wave (or static server) RTC3D protocol, instead of the polling threads of rtclient.
+The packets are split straight from the socket buffer by a BufferedProtocol (with RTC3DStreamParser),
+sorted by type into asyncio queues, and the data frames given by async iterators, eg:
+
+    client = await AsyncRTClient.connect(host, port)
+    async for df in client.stream():
+        ...
+
+LoopStreamReader is the thin wrapper for the threaded code (rtclient.init_connection(use_asyncio=True)):
+a NonBlockingStreamReader whose packets come from one event loop thread, rather than three polling threads.
+"""
+
+import asyncio
+import threading
+
+from ..rtc3d_parser import RTC3DPacketParser, RTC3DStreamParser, DataFrame
+from .rtclient import NonBlockingStreamReader
+
+
+class RTC3DClientProtocol(asyncio.BufferedProtocol):
+    """Receive into the RTC3DStreamParser buffers, calling on_packet for every complete (size, type, body) packet."""
+
+    def __init__(self, on_packet, on_closed):
+        self.parser = RTC3DStreamParser()
+        self.on_packet = on_packet
+        self.on_closed = on_closed
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint):
+        return self.parser.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        for packet in self.parser.buffer_updated(nbytes):
+            self.on_packet(packet)
+
+    def connection_lost(self, exc):
+        self.on_closed(exc)
+
+
+class AsyncRTClient(object):
+    """
+    A connection to a RTC3D server on an asyncio event loop.
+    The replies are queued by type like in NonBlockingStreamReader, the data frames in a bounded queue
+    that drops its oldest frames when full, so a slow consumer gets the latest ones.
+    """
+
+    FRAME_QUEUE_LIMIT = 100
+
+    def __init__(self, frame_queue_limit=FRAME_QUEUE_LIMIT, on_packet=None):
+        """
+        :param frame_queue_limit: number of frames kept for the frame iterators
+        :param on_packet: if given, every (size, type, body) packet is passed to this function (on the event loop)
+        instead of being queued
+        """
+        self.protocol = RTC3DPacketParser
+        self.on_packet = on_packet
+        self.transport = None
+        self.closed = None  # future set when the connection is lost
+        self.latest_df = None
+
+        # queues for different types of server responses
+        self._q01 = asyncio.Queue()  # status
+        self._q2 = asyncio.Queue()  # parameter data
+        self._q34 = asyncio.Queue(maxsize=max(1, frame_queue_limit))  # data frame, or None once closed
+        self._q5 = asyncio.Queue()  # c3d file and other
+        self.frames_dropped = 0
+
+    @classmethod
+    async def connect(cls, host=None, port=None, **kwargs):
+        """Return a client connected to (host, port), by default the Wave server in properties."""
+        if host is None or port is None:
+            from ...ema_shared.properties import waveserver_host, waveserver_port
+            host = waveserver_host if host is None else host
+            port = waveserver_port if port is None else port
+        client = cls(**kwargs)
+        await client._connect(host, port)
+        return client
+
+    async def _connect(self, host, port):
+        loop = asyncio.get_running_loop()
+        self.closed = loop.create_future()
+        self.transport, _ = await loop.create_connection(
+            lambda: RTC3DClientProtocol(self._receive_packet, self._connection_lost), host, port)
+
+    def _receive_packet(self, packet):
+        """Queue the packet by its type (or pass it to on_packet)."""
+        if self.on_packet is not None:
+            self.on_packet(packet)
+            return
+        rsize, rtype, rmsg = packet
+        if rtype == 0 or rtype == 1:
+            self._q01.put_nowait(packet)
+        elif rtype == 2:
+            self._q2.put_nowait(packet)
+        elif rtype == 3 or rtype == 4:
+            if self._q34.full():
+                self._q34.get_nowait()
+                self.frames_dropped += 1
+            self._q34.put_nowait(packet)
+        else:
+            self._q5.put_nowait(packet)
+
+    def _connection_lost(self, exc):
+        if not self.closed.done():
+            self.closed.set_result(exc)
+        if self._q34.full():
+            self._q34.get_nowait()
+        self._q34.put_nowait(None)  # ends the frame iterators
+
+    # ###### Sending #######
+    def send_packed(self, message, status=1):
+        """Send the message (a command if status is 1), without waiting."""
+        self.transport.write(self.protocol.pack_wrapper(message, atype=status))
+
+    def close(self):
+        self.transport.close()
+
+    async def wait_closed(self):
+        await asyncio.shield(self.closed)
+
+    # ###### Replies #######
+    async def readline(self):
+        """Return the content of the next ASCII (status) message."""
+        rsize, rtype, rmsg = await self._q01.get()
+        return str(rmsg, 'ascii')
+
+    async def request(self, command):
+        """Send the command and return the reply."""
+        self.send_packed(command, 1)
+        return await self.readline()
+
+    async def parameters(self):
+        """Return the XML string of the server parameters."""
+        self.send_packed("sendparameters", 1)
+        rsize, rtype, rmsg = await self._q2.get()
+        return str(rmsg, 'utf-8').replace('\x00', '')
+
+    async def readdata(self):
+        """Return the next queued data frame as a DataFrame, or None at the end of the data or the connection."""
+        data = await self._q34.get()
+        if data is None:
+            self._q34.put_nowait(None)  # for the other iterators
+            return None
+        rsize, rtype, rmsg = data
+        if rtype == 4:  # no data
+            return None
+        self.latest_df = DataFrame(rawdf=rmsg, lazy=True)  # coils are only decoded if they are used
+        return self.latest_df
+
+    async def current_frame(self):
+        """Request a single frame and return it (None at the end of the data file)."""
+        self.send_packed("sendcurrentframe", 1)
+        return await self.readdata()
+
+    async def frames(self):
+        """Async iterator over the data frames received, until the end of the data or the connection."""
+        while True:
+            df = await self.readdata()
+            if df is None:
+                return
+            yield df
+
+    async def stream(self, frequency=100):
+        """Start streaming and iterate over the streamed frames, streaming stops when the iteration does."""
+        self.send_packed("streamframes frequency:{}".format(frequency), 1)
+        try:
+            async for df in self.frames():
+                yield df
+        finally:
+            if not self.transport.is_closing():
+                self.send_packed("streamframes stop", 1)
+
+
+class LoopStreamReader(NonBlockingStreamReader):
+    """
+    NonBlockingStreamReader fed by an AsyncRTClient on its own event loop thread.
+    It is also the connection (with send_packed and close), for the functions of rtclient.
+    The data frames are not queued: each updates latest_df (and the smoothing window, filters and predictor)
+    as it is received, so readdata gives nothing.
+    """
+
+    def __init__(self, host=None, port=None, last_x=5):
+        self.protocol = RTC3DPacketParser
+        self.event_loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.event_loop.run_forever, name='LoopStreamReader')
+        self._thread.daemon = True
+        self._thread.start()
+        super().__init__(self, last_x=last_x, start_threads=False)
+
+        self.client = asyncio.run_coroutine_threadsafe(
+            AsyncRTClient.connect(host, port, on_packet=self._sort_into_queue), self.event_loop).result()
+
+    def _sort_into_queue(self, line):
+        """Update the latest frame with data frames, queue the other replies."""
+        rsize, rtype, rmsg = line
+        if rtype == 3 or rtype == 4:
+            msg = self._decode_data(line)
+            if type(msg) == DataFrame:
+                self._update_current(msg)
+                if self.print_tsv:
+                    self._write_tsv(rmsg)
+        else:
+            super()._sort_into_queue(line)
+
+    def send_packed(self, message, status):
+        self.event_loop.call_soon_threadsafe(self.client.send_packed, message, status)
+
+    def close(self):
+        """Close the connection and stop the event loop thread."""
+        self.alive = False
+        self.event_loop.call_soon_threadsafe(self.client.close)
+        self.event_loop.call_soon_threadsafe(self.event_loop.stop)
+        self._thread.join(timeout=1.0)
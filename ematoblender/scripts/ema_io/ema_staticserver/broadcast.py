@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Kristy'
+
+"""
+Broadcast mode of the static server: one paced stream of the data file, delivered to every streaming client.
+Without it each client session paces, reads and packs the frames itself. With it a single paced stream
+on the shared DeadlineScheduler (so with the same deadlines and jitter and overrun counters as the sessions' streams)
+gives each frame once, and the same packet is queued for every subscribed session.
+Each subscriber has a bounded queue emptied by its own sending thread, so a slow client never holds up the stream
+or the other clients. When a queue is full, the subscriber either drops its oldest frames (policy 'drop')
+or is disconnected (policy 'disconnect').
+The queue depth, the frames sent and dropped and the lag between a frame being paced and sent
+are counted per subscriber, see Broadcaster.give_stats, and the pacing by Broadcaster.give_pacing_stats.
+"""
+
+import socket
+import threading
+import time
+from collections import deque
+
+from .scheduler import DeadlineScheduler
+
+
+class Subscriber(object):
+    """
+    A session receiving the broadcast (or its own stream of frames, see RTServer_Session),
+    through a bounded queue of packets emptied by its own sending thread.
+    """
+
+    def __init__(self, session, queue_limit, policy):
+        self.session = session
+        self.conn = session.conn
+        self.queue_limit = max(1, queue_limit)
+        self.policy = policy
+        try:
+            self.name = '{}:{}'.format(*self.conn.s.getpeername()[:2])
+        except (OSError, AttributeError):
+            self.name = str(id(session))
+
+        self.queue = deque()  # (time queued, packet)
+        self.closed = False
+        self.closing = False  # no more packets are queued, the thread ends once the queued ones are sent
+        self.sent, self.dropped, self.max_queued = 0, 0, 0
+        self.lag, self.max_lag = 0.0, 0.0  # seconds between queueing and sending a frame
+        self._condition = threading.Condition()
+
+        self._thread = threading.Thread(target=self._send_queued, name='Subscriber ' + self.name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def offer(self, packet):
+        """Queue a packet to be sent. Returns False if the subscriber is closed (or is now, being too slow)."""
+        with self._condition:
+            if self.closed or self.closing:
+                return False
+            if len(self.queue) >= self.queue_limit:
+                if self.policy == 'disconnect':
+                    print('Disconnecting the slow broadcast subscriber', self.name)
+                    self._close(disconnect=True)
+                    return False
+                self.queue.popleft()
+                self.dropped += 1
+            self.queue.append((time.perf_counter(), packet))
+            self.max_queued = max(self.max_queued, len(self.queue))
+            self._condition.notify()
+        return True
+
+    def close(self, timeout=None):
+        """Stop sending, the queued packets are discarded.
+        If timeout is given, wait at most timeout seconds for a packet being sent."""
+        with self._condition:
+            self._close(disconnect=False)
+        if timeout is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+
+    def close_after_queued(self):
+        """Stop sending once the packets already queued are sent."""
+        with self._condition:
+            self.closing = True
+            self._condition.notify()
+
+    def _close(self, disconnect):
+        """Mark closed (holding the condition). If disconnect, the connection is shut down,
+        which also ends a send blocked on a client that stopped reading."""
+        self.closed = True
+        self.queue.clear()
+        self._condition.notify()
+        if disconnect:
+            try:  # the handler of the connection then receives nothing, and closes the session
+                self.conn.s.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _send_queued(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self.closed or self.closing or len(self.queue) > 0)
+                if self.closing and len(self.queue) == 0:
+                    self.closed = True
+                if self.closed:
+                    break
+                queued, packet = self.queue.popleft()
+            try:
+                self.conn.send_verbatim(packet)
+            except OSError:
+                self.close()
+                break
+            self.lag = time.perf_counter() - queued
+            self.max_lag = max(self.max_lag, self.lag)
+            self.sent += 1
+
+    def give_stats(self):
+        """Return the counters of this subscriber. The lag (in milliseconds) is the wait of the oldest queued frame,
+        or if none are queued, of the last frame sent."""
+        with self._condition:
+            lag = time.perf_counter() - self.queue[0][0] if len(self.queue) > 0 else self.lag
+            return {'queued': len(self.queue), 'max_queued': self.max_queued, 'sent': self.sent,
+                    'dropped': self.dropped, 'lag_ms': lag * 1000, 'max_lag_ms': max(lag, self.max_lag) * 1000}
+
+
+class Broadcaster(object):
+    """One paced stream of the frames of a RTServer_Static, queued for every subscribed session."""
+
+    POLICIES = ('drop', 'disconnect')
+
+    def __init__(self, source, loop=True, queue_limit=50, policy='drop'):
+        """
+        :param source: the RTServer_Static whose frames are streamed
+        :param loop: whether to restart at the beginning of the file at its end (else the subscribers get EOF)
+        :param queue_limit: number of frames queued per subscriber before the policy applies
+        :param policy: 'drop' to drop a slow subscriber's oldest frames, 'disconnect' to disconnect it
+        """
+        if policy not in self.__class__.POLICIES:
+            raise ValueError('Unknown slow subscriber policy {}, choose from {}'
+                             .format(policy, ', '.join(self.__class__.POLICIES)))
+        self.source = source
+        self.loop = loop
+        self.queue_limit = queue_limit
+        self.policy = policy
+
+        self.subscribers = {}  # session: Subscriber
+        self.cursor = 0  # index of the next frame to stream
+        self.frames_paced = 0
+        self._lock = threading.Lock()
+        self.stream = None  # the ScheduledStream pacing the frames while there are subscribers
+        self._generation = 0  # number of the current stream, a tick of an earlier one does nothing
+        self._restart = False
+        self._starting_time, self._starting_stamp = None, 0
+
+    def subscribe(self, session):
+        """Start sending the broadcast frames to the session, starting the paced stream if it is not running."""
+        with self._lock:
+            if session not in self.subscribers:
+                self.subscribers[session] = Subscriber(session, self.queue_limit, self.policy)
+            if self.stream is None:
+                self._generation += 1
+                self._restart = True
+                self.stream = DeadlineScheduler.shared().add_stream(self.source.static_data.frame_time/1000000,
+                                                                    self._pace_frame, args=(self._generation,))
+
+    def unsubscribe(self, session):
+        """Stop sending to the session, and the paced stream if there are no subscribers left."""
+        stream = None
+        with self._lock:
+            subscriber = self.subscribers.pop(session, None)
+            if len(self.subscribers) == 0:
+                stream, self.stream = self.stream, None
+        if subscriber is not None:
+            subscriber.close()
+        if stream is not None:
+            stream.cancel()
+
+    def change_source(self, source):
+        """Broadcast another data file, from its start, at its frame time."""
+        with self._lock:
+            self.source = source
+            self.cursor = 0
+            self._restart = True
+            if self.stream is not None:
+                self.stream.change_interval(source.static_data.frame_time/1000000)
+
+    def give_stats(self):
+        """Return a dict of the counters of each subscriber (by client address)."""
+        with self._lock:
+            subscribers = list(self.subscribers.values())
+        return {s.name: s.give_stats() for s in subscribers}
+
+    def give_pacing_stats(self):
+        """Return the tick counters, jitter and overruns of the paced stream (see ScheduledStream.give_stats),
+        or an empty dict if it is not running."""
+        stream = self.stream
+        return {} if stream is None else stream.give_stats()
+
+    def _pace_frame(self, deadline, generation):
+        """
+        A tick of the paced stream: give the frame due at the deadline (a perf_counter time) once,
+        by the timestamps (skipping late frames), and queue it for every subscriber.
+        Returns False, ending the stream, when there are no subscribers left or at the end of a file that does not loop.
+        """
+        with self._lock:
+            if generation != self._generation or len(self.subscribers) == 0:
+                if generation == self._generation:
+                    self.stream = None
+                return False
+            source, data = self.source, self.source.static_data
+            if self._restart:  # (re)start the clock at the cursor
+                self._restart = False
+                self._starting_stamp = data.give_frame_timestamp(max(0, min(self.cursor, data.max_num_frames - 1))) \
+                    if data.max_num_frames > 0 else 0
+                self._starting_time = deadline
+            index = data.frame_index_at_time(self._starting_stamp + (deadline - self._starting_time) * 1000000)
+
+            ended = []
+            if index >= data.max_num_frames:
+                if self.loop is False or data.max_num_frames == 0:  # an empty file cannot loop
+                    # the subscribers get EOF and are closed, a later subscribe starts a new stream
+                    for session, subscriber in self.subscribers.items():
+                        subscriber.offer(source.eof_packet)
+                        session.status = 'EOF'
+                    ended = list(self.subscribers.values())
+                    self.subscribers.clear()
+                    self.stream = None
+                else:  # restart at the beginning of the file
+                    self._starting_time, self._starting_stamp, index = deadline, data.give_frame_timestamp(0), 0
+            subscribers = list(self.subscribers.items())
+
+        if len(ended) > 0:
+            for subscriber in ended:
+                subscriber.close_after_queued()
+            return False
+
+        try:
+            packet = source.give_packet(index)  # read and packed once for all subscribers
+        except ValueError:  # the file was closed, as the source changed meanwhile
+            return True
+        timestamp = data.give_frame_timestamp(index)
+        for session, subscriber in subscribers:
+            if subscriber.offer(packet):
+                session.cursor, session.latest_timestamp = index + 1, timestamp
+        with self._lock:
+            if not self._restart:  # else change_source set the cursor for the new source
+                self.cursor = index + 1
+            self.frames_paced += 1
+        return True
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Kristy'
+
+"""
+Execution of the commands received on one client connection of the static server.
+Each connection has one CommandExecutor: a worker thread running the commands in the order they were received,
+fed by a bounded queue. When the queue is full, submitting waits, so the connection's handler stops reading
+and a client sending commands faster than they run is held back by TCP (backpressure).
+Nothing is kept of a command once it has run, apart from the counters given by give_stats, which also measure
+the cost of dispatching a command (submitting it) and its wait in the queue.
+"""
+
+import queue
+import sys
+import threading
+import time
+import traceback
+
+
+class CommandExecutor(object):
+    """Run the commands of one connection in order on a single worker thread, with at most queue_limit waiting."""
+
+    DEFAULT_QUEUE_LIMIT = 16
+
+    def __init__(self, name='CommandExecutor', queue_limit=DEFAULT_QUEUE_LIMIT):
+        """
+        :param name: name of the worker thread
+        :param queue_limit: number of commands waiting to run before submit waits
+        """
+        self._queue = queue.Queue(maxsize=max(1, queue_limit))
+        self._stats_lock = threading.Lock()
+        self.submitted, self.completed, self.failed = 0, 0, 0
+        self.dispatch_time, self.max_dispatch_time = 0.0, 0.0  # seconds spent in submit
+        self.wait_time, self.max_wait_time = 0.0, 0.0  # seconds between submitting and starting a command
+        self.run_time = 0.0
+
+        self._worker = threading.Thread(target=self._run_queued, name=name)
+        self._worker.daemon = True
+        self._worker.start()
+
+    def submit(self, fn, args=(), on_success=None, on_error=None):
+        """
+        Queue fn(*args) to run after the commands already submitted, waiting while the queue is full.
+        :param on_success: called without arguments after fn returns
+        :param on_error: called with the exception if fn raises (after the traceback is printed)
+        """
+        start = time.perf_counter()
+        self._queue.put((start, fn, args, on_success, on_error))
+        cost = time.perf_counter() - start
+        with self._stats_lock:
+            self.submitted += 1
+            self.dispatch_time += cost
+            self.max_dispatch_time = max(self.max_dispatch_time, cost)
+
+    def close(self, timeout=1.0):
+        """Stop the worker once the queued commands have run, waiting at most timeout seconds for it."""
+        self._queue.put(None)
+        if self._worker is not threading.current_thread():
+            self._worker.join(timeout=timeout)
+
+    def _run_queued(self):
+        """Worker thread: run each queued command in turn, until close."""
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            submitted, fn, args, on_success, on_error = item
+            del item  # release the command as soon as it has run
+            started = time.perf_counter()
+            try:
+                fn(*args)
+            except Exception as e:
+                print("Problem: ", e)
+                print(traceback.format_exc(), file=sys.stderr)
+                failed = True
+                if on_error is not None:
+                    on_error(e)
+            else:
+                failed = False
+                if on_success is not None:
+                    on_success()
+            finished = time.perf_counter()
+            del fn, args, on_success, on_error
+
+            with self._stats_lock:
+                self.completed += 1
+                self.failed += failed
+                self.wait_time += started - submitted
+                self.max_wait_time = max(self.max_wait_time, started - submitted)
+                self.run_time += finished - started
+
+    def give_stats(self):
+        """Return the command counters, and the mean and max dispatch and queue wait times in microseconds."""
+        with self._stats_lock:
+            return {'submitted': self.submitted, 'completed': self.completed, 'failed': self.failed,
+                    'queued': self._queue.qsize(),
+                    'mean_dispatch_us': self.dispatch_time / max(1, self.submitted) * 1000000,
+                    'max_dispatch_us': self.max_dispatch_time * 1000000,
+                    'mean_wait_us': self.wait_time / max(1, self.completed) * 1000000,
+                    'max_wait_us': self.max_wait_time * 1000000,
+                    'mean_run_us': self.run_time / max(1, self.completed) * 1000000}
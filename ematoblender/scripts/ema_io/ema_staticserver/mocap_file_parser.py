@@ -9,10 +9,15 @@ Responses are encoded according to the RTC3D protocol.
 
 import xml.etree.ElementTree as ET
 import math
-import struct
 import os
 import json
+import bisect
+import io
+import numpy
 from ..rtc3d_parser import DataFrame, Component6D, CoilBuilder6D
+from ...ema_shared.general_maths import euler_to_quaternion_arrays
+from .recording_cache import RecordingCache
+from .multimodal_index import MultimodalIndex
 
 xml_skeleton_location = os.path.abspath(os.path.normpath(os.path.dirname(__file__) + os.sep +'parameter_skeleton.xml'))
 
@@ -38,7 +43,7 @@ class Mapping():
             self.quat_inds = [None]
             if mapping_as_list is not None:
                 _, pi, theta, d, self.xind, self.yind, self.zind = mapping_as_list
-            self.euler_xyz = [theta, 0,  pi]
+            self.euler_xyz = [theta, None, pi]  # no roll
 
         if angle_type == 'EULER':
             self.quat_inds = [None]
@@ -65,25 +70,14 @@ class Mapping():
         """Convert the angle information in the mapping into Quaternions
         Return q0, qx, qy, qz.
         """
-        print('converting {} to quats'.format(measurementlist))
         if all(x is not None for x in self.quat_inds) and all([measurementlist[x] is not None for x in self.quat_inds]):
-            print(self.make_float_or_zero([measurementlist[i] for i in self.quat_inds]))
             return self.make_float_or_zero([measurementlist[i] for i in self.quat_inds])
 
-        elif all([measurementlist[x] is not None for x in self.euler_xyz]):
-            x, y, z = [measurementlist[x] is not None for x in self.euler_xyz]
+        elif all([x is None or measurementlist[x] is not None for x in self.euler_xyz]):
+            # an angle without a channel (eg the roll of an elevation mapping) is 0
+            x, y, z = self.make_float_or_zero([measurementlist[i] if i is not None else 0 for i in self.euler_xyz])
             # TODO: This presumes the angle application order XYZ # TODO: Check source
-            # TODO: Source is http://www.euclideanspace.com/maths/geometry/rotations/conversions/eulerToQuaternion/
-
-            c1, c2, c3 = [math.cos(math.radians(i)/2) for i in [z, y, x]]  # z is yaw, y is pitch, x is roll
-            s1, s2, s3 = [math.sin(math.radians(i)/2) for i in [z, y, x]]  # z is yaw, y is pitch, x is roll
-
-            # convert euler rotation angles to quaternion
-            q0 = c1*c2*c3 - s1*s2*s3
-            qx = s1*s2*c3 + c1*c2*s3
-            qy = s1*c2*c3 + c1*s2*s3
-            qz = c1*s2*c3 - s1*c2*s3
-            return self.make_float_or_zero((q0, qx, qy, qz))
+            return euler_to_quaternion_arrays(x, y, z).tolist()
         else:
             raise ValueError('Cannot convert None values to quaternions')
 
@@ -93,6 +87,36 @@ class Mapping():
         return [measurementlist[i] if i is not None else 0 for i in
                 [self.q0ind, self.qxind, self.qyind, self.qzind, self.xind, self.yind, self.zind]]
 
+    @staticmethod
+    def padded_columns(indices, nchannels):
+        """
+        Return the column of each index in measurements of nchannels channels padded with a column of zeros,
+        as convert_to_wave_array uses them. Negative indices count from the end like list indices,
+        None (not measured) and indices out of range give the column of zeros.
+        """
+        columns = [i + nchannels if i is not None and i < 0 else i for i in indices]
+        return [i if i is not None and 0 <= i < nchannels else nchannels for i in columns]
+
+    def convert_to_wave_array(self, measurements):
+        """
+        Batch convert_to_quat and give_in_wave_order: convert a (..., channels) array of measurements
+        (eg frames, coils, channels) to a (..., 7) float64 array in WAVE order (q0, qx, qy, qz, x, y, z).
+        Quaternion mappings are one column permutation, Euler and elevation angles are converted in one call.
+        """
+        measurements = numpy.asarray(measurements, dtype=numpy.float64)
+        nchannels = measurements.shape[-1]
+        padded = numpy.concatenate([measurements, numpy.zeros(measurements.shape[:-1] + (1,))],
+                                   axis=-1)  # the last column is the 0 for unmeasured fields
+        locs = self.padded_columns([self.xind, self.yind, self.zind], nchannels)
+        if all(i is not None for i in self.quat_inds):
+            return padded[..., self.padded_columns(self.quat_inds, nchannels) + locs]
+
+        wave = numpy.empty(measurements.shape[:-1] + (7,))
+        wave[..., :4] = euler_to_quaternion_arrays(*[padded[..., i]
+                                                     for i in self.padded_columns(self.euler_xyz, nchannels)])
+        wave[..., 4:] = padded[..., locs]
+        return wave
+
     @staticmethod
     def channel_label_to_attrs(label):
         """Semantically parse label names."""
@@ -185,18 +209,24 @@ class Mapping():
 
 class MakeMocapParser():
     """Factory Class to make parser objects based on the file extension."""
-    def factory(filename):
-        """Open a  filename (type read from extension), create parser class."""
+    def factory(filename, use_cache=True):
+        """Open a  filename (type read from extension), create parser class.
+        If use_cache, the frames are given from the file's recording cache (see recording_cache.py),
+        which is made now if there is no up to date one."""
         extension = filename.lower().split('.')[-1]
         if extension == 'bvh':
-            return BVHParser(filename)
-        if extension == 'tsv':
-            return TSVParser(filename)
-        if extension == 'pos':
-            return POSParser(filename)
-        if extension == 'json':
-            return JSONParser(filename)
-        raise ValueError("Bad mocap file type: {}".format(extension))
+            parser = BVHParser(filename)
+        elif extension == 'tsv':
+            parser = TSVParser(filename)
+        elif extension == 'pos':
+            parser = POSParser(filename)
+        elif extension == 'json':
+            parser = JSONParser(filename)
+        else:
+            raise ValueError("Bad mocap file type: {}".format(extension))
+        if use_cache:
+            parser.use_recording_cache()
+        return parser
     factory = staticmethod(factory)
 
 
@@ -216,6 +246,8 @@ class MocapParent(object):
     - pre_motion_position (position where reading starts, bytes from start, after this can use readline() to get frames)
     - max_num_frames (for static file, the number of frames that can  be read before looping)
     - latest_timestamp (the most recently read timestamp, in microseconds)
+    - frame_offsets (file position of each motion frame, for seeking)
+    - frame_timestamps (timestamp of each motion frame in microseconds, sorted, for seeking by time)
 
     SAMPLING RATE ATTRIBUTES
     - frame_time (number of microseconds per frame)
@@ -232,6 +264,7 @@ class MocapParent(object):
 
     ACTUAL LOCATION DATA
     - component (component attribute as defined in rtc3d parser)
+    - recording (RecordingCache with the arrays of all frames, if used, else None)
 
     METHODS COMMON TO ALL MOCAP FORMATS:
     - read_header (process the file header, populating attributes with the info)
@@ -239,6 +272,11 @@ class MocapParent(object):
     - update_xml_initial (update certain static xml attributes from the object's attributes)
     - update_xml_stats (update XML to reflect the current state of the file reading)
     - reset_motion_section (set file to position at start of the motion section)
+    - seek_frame (set file to position at the start of a given frame)
+    - frame_index_at_time (find the frame showing a given timestamp, by bisection)
+    - give_motion_frame_at (give_motion_frame for a given frame index or timestamp)
+    - use_recording_cache (give the frames from the arrays of a RecordingCache, making it if needed)
+    - load_recording (give the frames from one load_motion_array held in memory, without a cache file)
     - search_for_multimodal (scan the file's directory for likely audio/video candidates)
     - order_measurements_as_wave (yield the mapping between the dimensions given per coil and the order
         they should be in if they were streamed from the WAVE)
@@ -251,6 +289,9 @@ class MocapParent(object):
     """
 
     file_read_mode = 'r'
+    INDEX_CACHE_SUFFIX = '.index.npz'  # sidecar file holding the line index of a text mocap file
+    MOTION_CHUNK_BYTES = 1 << 18  # text converted per call when reading all the motion lines
+    DEFAULT_FRAME_TIME = 10000.0  # microseconds (the WAVE's 100 Hz), if a file has too few frames to measure it
 
     def __init__(self, filename):
         print('initialising a mocap parent')
@@ -269,6 +310,8 @@ class MocapParent(object):
         self.pre_motion_position = NotImplemented
         self.max_num_frames = NotImplemented
         self.latest_timestamp = NotImplemented
+        self.frame_offsets = NotImplemented
+        self.frame_timestamps = NotImplemented
 
         # populated in subclasses from the header/pre-reading
         self.frame_time = NotImplemented
@@ -285,6 +328,8 @@ class MocapParent(object):
         self.mappings = NotImplemented
 
         self.component = NotImplemented  # an initial component attribute
+        self.recording = None  # RecordingCache, if the frames are given from it
+        self.bulk_load_tried = False  # whether load_motion_array was tried for the frames (see load_recording)
 
         #  process the file header
         self.read_header()
@@ -313,6 +358,71 @@ class MocapParent(object):
             raise TypeError
         return timestamp
 
+    @staticmethod
+    def scan_line_starts(data, start=0, chunksize=1 << 24):
+        """
+        Return an int64 array of the positions of the non-empty lines from position start,
+        found by counting the newlines of the memory-mapped uint8 file data in binary chunks.
+        """
+        newlines = [numpy.flatnonzero(data[i:i+chunksize] == ord('\n')) + i
+                    for i in range(start, len(data), chunksize)]
+        ends = numpy.concatenate(newlines + [numpy.array([len(data)])]).astype(numpy.int64)
+        starts = numpy.concatenate([[start], ends[:-1] + 1]).astype(numpy.int64)
+        # a line is empty if it has no characters but a carriage return
+        lengths = ends - starts
+        lengths[lengths > 0] -= data[ends[lengths > 0] - 1] == ord('\r')
+        return starts[lengths > 0]
+
+    @staticmethod
+    def parse_first_fields(data, starts, width=64, batch=65536):
+        """Return a float64 array of the numbers in the first (tab separated) field of the lines at starts,
+        converted in batches of lines at once rather than line by line."""
+        values = numpy.empty(len(starts))
+        columns = numpy.arange(width)
+        for i in range(0, len(starts), batch):
+            window = data[numpy.minimum(starts[i:i+batch, None] + columns, len(data) - 1)]
+            ends = numpy.isin(window, (ord('\t'), ord('\n'), ord('\r')))
+            if not ends.any(axis=1).all():
+                raise ValueError('First field of a line longer than {} characters'.format(width))
+            window[columns >= ends.argmax(axis=1)[:, None]] = 0  # null bytes end the strings
+            values[i:i+batch] = window.view('S{}'.format(width)).ravel().astype(numpy.float64)
+        return values
+
+    def build_line_index(self, first_fields=False):
+        """
+        Index the motion lines of a text file, from the sidecar cache (file name + INDEX_CACHE_SUFFIX)
+        if it was made for the current version of the file, else by scanning the file and writing the cache.
+        Returns the array of line positions, and the array of the numbers in the first field if first_fields.
+        """
+        stat = os.stat(self.file_name)
+        cache_name = self.file_name + self.__class__.INDEX_CACHE_SUFFIX
+        try:
+            with numpy.load(cache_name) as cache:
+                if (int(cache['source_size']), int(cache['source_mtime_ns']), int(cache['start'])) == \
+                        (stat.st_size, stat.st_mtime_ns, self.pre_motion_position) and \
+                        (not first_fields or 'first_fields' in cache):
+                    return cache['starts'], cache['first_fields'] if first_fields else None
+        except (OSError, KeyError, ValueError):
+            pass  # no cache (or an unreadable one), scan the file
+
+        data = numpy.memmap(self.file_name, dtype=numpy.uint8, mode='r') if stat.st_size > 0 \
+            else numpy.zeros(0, dtype=numpy.uint8)
+        starts = self.scan_line_starts(data, self.pre_motion_position)
+        fields = self.parse_first_fields(data, starts) if first_fields else None
+        del data
+
+        arrays = {'starts': starts, 'source_size': stat.st_size, 'source_mtime_ns': stat.st_mtime_ns,
+                  'start': self.pre_motion_position}
+        if first_fields:
+            arrays['first_fields'] = fields
+        try:
+            with open(cache_name + '.tmp', 'wb') as f:
+                numpy.savez(f, **arrays)
+            os.replace(cache_name + '.tmp', cache_name)
+        except OSError as e:
+            print('Could not save the index of {}: {}'.format(self.file_name, e))
+        return starts, fields
+
     def __str__(self):
         """String rep of the mocap file"""
         return "Mocap file, generic type. This should never have an instance."
@@ -361,44 +471,143 @@ class MocapParent(object):
         self.file.seek(self.pre_motion_position, 0)
         self.motion_lines_read = 0
 
-    def search_for_multimodal(self):
-        """
-        Search based on filename for corresponding WAV or ultrasound videos.
-        :return:  abspath to both, None if not found.
-        """
-        wave_name, video_name = None, None
-
-        audtypes=['.wav', '.ogg', 'mp3']
-        vidtypes = ['.avi', '.mpeg', '.mp4', ]
+    # random access to the motion frames, using the index of frame offsets/timestamps made when reading the header
+    def seek_frame(self, index):
+        """Set the file so that give_motion_frame returns frame number index next (or EOF if past the last frame)."""
+        self.motion_lines_read = index
+        if 0 <= index < self.max_num_frames:
+            self.file.seek(int(self.frame_offsets[index]), 0)
+        else:
+            self.file.seek(0, 2)
 
-        # returns absolute path to audio file
-        dirname, tail = os.path.split(self.file_name)
-        streamfilename, streamext = os.path.splitext(tail)
+    def give_frame_timestamp(self, index):
+        """Return the timestamp of frame number index in microseconds."""
+        return int(self.frame_timestamps[index])
 
-        # search in same directory, then sister directory
-        current_search_dir = os.path.normpath(dirname+os.path.sep)
-        sister_search_dir = os.path.normpath(dirname+os.path.sep+'..'+os.path.sep)
+    def frame_index_at_time(self, timestamp):
+        """
+        Return the index of the frame to show at the timestamp (in microseconds),
+        that is the last frame starting at or before it, or max_num_frames if it is after the end of the last frame.
+        Irregular timestamps (eg skipped frames) are handled by bisection of self.frame_timestamps.
+        """
+        if self.max_num_frames == 0 or timestamp >= self.frame_timestamps[-1] + self.frame_time:
+            return self.max_num_frames
+        return max(0, bisect.bisect_right(self.frame_timestamps, timestamp) - 1)
+
+    def give_motion_frame_at(self, index=None, timestamp=None):
+        """Return give_motion_frame for frame number index, or for the frame at the timestamp (in microseconds).
+        Reading continues from this frame afterwards."""
+        if index is None:
+            index = self.frame_index_at_time(timestamp)
+        self.seek_frame(index)
+        return self.give_motion_frame()
+
+    # bulk loading of all the motion frames
+    def load_motion_array(self):
+        """
+        Read the whole motion section at once.
+        :returns: (frames,) int64 timestamps in microseconds, (frames, coils, 7) float32 array in WAVE order
+        (q0, qx, qy, qz, x, y, z) and (frames, coils) uint32 error values, as give_motion_frame would give them.
+        """
+        raise NotImplementedError
 
-        wavefound, vidfound = False, False
+    def iter_motion_arrays(self):
+        """Iterate over (timestamp, (coils, 7) WAVE order array) for every motion frame, from one load_motion_array."""
+        timestamps, wave, errors = self.load_motion_array()
+        return zip(timestamps.tolist(), wave)
 
-        for search_dir in [current_search_dir, sister_search_dir]:  # search in current folder first
-            for root, dirs, files in os.walk(search_dir):
-                for file in files:
-                    fn, ext = os.path.splitext(file)
-                    if fn.startswith(streamfilename):
-                        print('candidate found!', os.path.join(root, file))
-                        if ext in audtypes:
-                            wave_name = os.path.join(root, file)
-                            wavefound = True
-                        if ext in vidtypes:
-                            video_name = os.path.join(root, file)
-                            vidfound = True
+    def read_motion_values(self):
+        """
+        Return the numbers of the motion lines of a text file as a (lines, fields) float64 array,
+        converting the text a chunk of whole lines (MOTION_CHUNK_BYTES) at a time. Empty fields are 0,
+        as in CoilBuilder.to_floats. Raises ValueError if a field is not a number or the lines have
+        different numbers of fields.
+        """
+        with open(self.file_name, 'rb') as f:
+            f.seek(self.pre_motion_position, 0)
+            raw = f.read()
+        delimiter = '\t' if b'\t' in raw else None
+
+        # each conversion holds the GIL, in chunks other threads (eg a streaming one) are not held up long
+        chunks, start = [], 0
+        while start < len(raw):
+            stop = raw.find(b'\n', start + self.__class__.MOTION_CHUNK_BYTES) + 1 or len(raw)
+            chunk = raw[start:stop].replace(b'\r', b'')
+            if not chunk.isspace():
+                chunks.append(self.text_to_values(chunk, delimiter))
+            start = stop
+        if len(chunks) == 0:
+            return numpy.zeros((0, 0))
+        return numpy.concatenate(chunks)
 
-                        # break once both are populated
-                        if wavefound and vidfound:
-                            return wave_name, video_name
+    @staticmethod
+    def text_to_values(text, delimiter):
+        """Convert the bytes of whole lines of numbers separated by delimiter to a (lines, fields) float64 array."""
+        if delimiter is not None:
+            # fill the empty fields, a run of them needs a second pass as the replaced tabs do not overlap
+            text = text.replace(b'\t\t', b'\t0\t').replace(b'\t\t', b'\t0\t')
+            if b'\n\t' in text:
+                text = text.replace(b'\n\t', b'\n0\t')
+            if b'\t\n' in text:
+                text = text.replace(b'\t\n', b'\t0\n')
+            if text.startswith(b'\t'):
+                text = b'0' + text
+            if text.endswith(b'\t'):
+                text += b'0'
+        return numpy.loadtxt(io.BytesIO(text), dtype=numpy.float64, delimiter=delimiter, comments=None, ndmin=2)
+
+    # frames from the recording cache
+    def use_recording_cache(self):
+        """Give the frames from the recording cache of the file, making (and saving) the cache first if needed."""
+        if self.recording is not None:
+            return
+        recording = RecordingCache.load(self.file_name)
+        if recording is None:
+            print('Caching the recording', self.file_name)
+            try:
+                recording = RecordingCache.from_parser(self)
+            except ValueError as e:
+                print('Cannot cache the recording:', e)
+                return
+            recording.save(self.file_name)
+        self.recording = recording
+
+    def load_recording(self):
+        """
+        Give the frames from the arrays of one load_motion_array, held in memory as a RecordingCache
+        that is not saved (eg with use_cache False, or if the cache could not be made).
+        Tried once, if the file cannot be loaded in bulk give_motion_frame parses each motion line.
+        """
+        if self.recording is not None or self.bulk_load_tried:
+            return
+        self.bulk_load_tried = True
+        try:
+            timestamps, wave, errors = self.load_motion_array()
+        except (NotImplementedError, ValueError) as e:
+            print('Reading the motion lines of {} one by one: {}'.format(self.file_name, e))
+            return
+        self.recording = RecordingCache.from_wave_array(timestamps, wave, errors, self.marker_names, self.frame_time)
+
+    def give_cached_motion_frame(self):
+        """give_motion_frame from self.recording, no text is parsed."""
+        n = self.motion_lines_read
+        if 0 <= n < len(self.recording):
+            self.latest_timestamp = int(self.recording.timestamps[n])
+            self.component.timestamp = self.latest_timestamp
+            self.component.set_array(self.recording.give_coil_array(n))
+            self.motion_lines_read += 1
+            return 3, DataFrame(components=[self.component]).pack_all(), self.latest_timestamp
+        else:
+            print("All the frames have been read")
+            return 4, "No more frames left in mocap file"
 
-        return wave_name, video_name
+    def search_for_multimodal(self):
+        """
+        Search based on filename for corresponding WAV or ultrasound videos,
+        in the directory listings shared by all parsers (see multimodal_index.py).
+        :return:  abspath to both, None if not found.
+        """
+        return MultimodalIndex.find(self.file_name)
 
     def give_all_motion_frames(self):
         """Return all datafiles from start to end of file.
@@ -420,6 +629,8 @@ class JSONParser(MocapParent):
     Class to parse pre-processed JSON files (of the Trier dataset) into DataFrame objects.
     Do not yet incorporate correspondences.
     Must be able to be reconstructed into JSON format for the C++ server.
+    The JSON lists are converted once to arrays (euler_angles, positions and wave, over frames and coils),
+    a frame is then an index into wave.
     """
 
     # http://stackoverflow.com/questions/4836710/does-python-have-a-built-in-function-for-string-natural-sort
@@ -430,44 +641,69 @@ class JSONParser(MocapParent):
         return sorted(l, key = alphanum_key)
 
     def read_header(self):
-        """Read in the JSON file"""
-        print('Reading in JSON file, this may take a while')
-        self.json = json.loads(self.file.read())
-        print(self.json.keys())
+        """Read in the JSON file, or just the header information if there is an up to date recording cache."""
+        #setup a mapping between EX EY EZ X Y Z to wave
+        self.mappings = Mapping(mapping_as_list=[0, 1, 2, 3, 4, 5], angle_type='EULER')
+        self.min_dimensions = 6
         self.motion_lines_read = 0
 
+        recording = RecordingCache.load(self.file_name)
+        if recording is not None:  # skip parsing the JSON
+            self.recording = recording
+            self.marker_names = recording.marker_names
+            self.frame_timestamps = recording.timestamps
+            self.max_num_frames = len(recording)
+            self.frame_time = recording.frame_time
+            self.min_channels = len(self.marker_names)
+            self.component = Component6D(fileparser=self)
+            return
+
+        print('Reading in JSON file, this may take a while')
+        parsed = json.loads(self.file.read())
+        print(parsed.keys())
+
         # use a natural sorting of the marker names
-        self.marker_names = self.natural_sort(self.json["channels"].keys())
-        timestamps = self.json["timestamps"]
+        self.marker_names = self.natural_sort(parsed["channels"].keys())
+        timestamps = parsed["timestamps"]
 
         self.max_num_frames = len(timestamps)
+        self.frame_timestamps = numpy.floor(numpy.asarray(timestamps, dtype=numpy.float64) * 1000000)\
+            .astype(numpy.int64)
 
         # compute frame time in microseconds
-        self.frame_time = 1000000 / float(self.json["samplingFrequency"])
+        self.frame_time = 1000000 / float(parsed["samplingFrequency"])
+
+        # convert the lists of each channel to (frames, 3) arrays, dropping the lists as we go
+        self.euler_angles = numpy.empty((self.max_num_frames, len(self.marker_names), 3))
+        self.positions = numpy.empty((self.max_num_frames, len(self.marker_names), 3))
+        for i, ch in enumerate(self.marker_names):
+            channel = parsed["channels"].pop(ch)
+            self.euler_angles[:, i] = numpy.asarray(channel['eulerAngles'], dtype=numpy.float64).reshape(-1, 3)
+            self.positions[:, i] = numpy.asarray(channel['position'], dtype=numpy.float64).reshape(-1, 3)
+        del parsed
+
+        # all frames in WAVE order (q0, qx, qy, qz, x, y, z), the Euler angles converted in one call
+        self.wave = self.mappings.convert_to_wave_array(numpy.concatenate([self.euler_angles, self.positions], axis=-1))\
+            .astype(numpy.float32)
 
-        #setup a mapping between EX EY EZ X Y Z to wave
-        self.mappings = Mapping(mapping_as_list=[0, 1, 2, 3, 4, 5], angle_type='EULER')
         self.min_channels = len(self.marker_names)
-        self.min_dimensions = 6
         self.component = Component6D(fileparser=self)
 
+    def load_motion_array(self):
+        """All the frames at once, see MocapParent.load_motion_array."""
+        if self.recording is not None:  # the JSON was not parsed
+            return self.recording.timestamps, self.recording.give_wave_array(), self.recording.errors
+        return self.frame_timestamps, self.wave, numpy.zeros(self.wave.shape[:2], dtype=numpy.uint32)
+
     def give_motion_frame(self):
         """ Return angle, position and timestamp information for a file and status code. """
+        if self.recording is not None:
+            return self.give_cached_motion_frame()
         if self.motion_lines_read < self.max_num_frames:
             n = self.motion_lines_read
-            measurements_by_coil = []
-            for ch in self.marker_names:  # TODO: Fill from reading header
-                angles = self.json["channels"][ch]['eulerAngles'][n*3:n*3+3]
-                position = self.json["channels"][ch]["position"][n*3:n*3+3]
-                measurements_by_coil.append(angles+position)
-            timestamp = MocapParent.timestamp_to_microsecs(self.json["timestamps"][n])
-            print(measurements_by_coil)
-
-            self.component.coils = [CoilBuilder6D.build_from_mapping(self.mappings, onecoil)
-                                    for onecoil in measurements_by_coil]
-
-            self.component.timestamp = timestamp
-            self.latest_timestamp = timestamp
+            self.component.set_array(CoilBuilder6D.from_values(self.wave[n], 0))
+            self.latest_timestamp = int(self.frame_timestamps[n])
+            self.component.timestamp = self.latest_timestamp
 
             self.motion_lines_read += 1
             return 3, DataFrame(components=[self.component]).pack_all(), self.latest_timestamp
@@ -479,6 +715,10 @@ class JSONParser(MocapParent):
     def reset_motion_section(self):
         self.motion_lines_read = 0
 
+    def seek_frame(self, index):
+        """The frames are held in memory, so only the frame counter is set."""
+        self.motion_lines_read = index
+
 class BVHParser(MocapParent):
     """
     Class to parse .bvh motion capture files (Biovision Hierarchical Data).
@@ -535,12 +775,36 @@ class BVHParser(MocapParent):
         # now up to motion frames, to be handled in another function
         self.pre_motion_position = self.file.tell()
 
+        # index the motion lines, the frames are regularly spaced
+        self.frame_offsets, _ = self.build_line_index()
+        self.max_num_frames = len(self.frame_offsets)
+        self.frame_timestamps = [int(i * self.frame_time) for i in range(self.max_num_frames)]
+        self.file.seek(self.pre_motion_position, 0)
+
+    def load_motion_array(self):
+        """Read the whole motion section at once, see MocapParent.load_motion_array."""
+        values = self.read_motion_values()
+        if len(values) == 0:  # no motion lines, the fields are those of the header
+            values = numpy.zeros((0, sum(len(channels) for channels in self.marker_channels)))
+        # the channels of each coil follow each other, the mapping (of the first coil) is applied to each coil
+        wave, start = [], 0
+        for channels in self.marker_channels:
+            wave.append(self.mappings.convert_to_wave_array(values[:, start:start+len(channels)]))
+            start += len(channels)
+        wave = numpy.stack(wave, axis=1).astype(numpy.float32)
+        timestamps = numpy.array(self.frame_timestamps[:len(values)], dtype=numpy.int64)
+        return timestamps, wave, numpy.zeros(wave.shape[:2], dtype=numpy.uint32)
+
     def give_motion_frame(self):
         """According to the RTC3D protocol, return the error code and the bytestring with the packed dataframe."""
+        self.load_recording()
+        if self.recording is not None:
+            return self.give_cached_motion_frame()
         nextline = self.file.readline()
         if (nextline is not None) and (len(nextline.strip('\n\r\t ')) > 0):  # if there are more motion lines
+            self.latest_timestamp = self.give_frame_timestamp(self.motion_lines_read)
+            self.component.timestamp = self.latest_timestamp
             self.motion_lines_read += 1
-            self.latest_timestamp += self.frame_time
 
             # update Component6D/Coil objects from file
             measurements = nextline.rstrip('\n')
@@ -550,15 +814,13 @@ class BVHParser(MocapParent):
             # break into sub-lists per tool
             measurements_by_coil = []
             for ch in self.marker_channels:
-                print("new measurements", measurements[:len(ch)])
                 measurements_by_coil.append([float(j) for j in measurements[:len(ch)]])
                 measurements = measurements[len(ch):]
 
-            print("about to alter component", str(self.component)[:50])
             self.component.coils = [CoilBuilder6D.build_from_mapping(self.mappings, coilvals)
                                     for coilvals in measurements_by_coil]
 
-            return 3, DataFrame(components=[self.component]).pack_all(), None
+            return 3, DataFrame(components=[self.component]).pack_all(), self.latest_timestamp
 
         # no more data available (static, give up)
         else:
@@ -610,34 +872,43 @@ class TSVParser(MocapParent):
         # put in position to begin streaming (skip header line)
         self.pre_motion_position = self.file.tell()  # this is the beginning of the third line
 
-        # collect a list of the timestamps, count the motion frames
-
-        # read the first real line to get the initial timestamp
-        firstline = f.readline().rstrip().split('\t')
-        self.max_num_frames = 1
-        last_timestamp = MocapParent.timestamp_to_microsecs(firstline[self.timestamp_index])
-
-        # read the rest of the lines
-        timestamps = [MocapParent.timestamp_to_microsecs(
-                                                        line.strip('\n\r').split('\t')[self.timestamp_index]
-                                                        ) for line in self.file.readlines()]
-        self.max_num_frames = len(timestamps)
-        self.frame_times = [t - s for s, t in zip(timestamps, timestamps[1:])]
+        # index the motion lines with a binary scan (or the cached index), collecting the timestamps
+        # (the first field, in seconds) to find the frames by time
+        self.frame_offsets, seconds = self.build_line_index(first_fields=True)
+        self.frame_timestamps = numpy.floor(seconds * 1000000).astype(numpy.int64)  # as timestamp_to_microsecs
+        self.max_num_frames = len(self.frame_offsets)
+        self.frame_times = numpy.diff(self.frame_timestamps)
 
-        self.frame_time = sum(self.frame_times)/self.max_num_frames  # now in microseconds
-        # TODO: This overestimates the frame time slightly because if a measurement is missing this is unseen at this point
+        # the median, so frames that are missing from the data (longer gaps) do not lengthen the frame time
+        if len(self.frame_times) > 0:
+            self.frame_time = float(numpy.median(self.frame_times))  # now in microseconds
+        else:  # one frame or none, there is no interval between frames
+            self.frame_time = self.__class__.DEFAULT_FRAME_TIME
 
         print('frame time is ', self.frame_time, 'microseconds')
         print('max_num_frames is', self.max_num_frames)
 
         f.seek(self.pre_motion_position, 0)
 
-        # TODO: Does not handle skipped frames in data, should rather give a frame based on the timestamp
+    def load_motion_array(self):
+        """Read the whole motion section at once, see MocapParent.load_motion_array."""
+        values = self.read_motion_values()
+        if len(values) == 0:  # no motion lines, the fields are those of the header
+            values = numpy.zeros((0, self.extra_left_fields + self.min_channels * self.fields_per_sensor))
+        timestamps = numpy.floor(values[:, self.timestamp_index] * 1000000).astype(numpy.int64)
+        n_coils = (values.shape[1] - self.extra_left_fields) // self.fields_per_sensor
+        by_coil = values[:, self.extra_left_fields:self.extra_left_fields + n_coils * self.fields_per_sensor]\
+            .reshape(len(values), n_coils, self.fields_per_sensor)
+        wave = self.mappings.convert_to_wave_array(by_coil).astype(numpy.float32)
+        return timestamps, wave, numpy.zeros((len(values), n_coils), dtype=numpy.uint32)
 
     def give_motion_frame(self):
         """Read the next TSV line, and, skipping fields for the header and channel header, assign data to channels.
         :returns: error code, bytestring of packed data
         """
+        self.load_recording()
+        if self.recording is not None:
+            return self.give_cached_motion_frame()
         if self.motion_lines_read < self.max_num_frames:
             self.motion_lines_read += 1
 
@@ -659,8 +930,6 @@ class TSVParser(MocapParent):
             timestamp = meta[self.timestamp_index]
             timestamp = MocapParent.timestamp_to_microsecs(timestamp)  # timestamp now in microseconds
 
-            print("about to alter component", str(self.component)[:50])
-            print('measurements_by_coil:', measurements_by_coil)
             self.component.coils = [CoilBuilder6D.build_from_mapping(self.mappings, coilvals)
                                     for coilvals in measurements_by_coil]
 
@@ -677,9 +946,18 @@ class TSVParser(MocapParent):
 
 
 class POSParser(MocapParent):
-    """Parses Carstens motion capture files for AG500 and AG501 machines."""
+    """
+    Parses Carstens motion capture files for AG500 and AG501 machines.
+    The samples are memory-mapped rather than read, self.samples is a (frames, channels, 7) little-endian float32
+    array over the file (x, y, z, phi, theta, rms, extra per channel), so any frame or range of frames can be used
+    without reading the file into memory. give_wave_array converts a range of frames to WAVE order in one go.
+    """
 
     file_read_mode = 'rb'
+    SAMPLE_DTYPE = numpy.dtype('<f4')
+    FIELDS_PER_CHANNEL = 7  # x, y, z, phi, theta, rms, extra
+    V001_CHANNELS = 12
+    V001_SAMPLING_RATE = 200  # V001 files (AG500) have no header giving it
 
     def __init__(self, filename):
         """ Initialise the POS parser object. """
@@ -695,15 +973,14 @@ class POSParser(MocapParent):
         self.component = Component6D(fileparser=self)  # build the first component within the mocap object
 
     def read_header(self):
-        """Read the version, channel info and sampling rate from the ASCII header."""
-        firstline = str(self.file.readline(), encoding='utf-8')
+        """Read the version, channel info and sampling rate from the ASCII header, memory-map the samples."""
+        firstline = str(self.file.readline(), encoding='utf-8', errors='replace')
         if 'V002' in firstline:
             self.pos_version = 2
         elif 'V003' in firstline:
             self.pos_version = 3
         else:
             self.pos_version = 1
-            self.min_channels = 12
 
         self.file.seek(0, 0)
 
@@ -714,49 +991,76 @@ class POSParser(MocapParent):
 
             # number of channels for each frame
             self.min_channels = int(str(self.file.readline(), encoding='utf-8').split('=')[-1])
-            self.bytes_in_frame = self.min_channels * 7 * 4  # channels * 4bytes * 7 readings
 
             sampling_rate = int(str(self.file.readline(), encoding='utf-8').split('=')[-1])
-            self.frame_time = 1/sampling_rate * 1000000  # microseconds
-
-            # extra fields in V003
-            header_extra_fields = self.file.read(self.pre_motion_position-self.file.tell())
+            # extra fields in V003 are not used, the samples start at pre_motion_position
         else:
-            self.bytes_in_frame = self.min_channels * 7 * 4  # this also holds for V001
+            self.pre_motion_position = 0
+            self.min_channels = self.__class__.V001_CHANNELS
+            sampling_rate = self.__class__.V001_SAMPLING_RATE
+
+        self.frame_time = 1/sampling_rate * 1000000  # microseconds
+        self.bytes_in_frame = self.min_channels * self.__class__.FIELDS_PER_CHANNEL * self.__class__.SAMPLE_DTYPE.itemsize
 
         # get bytes in file by going to end, calculate how many frames available
         self.file.seek(0, 2)
-        self.max_num_frames = (self.file.tell()-self.pre_motion_position) / self.bytes_in_frame
+        self.max_num_frames = (self.file.tell()-self.pre_motion_position) // self.bytes_in_frame
+
+        # map the whole frames in the file (a memmap cannot be empty, so leave an empty array then)
+        shape = (self.max_num_frames, self.min_channels, self.__class__.FIELDS_PER_CHANNEL)
+        if self.max_num_frames > 0:
+            self.samples = numpy.memmap(self.file, dtype=self.__class__.SAMPLE_DTYPE, mode='r',
+                                        offset=self.pre_motion_position, shape=shape)
+        else:
+            self.samples = numpy.zeros(shape, dtype=self.__class__.SAMPLE_DTYPE)
 
         # return to the beginning of the data section
         self.file.seek(self.pre_motion_position, 0)
 
+    def give_wave_array(self, start=0, stop=None):
+        """
+        Return the frames start:stop as a (frames, channels, 7) float32 array in WAVE order
+        (q0, qx, qy, qz, x, y, z), converting the phi and theta angles to quaternions for all frames at once.
+        The angles are used as the Euler z and x rotations respectively.
+        """
+        return self.mappings.convert_to_wave_array(self.samples[start:stop]).astype(numpy.float32)
+
+    def load_motion_array(self):
+        """All the frames at once, see MocapParent.load_motion_array."""
+        timestamps = (numpy.arange(self.max_num_frames) * self.frame_time).astype(numpy.int64)
+        wave = self.give_wave_array()
+        return timestamps, wave, numpy.zeros(wave.shape[:2], dtype=numpy.uint32)
+
+    # frames have a fixed size and are regularly spaced, so seeking is computed rather than indexed
+    def seek_frame(self, index):
+        self.motion_lines_read = index
+
+    def give_frame_timestamp(self, index):
+        return int(index * self.frame_time)
+
+    def frame_index_at_time(self, timestamp):
+        return min(max(0, int(timestamp // self.frame_time)), self.max_num_frames)
+
     def give_motion_frame(self):
-        """Read the next sample from the POS file and assign to coil objects.
-        :returns: error code, packed bytestring with dataframe response
+        """Give the next sample from the POS file as the component's coil array.
+        :returns: error code, packed bytestring with dataframe response, timestamp
         """
+        if self.recording is not None:
+            return self.give_cached_motion_frame()
         if self.motion_lines_read < self.max_num_frames:
 
             # update the timestamp
-            timestamp = self.timestamp_to_microsecs(self.motion_lines_read * self.frame_time)
+            timestamp = self.give_frame_timestamp(self.motion_lines_read)
             self.component.timestamp, self.latest_timestamp = timestamp, timestamp
-            print('BVH latest timestamp:', self.latest_timestamp)
 
-            # 7f is floats for: x, y, z, phi, theta, rms, extra
-            measurements_by_coil = struct.iter_unpack('< 7f', self.file.read(self.bytes_in_frame))
-            # for m in measurements_by_coil:
-            #     print('POS measurement by coil:', m)
-            #
-            # print([m for m in measurements_by_coil])
-
-            self.component.coils = [CoilBuilder6D.build_from_mapping(self.mappings, coilvals)
-                                    for coilvals in measurements_by_coil]
-            # print([(self.mappings, coilvals)for coilvals in measurements_by_coil])
-            assert len(self.component.coils) > 0  # at least one coil must be made
+            # fill a coil array (with zero flags) from the mapped sample, no coil objects are built
+            array = numpy.zeros((self.min_channels, CoilBuilder6D.EACH_FIELDS), dtype=CoilBuilder6D.ARRAY_DTYPE)
+            array[:, :7] = self.give_wave_array(self.motion_lines_read, self.motion_lines_read + 1)[0]
+            self.component.set_array(array)
 
             # update the line statistics
             self.motion_lines_read += 1
-            return 3, DataFrame(components=[self.component]).pack_all(), None
+            return 3, DataFrame(components=[self.component]).pack_all(), self.latest_timestamp
 
         # no more data available (static, give up)
         else:
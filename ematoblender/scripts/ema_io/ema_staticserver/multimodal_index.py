@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Kristy'
+
+"""
+Index of the audio and video files that may belong to a mocap recording (MocapParent.search_for_multimodal).
+Each directory is listed once, its audio/video files kept sorted by file name stem (with its subdirectories),
+and listed again only when the modification time of the directory changes (ie files were added, removed or renamed).
+The index is shared by all parsers, so opening another file of the same session only needs a stat per directory.
+"""
+
+import bisect
+import os
+import threading
+
+
+class MultimodalIndex(object):
+    """Cached listings of the directories searched for audio/video files, shared by all parsers."""
+
+    AUDIO_TYPES = ('.wav', '.ogg', '.mp3')
+    VIDEO_TYPES = ('.avi', '.mpeg', '.mp4')
+
+    _listings = {}  # directory: (mtime_ns, sorted [(stem, path, is_audio)], [subdirectories])
+    _lock = threading.Lock()
+
+    @classmethod
+    def listing(cls, directory):
+        """Return the sorted (stem, path, is_audio) audio/video files and the subdirectories of a directory,
+        listing it again only if it changed. Directories that cannot be read have no files."""
+        try:
+            mtime_ns = os.stat(directory).st_mtime_ns
+        except OSError:
+            return [], []
+        with cls._lock:
+            cached = cls._listings.get(directory)
+        if cached is not None and cached[0] == mtime_ns:
+            return cached[1], cached[2]
+
+        files, subdirs = [], []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                        continue
+                    stem, ext = os.path.splitext(entry.name)
+                    if ext in cls.AUDIO_TYPES or ext in cls.VIDEO_TYPES:
+                        files.append((stem, entry.path, ext in cls.AUDIO_TYPES))
+        except OSError:
+            return [], []
+        files.sort()
+        subdirs.sort()
+        with cls._lock:
+            cls._listings[directory] = (mtime_ns, files, subdirs)
+        return files, subdirs
+
+    @classmethod
+    def candidates(cls, top, prefix):
+        """Iterate over the (path, is_audio) audio/video files in top and its subdirectories (top-down, like os.walk)
+        whose name stem starts with prefix."""
+        pending = [top]
+        while len(pending) > 0:
+            files, subdirs = cls.listing(pending.pop())
+            start = bisect.bisect_left(files, (prefix,))
+            for stem, path, is_audio in files[start:]:
+                if not stem.startswith(prefix):
+                    break
+                yield path, is_audio
+            pending.extend(reversed(subdirs))
+
+    @classmethod
+    def find(cls, filename):
+        """
+        Return the paths of the audio and video files belonging to the mocap file filename
+        (their names start with its name), searching its directory and then its parent directory.
+        :return: audio path, video path, None for those not found.
+        """
+        dirname, tail = os.path.split(filename)
+        streamfilename, streamext = os.path.splitext(tail)
+        wave_name, video_name = None, None
+
+        # search in same directory, then sister directory
+        for search_dir in [os.path.normpath(dirname + os.path.sep),
+                           os.path.normpath(dirname + os.path.sep + '..' + os.path.sep)]:
+            for path, is_audio in cls.candidates(search_dir, streamfilename):
+                print('candidate found!', path)
+                if is_audio:
+                    wave_name = path
+                else:
+                    video_name = path
+                # stop once both are populated
+                if wave_name is not None and video_name is not None:
+                    return wave_name, video_name
+
+        return wave_name, video_name
+
+    @classmethod
+    def clear(cls):
+        """Forget all the directory listings."""
+        with cls._lock:
+            cls._listings.clear()
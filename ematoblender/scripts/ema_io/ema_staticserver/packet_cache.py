@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Kristy'
+
+"""
+In-memory cache of a whole mocap file as ready-to-send RTC3D data frame packets.
+The file is parsed once when it is loaded; streaming a frame is then only a slice of one contiguous buffer,
+sent as is, so a static server can emulate high-rate streams to many clients with almost no CPU use.
+"""
+
+from array import array
+
+from ..rtc3d_parser import RTC3DPacketParser
+
+
+class MocapPacketCache(object):
+    """
+    All the motion frames of a MocapParent parser, packed (with the outer RTC3D header) into one bytearray.
+    The packets are found with an offset table, packet i is buffer[offsets[i]:offsets[i+1]].
+    """
+
+    EOF_MESSAGE = "No more frames left in mocap file"
+
+    def __init__(self, static_data):
+        """Parse every motion frame of the mocap parser static_data, leaving it reset to the motion section."""
+        self.buffer = bytearray()
+        self.offsets = array('Q', [0])
+        self.timestamps = []  # in microseconds, None where the parser does not give one
+
+        static_data.reset_motion_section()
+        while True:
+            status, message, *timestamp = static_data.give_motion_frame()
+            if status != 3:
+                break
+            self.buffer += RTC3DPacketParser.pack_wrapper(message, atype=3)
+            self.offsets.append(len(self.buffer))
+            self.timestamps.append(timestamp[0] if len(timestamp) > 0 else None)
+        static_data.reset_motion_section()
+
+        self.eof_packet = RTC3DPacketParser.pack_wrapper(self.__class__.EOF_MESSAGE, atype=4)
+        self._view = memoryview(self.buffer)  # the buffer is not resized after this
+        print('Cached {} motion frames as {} bytes of packets.'.format(len(self), len(self.buffer)))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def give_packet(self, index):
+        """Return a memoryview of packet number index (without copying), or the EOF packet past the last frame."""
+        if not 0 <= index < len(self):
+            return self.eof_packet
+        return self._view[self.offsets[index]:self.offsets[index+1]]
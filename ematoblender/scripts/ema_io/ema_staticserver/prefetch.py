@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Kristy'
+
+"""
+Background preparation of the data files that the static server is likely to stream next.
+Opening a data file (parsing the header, building the XML, searching for audio/video and, with precaching,
+packing every frame) takes long enough to interrupt the stream, so while one file of a collection is streamed
+the neighbouring entries of the collection are prepared on a worker thread.
+ThreadedTCPServer.change_datafile then only swaps in the prepared object.
+"""
+
+import queue
+import threading
+from collections import OrderedDict
+
+
+class DatafilePrefetcher(object):
+    """
+    A bounded cache of prepared objects (eg RTServer_Static) keyed by file name, filled by one worker thread.
+    Each prepared object is given out once by take, as it holds the reading position in its file.
+    """
+
+    DEFAULT_CAPACITY = 2  # the next and the previous collection entries
+
+    def __init__(self, builder, capacity=DEFAULT_CAPACITY, closer=None):
+        """
+        :param builder: function making the prepared object from a file name, called on the worker thread
+        :param capacity: number of prepared objects kept, the least recently requested are dropped first
+        :param closer: function called with a prepared object that is dropped without being taken
+        """
+        self.builder = builder
+        self.closer = closer
+        self.capacity = max(1, capacity)
+        self.prepared = OrderedDict()  # file name: prepared object, or the exception raised preparing it
+        self.pending = set()  # file names queued or being prepared
+        self._condition = threading.Condition()
+        self._requests = queue.Queue()
+        self._worker = threading.Thread(target=self._prepare_requested, name='DatafilePrefetcher')
+        self._worker.daemon = True
+        self._worker.start()
+
+    def prefetch(self, filenames):
+        """Prepare the files in the background (in the given order), unless already prepared or pending.
+        Prepared files not in filenames are dropped, to make space."""
+        filenames = [fn for fn in filenames if fn is not None]
+        with self._condition:
+            for fn in [fn for fn in self.prepared if fn not in filenames]:
+                self._drop(fn)
+            for fn in filenames:
+                if fn in self.prepared:
+                    self.prepared.move_to_end(fn)
+                elif fn not in self.pending:
+                    self.pending.add(fn)
+                    self._requests.put(fn)
+
+    def take(self, filename, timeout=None):
+        """
+        Return the prepared object for filename, removing it from the cache.
+        If it is being prepared, wait for it (at most timeout seconds). Returns None if it is not prepared.
+        An exception raised while preparing it is raised here.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: filename not in self.pending, timeout=timeout)
+            if filename not in self.prepared:
+                return None
+            prepared = self.prepared.pop(filename)
+        if isinstance(prepared, Exception):
+            raise prepared
+        return prepared
+
+    def close(self):
+        """Stop the worker and drop all prepared objects."""
+        self._requests.put(None)
+        with self._condition:
+            for fn in list(self.prepared):
+                self._drop(fn)
+
+    def _drop(self, filename):
+        """Remove a prepared object, closing it. Call while holding the condition."""
+        prepared = self.prepared.pop(filename)
+        if self.closer is not None and not isinstance(prepared, Exception):
+            self.closer(prepared)
+
+    def _prepare_requested(self):
+        """Worker thread: prepare each requested file in turn, keeping at most capacity of them."""
+        while True:
+            filename = self._requests.get()
+            if filename is None:
+                break
+            try:
+                prepared = self.builder(filename)
+            except Exception as e:
+                print('Could not prepare the data file {}: {}'.format(filename, e))
+                prepared = e
+
+            with self._condition:
+                self.pending.discard(filename)
+                self.prepared[filename] = prepared
+                while len(self.prepared) > self.capacity:
+                    self._drop(next(iter(self.prepared)))
+                self._condition.notify_all()
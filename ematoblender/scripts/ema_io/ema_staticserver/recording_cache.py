@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Kristy'
+
+"""
+Columnar binary cache of a whole EMA recording, so that a mocap file only needs to be parsed once.
+The cache is an .npz file next to the source file (source name + RecordingCache.SUFFIX) holding
+the timestamps, positions, quaternions, error values (the coil flags) and marker names as arrays.
+It is made the first time a file is opened with MakeMocapParser.factory and reused while the source file
+has the same size and modification time, the parsers then give their frames from the arrays.
+"""
+
+import os
+
+import numpy
+
+from ..rtc3d_parser import DataFrame, CoilBuilder6D
+
+
+class RecordingCache(object):
+    """The coil data of every frame of a recording, as arrays over (frames, coils)."""
+
+    SUFFIX = '.rec.npz'
+    VERSION = 2  # increment when the format (or the parsing that fills it) changes, so old caches are remade
+
+    def __init__(self, timestamps, positions, quaternions, errors, marker_names=(), frame_time=None):
+        """
+        :param timestamps: (frames,) int64 timestamps in microseconds
+        :param positions: (frames, coils, 3) float32 x, y, z
+        :param quaternions: (frames, coils, 4) float32 q0, qx, qy, qz
+        :param errors: (frames, coils) uint32 error/status values, as in the coil flags
+        :param marker_names: the coil names from the file header
+        :param frame_time: microseconds per frame
+        """
+        self.timestamps = numpy.asarray(timestamps, dtype=numpy.int64)
+        self.positions = numpy.asarray(positions, dtype=numpy.float32)
+        self.quaternions = numpy.asarray(quaternions, dtype=numpy.float32)
+        self.errors = numpy.asarray(errors, dtype=numpy.uint32)
+        self.marker_names = [str(m) for m in marker_names]
+        self.frame_time = frame_time
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    @classmethod
+    def from_wave_array(cls, timestamps, wave, errors=None, marker_names=(), frame_time=None):
+        """Make the cache from a (frames, coils, 7) array in WAVE order (q0, qx, qy, qz, x, y, z)."""
+        if errors is None:
+            errors = numpy.zeros(wave.shape[:2], dtype=numpy.uint32)
+        return cls(timestamps, wave[..., 4:7], wave[..., 0:4], errors, marker_names, frame_time)
+
+    @classmethod
+    def from_parser(cls, parser):
+        """Make the cache from the bulk loader of a MocapParent parser if it has one, else by reading every motion
+        frame with give_motion_frame. The parser is left reset to the start of the motion section."""
+        try:
+            timestamps, wave, errors = parser.load_motion_array()
+            if len(timestamps) == 0:
+                raise ValueError('No motion frames to cache in {}'.format(parser.file_name))
+            return cls.from_wave_array(timestamps, wave, errors, parser.marker_names, parser.frame_time)
+        except (NotImplementedError, ValueError):
+            parser.bulk_load_tried = True  # no bulk loader, or the file is irregular, so each frame is parsed
+
+        parser.reset_motion_section()
+        timestamps, arrays = [], []
+        while True:
+            status, message, *_ = parser.give_motion_frame()
+            if status != 3:
+                break
+            df = DataFrame(rawdf=message)
+            timestamps.append(df.give_timestamp())
+            arrays.append(df.give_coil_array())
+        parser.reset_motion_section()
+
+        if len(arrays) == 0:
+            raise ValueError('No motion frames to cache in {}'.format(parser.file_name))
+        stacked = numpy.stack(arrays)  # raises ValueError if the number of coils changes between frames
+        wave = stacked[..., :7].astype(numpy.float32)
+        errors = stacked[..., 7:].view(CoilBuilder6D.FLAG_DTYPE)[..., 0]
+        return cls.from_wave_array(timestamps, wave, errors, parser.marker_names, parser.frame_time)
+
+    @classmethod
+    def cache_name(cls, source_name):
+        return source_name + cls.SUFFIX
+
+    @staticmethod
+    def source_stamp(source_name):
+        """Return the size and modification time that the cache must have been made for."""
+        stat = os.stat(source_name)
+        return stat.st_size, stat.st_mtime_ns
+
+    @classmethod
+    def load(cls, source_name):
+        """Return the cache for the source file, or None if there is none or it is out of date."""
+        try:
+            with numpy.load(cls.cache_name(source_name)) as npz:
+                if int(npz['version']) != cls.VERSION or \
+                        (int(npz['source_size']), int(npz['source_mtime_ns'])) != cls.source_stamp(source_name):
+                    return None
+                frame_time = float(npz['frame_time'])
+                return cls(npz['timestamps'], npz['positions'], npz['quaternions'], npz['errors'],
+                           npz['marker_names'].tolist(), None if numpy.isnan(frame_time) else frame_time)
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def save(self, source_name):
+        """Write the cache next to the source file. Returns False (printing why) if it cannot be written."""
+        cache_name = self.__class__.cache_name(source_name)
+        size, mtime_ns = self.__class__.source_stamp(source_name)
+        try:
+            with open(cache_name + '.tmp', 'wb') as f:
+                numpy.savez(f, version=self.__class__.VERSION, source_size=size, source_mtime_ns=mtime_ns,
+                            timestamps=self.timestamps, positions=self.positions, quaternions=self.quaternions,
+                            errors=self.errors, marker_names=numpy.array(self.marker_names, dtype=str),
+                            frame_time=numpy.nan if self.frame_time is None else self.frame_time)
+            os.replace(cache_name + '.tmp', cache_name)
+        except OSError as e:
+            print('Could not save the recording cache of {}: {}'.format(source_name, e))
+            return False
+        return True
+
+    def give_wave_array(self, start=0, stop=None):
+        """Return the frames start:stop as a (frames, coils, 7) float32 array in WAVE order."""
+        return numpy.concatenate([self.quaternions[start:stop], self.positions[start:stop]], axis=-1)
+
+    def give_coil_array(self, index):
+        """Return frame number index as a Component6D coil array."""
+        return CoilBuilder6D.from_values(self.give_wave_array(index, index + 1)[0], self.errors[index])
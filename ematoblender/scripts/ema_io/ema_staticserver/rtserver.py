@@ -3,7 +3,11 @@ __author__ = 'Kristy'
 
 """
 This module defines how the static server works.
-This is a TCP server with threading, that creates a separate thread for each request.
+This is a TCP server with threading, that creates a separate thread for each request (client connection).
+The commands of a connection run in order on its own worker thread (see command_executor.py).
+Each client connection has its own session (RTServer_Session), with its own position in the data file and
+streaming state, so several clients can stream at once. The data file itself is opened once and shared.
+In broadcast mode all streaming clients instead receive one paced stream (see broadcast.py).
 It has functions that handle changing which data-file the server streams from and the looping behaviour,
 so that these can be passed on to the parsing function.
 However, the handle function passes the commands to a further module, rtserver_emulate_func.py,
@@ -14,10 +18,15 @@ The main function takes command line arguments for starting the server, and runs
 # TODO: Future developments should continue the current streaming status when a new file is loaded.
 
 # server functionality
+import socket
 import socketserver
+from collections import OrderedDict
 
 from ..client_server_comms import ServerConnection, RTC3DPacketParser
 from .rtserver_emulate_func import RTServer_Static
+from .prefetch import DatafilePrefetcher
+from .broadcast import Broadcaster
+from .command_executor import CommandExecutor
 from ...ema_shared import properties as pps
 
 # for debugging
@@ -35,13 +44,22 @@ import argparse
 class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
     """ ThreadedTCPServer uses Python's inbuilt socketserver behaviour to create a server. """
 
-    def __init__(self, address, requesthandler, datafile, loop=True):
+    CLOSED_CLIENT_STATS = 20  # number of disconnected clients whose command counters are kept
+
+    def __init__(self, address, requesthandler, datafile, loop=True, precache=False, collection=None,
+                 prefetch_previous=True, broadcast=False, slow_subscriber='drop', queue_limit=50):
         """
         Initialise the TCP threaded server.
         :param address: (HOST, PORT) tuple
         :param requesthandler: RTServer_Static class, determines the response from the self.handle() fn
         :param datafile: The path to the datafile that the server streams from initially.
         :param loop: true/false, if true the server begins again at the start of the data file when it ends.
+        :param precache: true/false, if true each data file is parsed once on loading and streamed from memory.
+        :param collection: list of the datafiles the experimenter steps through, the entries after
+        (and if prefetch_previous, before) the streamed one are prepared in the background (see prefetch.py).
+        :param broadcast: true/false, if true all streaming clients receive the frames of a single paced stream.
+        :param slow_subscriber: in broadcast mode, 'drop' the oldest frames queued for a client that cannot keep up,
+        or 'disconnect' it, once queue_limit frames are queued for it.
         """
         super().__init__(address, requesthandler)
         print('Server address is:', self.server_address)
@@ -49,43 +67,140 @@ class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
 
         self.datafile = datafile
         self.server_loop = loop
-        self.server_conn = None
-
-        self.rt_fns = RTServer_Static(self.datafile, self.server_conn, loopfile=self.server_loop)
-
-        self.active_threads = []
+        self.server_precache = precache
+
+        self.rt_fns = self._open_datafile(self.datafile)  # the shared data of the streamed file
+        self.sessions = []  # a RTServer_Session for each connected client
+        self.broadcaster = Broadcaster(self.rt_fns, loop=self.server_loop, queue_limit=queue_limit,
+                                       policy=slow_subscriber) if broadcast else None
+        self._swap_lock = threading.Lock()
+
+        self.collection = []
+        self.prefetch_previous = prefetch_previous
+        self.prefetcher = DatafilePrefetcher(self._open_datafile, closer=lambda rt_fns: rt_fns.static_data.file.close())
+        if collection is not None:
+            self.set_collection(collection)
+
+        self.command_stats = {}  # client address: give_stats of its CommandExecutor, while it is connected
+        self.closed_command_stats = OrderedDict()  # client address: final counters, of the latest disconnected
+        self._stats_lock = threading.Lock()
+
+    def _open_datafile(self, datafile):
+        """Return the RTServer_Static streaming from datafile."""
+        return RTServer_Static(datafile, None, loopfile=self.server_loop, precache=self.server_precache)
+
+    def open_session(self, conn):
+        """Return a new session streaming the current datafile on the client connection conn."""
+        with self._swap_lock:
+            session = self.rt_fns.new_session(conn, loopfile=self.server_loop, broadcaster=self.broadcaster)
+            self.sessions.append(session)
+        return session
+
+    def close_session(self, session):
+        """Stop the session of a disconnected client."""
+        session.bye()
+        with self._swap_lock:
+            if session in self.sessions:
+                self.sessions.remove(session)
+
+    def give_status(self):
+        """Return the status and latest timestamp of the most recently connected client's session."""
+        with self._swap_lock:
+            if len(self.sessions) == 0:
+                return 'READY', NotImplemented
+            return self.sessions[-1].status, self.sessions[-1].latest_timestamp
+
+    def open_command_stats(self, client, executor):
+        """Count the commands of the connected client with the executor."""
+        with self._stats_lock:
+            self.command_stats[client] = executor.give_stats
+
+    def close_command_stats(self, client, executor):
+        """Keep the final counters of the disconnected client, dropping those of the earliest disconnected
+        beyond CLOSED_CLIENT_STATS."""
+        stats = executor.give_stats()
+        with self._stats_lock:
+            self.command_stats.pop(client, None)
+            self.closed_command_stats.pop(client, None)
+            self.closed_command_stats[client] = stats
+            while len(self.closed_command_stats) > self.__class__.CLOSED_CLIENT_STATS:
+                self.closed_command_stats.popitem(last=False)
+
+    def give_command_stats(self):
+        """Return the command counters and dispatch times of each client connection, by client address:
+        the connected clients and the latest disconnected ones."""
+        with self._stats_lock:
+            stats = dict(self.closed_command_stats)
+            live = list(self.command_stats.items())
+        stats.update((client, give_stats()) for client, give_stats in live)
+        return stats
+
+    def give_broadcast_stats(self):
+        """Return the queue and lag counters of each broadcast subscriber, by client address ({} if not broadcasting)."""
+        return {} if self.broadcaster is None else self.broadcaster.give_stats()
+
+    def set_collection(self, collection):
+        """Set the list of datafiles that is stepped through, preparing the neighbours of the current file."""
+        self.collection = list(collection)
+        self._prefetch_neighbours()
+
+    def _prefetch_neighbours(self):
+        """Prepare the collection entries after (and before) the current datafile in the background."""
+        if self.datafile not in self.collection:
+            self.prefetcher.prefetch([])
+            return
+        i = self.collection.index(self.datafile)
+        neighbours = [self.collection[i+1] if i + 1 < len(self.collection) else None,
+                      self.collection[i-1] if self.prefetch_previous and i > 0 else None]
+        self.prefetcher.prefetch([fn for fn in neighbours if fn != self.datafile])
 
     def change_datafile(self, new_datafile):
-        """ Change the datafile that self reads information from. """
-        self.rt_fns.static_data.file.close()
-        self.datafile = new_datafile
-        self.rt_fns = RTServer_Static(self.datafile, self.server_conn, loopfile=self.server_loop)
+        """
+        Change the datafile that all sessions read information from.
+        A datafile prepared in the background is swapped in, others are opened now.
+        The sessions start at the beginning of the new file, those that were streaming stream on
+        without a new streamframes command.
+        """
+        with self._swap_lock:
+            new_fns = self.prefetcher.take(new_datafile)
+            if new_fns is None:
+                new_fns = self._open_datafile(new_datafile)
+            new_fns.emulator_loop = self.server_loop
+
+            old_fns = self.rt_fns
+            self.rt_fns = new_fns
+            self.datafile = new_datafile
+            if self.broadcaster is not None:
+                self.broadcaster.change_source(new_fns)
+            for session in self.sessions:
+                session.change_source(new_fns)
+
+            with old_fns._read_lock:
+                old_fns.static_data.file.close()
         pps.streaming_source = new_datafile  # TODO: This line is probably ineffective
+        self._prefetch_neighbours()
 
     def change_loop(self, new_loop=None):
         """
         Change the file looping behaviour of the server.
         :param new_loop: True to loop the data file, False to fail after data lines are exceeded.
         """
-        if new_loop is not None:
-            self.rt_fns.emulator_loop = new_loop
-            self.server_loop = new_loop
-        else:
-            self.rt_fns.emulator_loop = not self.rt_fns.emulator_loop
-            self.server_loop = not self.server_loop
-        return self.rt_fns.emulator_loop
+        self.server_loop = (not self.server_loop) if new_loop is None else new_loop
+        with self._swap_lock:
+            self.rt_fns.emulator_loop = self.server_loop
+            if self.broadcaster is not None:
+                self.broadcaster.loop = self.server_loop
+            for session in self.sessions:
+                session.emulator_loop = self.server_loop
+        return self.server_loop
 
     def server_close(self):
         """Shut down the server, with pausing behaviour for any continuing threaded tasks."""
-        print('Checking status of threads')
-        for t in self.active_threads:
-            print(t.name, 'alive?', t.is_alive())
-            try:
-                t.join(timeout=0.05)  # explicitly close all the threads created, waiting 0.05 secs if needed
-            except Runtimeerror:
-                pass
-            print(t.name, 'alive?', t.is_alive(), '\n')
+        print('Stopping the sessions.')
+        for session in list(self.sessions):
+            self.close_session(session)
         print('Closing the open data file.')
+        self.prefetcher.close()
         self.rt_fns.static_data.file.close()
         print('Performing server\'s shutdown method')
         self.shutdown()
@@ -108,89 +223,97 @@ class FakeRTRequestHandler(socketserver.BaseRequestHandler):
     # placeholders, filled on __init__
     datafile = None
     loop = None
-    rt_fns = None
+
+    @staticmethod
+    def split_command(body):
+        """Return the command text of a received packet body, and the session method name and arguments it calls."""
+        text = str(body, 'UTF-8').rstrip(' \t\n\r\0').lstrip('_')
+        fn_name, *commargs = text.lower().split(' ')
+        return text, fn_name, commargs
 
     def handle(self):
         """
         Reply based on the client's request, which per socketserver is self.request.
         A peristent connection is established, so continue replying until connection is broken.
-        Command functionality as rt_fns; pass on the request to this further module.
+        Command functionality as the connection's session; pass on the request to this further module.
         """
 
+        # only socketserver.StreamRequestHandler applies disable_nagle_algorithm itself
+        if self.disable_nagle_algorithm:
+            self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
+
         # firstly parse request by ServerConnection class (unpacks the packet according to the RTC3D RTC3DPacketParser)
         conn = ServerConnection(self.request, RTC3DPacketParser)
-        # make this request an attribute of the ThreadedTCPServer and FakeRTRequestHandler for access
-        self.server.server_conn = conn
-        self.server.rt_fns.conn = conn
+        # this connection's own session, streaming from the server's shared data file
+        session = self.server.open_session(conn)
+        # the commands run in order on the connection's own worker thread
+        client = '{}:{}'.format(*self.client_address[:2])
+        executor = CommandExecutor(name='Commands ' + client)
+        self.server.open_command_stats(client, executor)
 
         print("Functionality initialised, ready to respond to client")
 
-        while True:  # Persistent connection
-
-            #receive and unwrap the data
-            data = conn.receive_verbatim()
-            #print("\n\nRequest received: ", data, file=sys.stderr)
-
-            # disconnect messages
-            if data == b'' or data is None:
-                #reply = "Disconnecting."
-                #conn.send_packed(reply, 1)
-                #print("Blank message received.", file=sys.stderr)
-                self.server.rt_fns.bye()
-                break #prev. break  # no data received (possible timeout), disconnect socket
-
-            # server decodes request method
-            size, atype, text, *otherargs = conn.protocol.unpack_wrapper(data)
-            #print("Message received: ", size, atype, text, file=sys.stderr)
-            text = text.decode('UTF-8').rstrip(' \t\n\r\0').lstrip('_')
-
-            # text is a command string, now sever responds
-            command = text.lower().split(' ')
-            fn_name, *commargs = command
-            #print("Command issued is: ", fn_name, commargs, file=sys.stderr)
-
-            ############ handle messages of wrong type ##########
-            if not self.server.rt_fns.validate_message_type(atype):
-                continue  # skip to next command if msg type is not 1
-
-            ########### handle all commands  #########
-            try:  # check if the command is described for the modality being queried
-                method = getattr(self.server.rt_fns, fn_name)
-            except Exception as e:  # command not defined
-                conn.send_packed("Error-Unknown command: {}".format(str(text)), status=0)
-                continue
-
-            # command is defined
-            #print("Using method:", str(method), 'commargs:', commargs, file=sys.stderr)
-
-            try:
-                # start a thread to handle the command
-                command_thread = threading.Thread(target=method, args=commargs)
-                command_thread.daemon = True
-                command_thread.start()  # as threaded server, these are now executed in thread. rt_fns sends reply.
-                #print('command {} executed on thread {}'.format(command, command_thread.name), file=sys.stderr)
-                conn.send_packed('OK-'+text, 1)  # should follow method response
-
-            except Exception as e:
-                print("Problem: ", e)
-                print(sys.exc_info()[0], file=sys.stderr)
-                print(traceback.format_exc(), file=sys.stderr)
-                self.server.rt_fns._err_command_execution(text)
-
-            else:
-                conn.send_packed('OK-'+text, 1)  # should follow method response
-            finally:
-                self.server.active_threads.append(command_thread)  # this clogs memory somewhat, but allows explicit join
-
-
-def initialise_server(datafile='', loop=True):
+        try:
+            while True:  # Persistent connection
+
+                #receive and unwrap the data
+                data = conn.receive_packet()
+                #print("\n\nRequest received: ", data, file=sys.stderr)
+
+                # disconnect messages
+                if data == b'' or data is None:
+                    #reply = "Disconnecting."
+                    #conn.send_packed(reply, 1)
+                    #print("Blank message received.", file=sys.stderr)
+                    break #prev. break  # no data received (possible timeout), disconnect socket
+
+                # server decodes request method
+                size, atype, text = data
+                #print("Message received: ", size, atype, text, file=sys.stderr)
+                text, fn_name, commargs = self.split_command(text)
+                #print("Command issued is: ", fn_name, commargs, file=sys.stderr)
+
+                ############ handle messages of wrong type ##########
+                if not session.validate_message_type(atype):
+                    continue  # skip to next command if msg type is not 1
+
+                ########### handle all commands  #########
+                try:  # check if the command is described for the modality being queried
+                    method = getattr(session, fn_name)
+                except Exception as e:  # command not defined
+                    conn.send_packed("Error-Unknown command: {}".format(str(text)), status=0)
+                    continue
+
+                # command is defined
+                #print("Using method:", str(method), 'commargs:', commargs, file=sys.stderr)
+
+                # queue the command, waiting if too many are queued. the session sends the reply,
+                # the OK follows it (or the error if the command fails)
+                executor.submit(method, commargs,
+                                on_success=lambda text=text: conn.send_packed('OK-'+text, 1),
+                                on_error=lambda e, text=text: session._err_command_execution(text))
+
+        finally:
+            executor.close()  # the queued commands run first
+            self.server.close_command_stats(client, executor)
+            self.server.close_session(session)  # stop streaming to the closed connection
+
+
+def initialise_server(datafile='', loop=True, precache=False, collection=None, broadcast=False,
+                      slow_subscriber='drop'):
     """
     Initialise the server running in a thread.
     :param datafile: path to the datafile to be streamed initially
     :param loop: whether to loop the datafile
+    :param precache: whether to parse each datafile once on loading and stream the packed frames from memory
+    :param collection: list of datafiles to be switched between, whose neighbours are prepared in the background
+    :param broadcast: whether all streaming clients receive one paced stream
+    :param slow_subscriber: 'drop' frames for, or 'disconnect', broadcast clients that cannot keep up
     """
     # initialise the server
-    server = ThreadedTCPServer((pps.waveserver_host, pps.waveserver_port), FakeRTRequestHandler, datafile, loop=loop)
+    server = ThreadedTCPServer((pps.waveserver_host, pps.waveserver_port), FakeRTRequestHandler, datafile,
+                               loop=loop, precache=precache, collection=collection, broadcast=broadcast,
+                               slow_subscriber=slow_subscriber)
 
     # start a thread with the server
     # thread starts another thread for each request
@@ -204,9 +327,16 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Server, emulating NDI Wave, taking info from a static EMA data file.')
     parser.add_argument('Datafile', help='Load an EMA data file, .tsv and .bvh formats available.')
     parser.add_argument('-loop', help='Include to continue looping over data.', action='store_true')
+    parser.add_argument('-cache', help='Include to parse the data file once and stream it from memory.',
+                        action='store_true')
+    parser.add_argument('-broadcast', help='Include to send one paced stream to all streaming clients.',
+                        action='store_true')
+    parser.add_argument('-slow', help='In broadcast mode, drop frames for or disconnect clients that cannot keep up.',
+                        choices=Broadcaster.POLICIES, default='drop')
     cl_args = parser.parse_args()
 
-    st, so = initialise_server(datafile=cl_args.Datafile, loop=cl_args.loop)
+    st, so = initialise_server(datafile=cl_args.Datafile, loop=cl_args.loop, precache=cl_args.cache,
+                               broadcast=cl_args.broadcast, slow_subscriber=cl_args.slow)
 
     print('Starting first server thread.')
     st.start()
@@ -215,4 +345,8 @@ if __name__ == "__main__":
     while st.is_alive():
         print("Server still alive; emulating file '{}' with looping set to {}."
               .format(FakeRTRequestHandler.datafile, FakeRTRequestHandler.loop))
+        for client, stats in so.give_command_stats().items():
+            print('Commands from {}: {}'.format(client, stats))
+        for client, stats in so.give_broadcast_stats().items():
+            print('Broadcast to {}: {}'.format(client, stats))
         time.sleep(30)
@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Kristy'
+
+"""
+The static server on an asyncio event loop, instead of a thread per connection, per command and per stream.
+It answers the same RTC3D commands as rtserver.py (the sessions are RTServer_Session with another way of streaming),
+but all connections are served by asyncio.start_server and every stream is driven by loop.call_at deadlines,
+so one event loop streams to dozens of clients without threads being switched between frames.
+The frames are sent as they are given by the deadlines of the frame times; a frame is skipped for a client
+whose sending buffer is full, rather than queueing it.
+
+Data files are opened on a worker thread, and by default precached (see packet_cache.py),
+so that sending a frame never reads the file on the event loop.
+
+ThreadedAsyncRTServer runs the event loop on a thread with the blocking methods of ThreadedTCPServer,
+and initialise_async_server gives it like rtserver.initialise_server.
+"""
+
+import asyncio
+import socket
+import threading
+import argparse
+
+from ..rtc3d_parser import RTC3DPacketParser
+from .rtserver import FakeRTRequestHandler
+from .rtserver_emulate_func import RTServer_Static, RTServer_Session
+from ...ema_shared import properties as pps
+
+
+class StreamConnection(object):
+    """The sending side of a client connection, like ServerConnection but writing to an asyncio StreamWriter."""
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.protocol = RTC3DPacketParser
+
+    def send_verbatim(self, message):
+        """Queue exactly the message bytes for sending, without waiting."""
+        if not self.writer.is_closing():
+            self.writer.write(message)
+
+    def send_packed(self, message, status):
+        self.send_verbatim(self.protocol.pack_wrapper(message, atype=status))
+
+    def buffered(self):
+        """Return the number of bytes written but not yet sent."""
+        return self.writer.transport.get_write_buffer_size()
+
+
+class AsyncRTServer_Session(RTServer_Session):
+    """A session whose frames are sent by callbacks at the frame deadlines on the event loop, not by a thread."""
+
+    MAX_BUFFERED = 65536  # bytes not yet sent to the client, above which frames are skipped
+
+    def __init__(self, source, connection, event_loop, loopfile=False):
+        super().__init__(source, connection, loopfile)
+        self.event_loop = event_loop
+        self._timer = None  # the asyncio.TimerHandle of the next frame
+
+    def _start_streaming(self):
+        """Schedule the first frame now, the following at every frame time after it."""
+        self._cancel_timer()  # there is only ever one chain of frame callbacks
+        self._starting_stamp = self._give_starting_stamp()
+        self._starting_time = self._deadline = self.event_loop.time()
+        self._timer = self.event_loop.call_at(self._deadline, self._stream_frame)
+
+    def _stream_frame(self):
+        """Send the frame of the current deadline and schedule the next.
+        A deadline missed by more than a frame time skips frames rather than drifting."""
+        self._timer = None
+        if self.status != 'STREAMING':
+            return
+        data = self.source.static_data
+        ft = data.frame_time/1000000  # frame time in seconds
+
+        late = self.event_loop.time() - self._deadline
+        if late > ft:
+            self._deadline += (late // ft) * ft
+        index = self._give_frame_index(self._deadline)
+        if index is None:
+            self.status = 'EOF'
+            self.conn.send_verbatim(self.source.eof_packet)
+            return
+
+        if self.conn.buffered() > self.__class__.MAX_BUFFERED:
+            self.frames_skipped += 1
+        else:
+            self._send_frame(index)
+
+        self._deadline += ft
+        self._timer = self.event_loop.call_at(self._deadline, self._stream_frame)
+
+    def stop_streaming(self):
+        """Stop streaming, cancelling the next frame. Frames are sent on the event loop, so none is being sent."""
+        if self.status == 'STREAMING':
+            self.status = 'READY'
+        self._cancel_timer()
+
+    def bye(self, *args, **kwargs):
+        """ Stop streaming, change state. Disconnecting handled by the server."""
+        self.status = 'READY' if self.status != 'EOF' else 'EOF'
+        self._cancel_timer()
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+
+class AsyncRTServer(object):
+    """The static server on an asyncio event loop, with a session for each connected client."""
+
+    def __init__(self, datafile, loop=True, precache=True):
+        """
+        :param datafile: The path to the datafile that the server streams from initially.
+        :param loop: true/false, if true the server begins again at the start of the data file when it ends.
+        :param precache: true/false, if true each data file is parsed once on loading and streamed from memory,
+        else frames are read from the file on the event loop.
+        """
+        self.datafile = datafile
+        self.server_loop = loop
+        self.server_precache = precache
+
+        self.rt_fns = None  # the shared data of the streamed file, opened by start
+        self.sessions = []
+        self._clients = {}  # session: the task answering its connection
+        self.server = None
+        self.event_loop = None
+
+    def _open_datafile(self, datafile):
+        """Return the RTServer_Static streaming from datafile."""
+        return RTServer_Static(datafile, None, loopfile=self.server_loop, precache=self.server_precache)
+
+    async def start(self, host=None, port=None):
+        """Open the data file and start accepting connections on (host, port), by default those in properties."""
+        self.event_loop = asyncio.get_running_loop()
+        self.rt_fns = await self.event_loop.run_in_executor(None, self._open_datafile, self.datafile)
+        self.server = await asyncio.start_server(self._serve_client,
+                                                 pps.waveserver_host if host is None else host,
+                                                 pps.waveserver_port if port is None else port)
+        print('Server address is:', self.server_address)
+
+    @property
+    def server_address(self):
+        return self.server.sockets[0].getsockname()
+
+    async def serve_forever(self):
+        await self.server.serve_forever()
+
+    async def _serve_client(self, reader, writer):
+        """Answer the commands of one client connection until it is closed."""
+        sock = writer.get_extra_info('socket')
+        if sock is not None:  # as per NDI WAVE RTC3D instructions
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn = StreamConnection(writer)
+        session = AsyncRTServer_Session(self.rt_fns, conn, self.event_loop, self.server_loop)
+        self.sessions.append(session)
+        self._clients[session] = asyncio.current_task()
+
+        try:
+            while True:
+                try:
+                    header = await reader.readexactly(RTC3DPacketParser.HEADER_LEN)
+                    size, atype = RTC3DPacketParser.HEADER_PACKER.unpack(header)
+                    body = await reader.readexactly(max(0, size - RTC3DPacketParser.HEADER_LEN))
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break  # the client disconnected
+
+                text, fn_name, commargs = FakeRTRequestHandler.split_command(body)
+                if not session.validate_message_type(atype):
+                    continue
+                try:
+                    method = getattr(session, fn_name)
+                except AttributeError:
+                    conn.send_packed("Error-Unknown command: {}".format(str(text)), status=0)
+                    continue
+
+                try:  # the commands only queue their replies, so they run on the event loop
+                    method(*commargs)
+                except Exception as e:
+                    print("Problem: ", e)
+                    session._err_command_execution(text)
+                else:
+                    conn.send_packed('OK-'+text, 1)
+                try:  # stop reading commands while the client does not receive the replies
+                    await writer.drain()
+                except ConnectionError:
+                    break
+
+        finally:
+            session.bye()
+            if session in self.sessions:
+                self.sessions.remove(session)
+            self._clients.pop(session, None)
+            writer.close()
+
+    async def change_datafile(self, new_datafile):
+        """
+        Change the datafile that all sessions read information from, opening it on a worker thread.
+        The sessions start at the beginning of the new file, those that were streaming stream on.
+        """
+        new_fns = await self.event_loop.run_in_executor(None, self._open_datafile, new_datafile)
+        new_fns.emulator_loop = self.server_loop
+        old_fns = self.rt_fns
+        self.rt_fns, self.datafile = new_fns, new_datafile
+        for session in self.sessions:
+            session.change_source(new_fns)
+        old_fns.static_data.file.close()
+
+    def change_loop(self, new_loop=None):
+        """
+        Change the file looping behaviour of the server.
+        :param new_loop: True to loop the data file, False to fail after data lines are exceeded.
+        """
+        self.server_loop = (not self.server_loop) if new_loop is None else new_loop
+        self.rt_fns.emulator_loop = self.server_loop
+        for session in self.sessions:
+            session.emulator_loop = self.server_loop
+        return self.server_loop
+
+    def give_status(self):
+        """Return the status and latest timestamp of the most recently connected client's session."""
+        if len(self.sessions) == 0:
+            return 'READY', NotImplemented
+        return self.sessions[-1].status, self.sessions[-1].latest_timestamp
+
+    async def close(self):
+        """Stop the sessions, close their connections, stop accepting connections and close the data file."""
+        self.server.close()
+        for session in list(self.sessions):
+            session.bye()
+            session.conn.writer.close()  # the session's task then reads the end of the connection
+        await asyncio.gather(*self._clients.values(), return_exceptions=True)
+        await self.server.wait_closed()
+        if self.rt_fns is not None:
+            self.rt_fns.static_data.file.close()
+
+
+class ThreadedAsyncRTServer(object):
+    """
+    Thin blocking wrapper running an AsyncRTServer on its own event loop thread,
+    with the methods of ThreadedTCPServer used by the server GUIs.
+    """
+
+    def __init__(self, datafile, loop=True, precache=True, host=None, port=None):
+        self.async_server = AsyncRTServer(datafile, loop=loop, precache=precache)
+        self.event_loop = asyncio.new_event_loop()
+        self._address = (host, port)
+        self._started = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='AsyncRTServer')
+        self.thread.daemon = True
+
+    def _run(self):
+        asyncio.set_event_loop(self.event_loop)
+        try:
+            self.event_loop.run_until_complete(self.async_server.start(*self._address))
+        finally:
+            self._started.set()
+        self.event_loop.run_forever()
+
+    def start(self, timeout=None):
+        """Start the event loop thread, returning once the server accepts connections."""
+        self.thread.start()
+        self._started.wait(timeout)
+
+    def _call(self, coroutine, timeout=None):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.event_loop).result(timeout)
+
+    def _call_soon(self, fn, *args):
+        async def call():
+            return fn(*args)
+        return self._call(call())
+
+    @property
+    def server_address(self):
+        return self.async_server.server_address
+
+    @property
+    def datafile(self):
+        return self.async_server.datafile
+
+    @property
+    def server_loop(self):
+        return self.async_server.server_loop
+
+    def change_datafile(self, new_datafile):
+        self._call(self.async_server.change_datafile(new_datafile))
+
+    def change_loop(self, new_loop=None):
+        return self._call_soon(self.async_server.change_loop, new_loop)
+
+    def give_status(self):
+        return self._call_soon(self.async_server.give_status)
+
+    def server_close(self):
+        """Close the server and stop its event loop."""
+        self._call(self.async_server.close())
+        self.event_loop.call_soon_threadsafe(self.event_loop.stop)
+        self.thread.join(timeout=1.0)
+
+
+def initialise_async_server(datafile='', loop=True, precache=True):
+    """
+    Initialise the asyncio server, like rtserver.initialise_server.
+    :param datafile: path to the datafile to be streamed initially
+    :param loop: whether to loop the datafile
+    :param precache: whether to parse each datafile once on loading and stream the packed frames from memory
+    :return: the thread to start running the event loop, and the ThreadedAsyncRTServer
+    """
+    server = ThreadedAsyncRTServer(datafile, loop=loop, precache=precache)
+    return server.thread, server
+
+
+async def main(cl_args):
+    server = AsyncRTServer(cl_args.Datafile, loop=cl_args.loop, precache=not cl_args.nocache)
+    await server.start()
+    async with server.server:
+        while True:
+            print("Server still alive; emulating file '{}' with looping set to {}, {} clients connected."
+                  .format(server.datafile, server.server_loop, len(server.sessions)))
+            await asyncio.sleep(30)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Asyncio server, emulating NDI Wave, taking info from a static EMA data file.')
+    parser.add_argument('Datafile', help='Load an EMA data file, .tsv and .bvh formats available.')
+    parser.add_argument('-loop', help='Include to continue looping over data.', action='store_true')
+    parser.add_argument('-nocache', help='Include to read the frames from the data file while streaming.',
+                        action='store_true')
+    asyncio.run(main(parser.parse_args()))
@@ -12,6 +12,10 @@ The results of these functions are then sent back to the client.
 import xml.etree.ElementTree as ET
 
 from .mocap_file_parser import MakeMocapParser
+from .packet_cache import MocapPacketCache
+from .scheduler import DeadlineScheduler
+from .broadcast import Subscriber
+from ..rtc3d_parser import RTC3DPacketParser
 import os
 
 # streaming
@@ -105,13 +109,19 @@ class RTServerBase():
 
 
 class RTServer_Static(RTServerBase):
-    """Pretend to be a live RTC3D server but actually be a text document."""
+    """
+    Pretend to be a live RTC3D server but actually be a text document.
+    This holds the data file, shared by the RTServer_Session of every client connection,
+    which each stream from it with their own frame cursor.
+    """
 
-    def __init__(self, filename, connection, loopfile=False):
+    def __init__(self, filename, connection=None, loopfile=False, precache=False):
         """
         Emulate all the server functionality from a text file.
         Begin by creating the parameter xml from the header, ready to send/stream frames.
         :param filename: Path to the file that should be streamed.
+        :param precache: If true, all frames are parsed and packed once now (see packet_cache.py),
+        so streaming only sends slices of the cached packets.
         """
 
         # initialise the super class, containing self.conn and XML root as self.serverparams.
@@ -126,9 +136,65 @@ class RTServer_Static(RTServerBase):
         # set some global settings
         self.emulator_loop = loopfile
 
+        # optionally parse the whole file now, keeping the packed frames in memory
+        self.packet_cache = MocapPacketCache(self.static_data) if precache else None
+        self.eof_packet = RTC3DPacketParser.pack_wrapper(MocapPacketCache.EOF_MESSAGE, atype=4)
+        self._read_lock = threading.Lock()  # the parser reads one frame at a time for all sessions
+
     def __str__(self):
         return "Static C3D Info object with motion data as {} ".format(str(self.static_data))
 
+    def give_packet(self, index):
+        """Return the RTC3D packet of frame number index (the EOF packet past the last frame), for any session."""
+        if self.packet_cache is not None:
+            return self.packet_cache.give_packet(index)
+        if not 0 <= index < self.static_data.max_num_frames:
+            return self.eof_packet
+        with self._read_lock:
+            status, message, *timestamp = self.static_data.give_motion_frame_at(index=index)
+            # increment frames streamed in the XML data
+            self.static_data.update_xml_stats()
+        return RTC3DPacketParser.pack_wrapper(message, atype=status)
+
+    def new_session(self, connection, loopfile=None, broadcaster=None):
+        """Return a RTServer_Session responding to the commands of a client on connection from this file."""
+        return RTServer_Session(self, connection, self.emulator_loop if loopfile is None else loopfile, broadcaster)
+
+
+class RTServer_Session(RTServerBase):
+    """
+    The RTC3D commands of one client connection, streaming frames from the shared RTServer_Static source.
+    Each session has its own frame cursor and streaming status, and sends only on its own connection.
+    Its frames are paced at their deadlines by the DeadlineScheduler shared by all sessions,
+    and sent by the session's own Subscriber thread, so a client that stops receiving holds up no other stream.
+    With a broadcaster (see broadcast.py), streaming subscribes the session to the server's single paced stream instead.
+    """
+
+    SEND_QUEUE_LIMIT = 5  # frames queued for sending, above which the oldest are skipped
+
+    def __init__(self, source, connection, loopfile=False, broadcaster=None):
+        self.source = source
+        self.broadcaster = broadcaster
+        self.conn = connection
+        self.status = 'READY'  # statuses: ['READY', 'EOF', 'STREAMING']
+        self.emulator_loop = loopfile
+        self.cursor = 0  # index of the next frame to send
+        self.latest_timestamp = NotImplemented  # timestamp of the last frame sent, in microseconds
+        self.stream = None  # the ScheduledStream pacing the frames while streaming
+        self.sender = None  # the Subscriber sending the paced frames while streaming
+        self.frames_skipped = 0  # frames not sent as the client did not receive the previous ones
+
+    def __str__(self):
+        return "Session streaming from {} ".format(str(self.source))
+
+    @property
+    def static_data(self):
+        return self.source.static_data
+
+    @property
+    def serverparams(self):
+        return self.source.serverparams
+
     ################ RTC3D PROTOCOL COMMANDS
     def streamframes(self, *args, **kwargs):
         """
@@ -145,118 +211,132 @@ class RTServer_Static(RTServerBase):
             print("Error in given parameters.")
             pass  # TODO: This persists with default values even though the command asked for different parameters, added because parameters necessary for live use.
 
-        # time aspect
-        ft = self.static_data.frame_time  # frame time (inverse of frequency) in microseconds
-
-        self._delay = 0
-
-        streamthread = threading.Thread(group=None, target=self._stream_one_frame)
-
         # use the command to stop/fail to start streaming
         if 'stop' in args and (self.status == 'READY' or self.status == 'STREAMING'):  # stop streaming
-            self.status = 'READY'
+            self.stop_streaming()
 
         elif self.status == 'EOF':
             self.conn.send_packed("No data, EOF or no measurement", 4)
 
-        else:  # command asks to start streaming
+        elif self.status != 'STREAMING':  # command asks to start streaming
             print("Starting the repeating timer, using only the pre-determined frequency.")
             self.status = 'STREAMING'
-            streamthread.start()
-
-    def _stream_one_frame(self, *args, **kwargs):
-        """Define how one frame should be streamed using the repeating timer.
-        If end reached, set status as EOF or loop."""
-
-        # compute frame time in seconds
-        ft = self.static_data.frame_time/1000000
-
-        # use currently read lines as offset
-        frameOffset = self.static_data.motion_lines_read
-
-        # get starting time
-        startingTime = time.monotonic()
-
-        # send frames, perform frameskipping if needed
-        while self.status == 'STREAMING':
-
-            # start measuring time for processing
-            start = time.monotonic()
-
-            # compute index of current frame depending on passed time
-            currentFrame = int((time.monotonic() - startingTime) / ft)
-
-            # set index, add offset
-            self.static_data.motion_lines_read = frameOffset + currentFrame
-
-            # get the motion frame as message in packed wave format
-            status, message, *timestamp = self.static_data.give_motion_frame()
-
-            # reset starting time and frame offset if eof was read
-            if status == 4:
-                startingTime = time.monotonic()
-                frameOffset = 0
-
-            # restart loop or cancel if EOF, update stats
-            status, message, *timestamp = self._check_streaming_eof(status, message, timestamp)
-
-            # send data
-            self.conn.send_packed(message, status)
-
-            # end measuring time for processing
-            end = time.monotonic()
-
-            # sleep some time if any is left
-            sleepTime = ft - (end - start)
-
-            if sleepTime > 0:
-                time.sleep(sleepTime)
-
-            #from scripts.ema_io.rtc3d_parser import DataFrame
-            #print(DataFrame(message).give_timestamp_secs())
-            # time.sleep(0.5) # debugging
-
-
-
-    def _check_streaming_eof(self, status, message, timestamp):
-        if status == 4:  # no more data available
-            # looping not available, signal EOF and let stop
-            if self.emulator_loop is False:
-                self.status = 'EOF'
-                print('\n\n\n I AM SETTING EOF STATUS')
-            # looping available, reset the static data to the beginning of the motion section and get frame again
+            if self.broadcaster is not None:
+                self.broadcaster.subscribe(self)
             else:
-                self.static_data.reset_motion_section()
-                status, message, timestamp = self.static_data.give_motion_frame()
-                print("Restarted motion frame looks like:", status, message, timestamp)
-                # increment frames streamed in the XML data
-                self.serverparams = self.static_data.update_xml_stats().getroot()
-        else:
-            # increment frames streamed in the XML data
-            self.static_data.update_xml_stats()
+                self._start_streaming()
+
+    def _start_streaming(self):
+        """Start sending the frames (status is already STREAMING), every frame time on the shared scheduler."""
+        self._cancel_stream()  # there is only ever one stream per session
+        self.sender = Subscriber(self, self.__class__.SEND_QUEUE_LIMIT, 'drop')
+        self._starting_stamp = self._give_starting_stamp()  # use the timestamp of the next frame as offset
+        self._starting_time = None  # the deadline of the first frame
+        self.stream = DeadlineScheduler.shared().add_stream(self.source.static_data.frame_time/1000000,
+                                                            self._stream_frame)
+
+    def stop_streaming(self, timeout=1.0):
+        """Stop streaming (like streamframes stop), waiting at most timeout seconds for a frame being sent."""
+        if self.status == 'STREAMING':
+            self.status = 'READY'
+        if self.broadcaster is not None:
+            self.broadcaster.unsubscribe(self)
+        self._cancel_stream(timeout)
+
+    def _cancel_stream(self, timeout=1.0):
+        """Stop the scheduled stream and its sender, waiting at most timeout seconds for each
+        (for the running tick, and for a frame being sent)."""
+        if self.stream is not None:
+            self.stream.cancel(timeout=timeout)
+            self.stream = None
+        if self.sender is not None:
+            self.sender.close(timeout=timeout)
+            self.sender = None
+
+    def _stream_frame(self, deadline):
+        """Queue the frame due at the deadline (a perf_counter time) for the sender while the status is STREAMING.
+        At the end of the file, loop or set status EOF. Nothing is sent on the scheduler's thread, if the client
+        does not receive the queued frames the oldest are skipped."""
+        sender = self.sender
+        if self.status != 'STREAMING' or sender is None:
+            return False
+        if self._starting_time is None:
+            self._starting_time = deadline
+        index = self._give_frame_index(deadline)
+        if index is None:
+            self.status = 'EOF'
+            self.sender = None  # not closed when stopping, so its last frames and the EOF packet are all sent
+            sender.offer(self.source.eof_packet)
+            sender.close_after_queued()
+            return False
+
+        dropped = sender.dropped
+        if not sender.offer(self.source.give_packet(index)):
+            return False  # the connection is closed
+        self.frames_skipped += sender.dropped - dropped
+        self.cursor = index + 1
+        self.latest_timestamp = self.source.static_data.give_frame_timestamp(index)
 
-        return status, message, timestamp
+    def _give_frame_index(self, deadline):
+        """
+        Return the index of the frame to stream at the deadline (in seconds, on the clock of self._starting_time),
+        choosing it by the timestamps, so that frames are skipped if deadlines are missed.
+        At the end of the file restart at its beginning if looping, else return None.
+        """
+        data = self.source.static_data
+        index = data.frame_index_at_time(self._starting_stamp + (deadline - self._starting_time) * 1000000)
+        if index >= data.max_num_frames:
+            if self.emulator_loop is False or data.max_num_frames == 0:  # an empty file cannot loop
+                return None
+            # restart at the beginning of the file
+            self._starting_time, self._starting_stamp, index = deadline, data.give_frame_timestamp(0), 0
+        return index
+
+    def _send_frame(self, index):
+        """Send frame number index on this session's connection, moving the cursor past it."""
+        self.conn.send_verbatim(self.source.give_packet(index))
+        self.cursor = index + 1
+        self.latest_timestamp = self.source.static_data.give_frame_timestamp(index)
+
+    def _give_starting_stamp(self):
+        """Return the timestamp (microseconds) of the next frame to send, where streaming starts."""
+        data = self.source.static_data
+        if data.max_num_frames == 0:
+            return 0
+        return data.give_frame_timestamp(max(0, min(self.cursor, data.max_num_frames - 1)))
 
     def sendcurrentframe(self, *args, **kwargs):
         """Send back the next frame in the data file."""
-         # get the motion frame as message in packed wave format
-        status, message, *timestamp = self.static_data.give_motion_frame()
-
-        # if last measurement sent, set functionality status
-        if status == 4:
-            if self.emulator_loop is False:
+        index = self.cursor
+        if index >= self.source.static_data.max_num_frames:
+            if self.emulator_loop is False or self.source.static_data.max_num_frames == 0:
                 self.status = 'EOF'
-                print('location 2 setting eof')
-            elif self.emulator_loop is True:
-                self.static_data.reset_motion_section()
-                status, message, timestamp = self.static_data.give_motion_frame()
-        else:
-             # increment frames streamed in the XML data
-            self.serverparams = self.static_data.update_xml_stats().getroot()
+                self.conn.send_verbatim(self.source.eof_packet)
+                return
+            index = 0
+        self._send_frame(index)
 
-        # send the frame
-        print('\nSending a single df from rtserver_emulate_func.py.', file=sys.stderr)
-        self.conn.send_packed(message, status)
+    def bye(self, *args, **kwargs):
+        """ Stop streaming, change state. Disconnecting handled in handle() method."""
+        print("Now performing connection shutown as nothing received.")
+        self.status = 'READY' if self.status != 'EOF' else 'EOF'  # stops streaming at poll time
+        if self.broadcaster is not None:
+            self.broadcaster.unsubscribe(self)
+        self._cancel_stream()
+
+    def change_source(self, source):
+        """Stream from another RTServer_Static (another data file) from its start,
+        streaming on without a new streamframes command if this session was streaming."""
+        if self.broadcaster is not None and self.status == 'STREAMING':  # the broadcaster changes source itself
+            self.source, self.cursor = source, 0
+            return
+        was_streaming = self.status == 'STREAMING'
+        self.stop_streaming()
+        self.source = source
+        self.cursor = 0
+        self.status = 'READY'
+        if was_streaming:
+            self.streamframes()
 
 
 class RTServer_Live(RTServerBase):
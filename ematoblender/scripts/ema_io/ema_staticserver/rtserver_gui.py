@@ -44,7 +44,7 @@ def main(collection=None):
         mb.showinfo("Error", "Can not read file collection file.")
 
     # start the server
-    server_thread, server = rts.initialise_server(datafile=files[0], loop=True)
+    server_thread, server = rts.initialise_server(datafile=files[0], loop=True, collection=files)
     server_thread.start()
 
     # build the gui
@@ -90,7 +90,7 @@ class Application(tk.Frame):
         self.on_toggle_fn = toggle_fn
         self.server_obj = server_obj
 
-        self.gs = lambda x: x.rt_fns.status
+        self.gs = lambda x: x.give_status()[0]
         self.createWidgets()
 
     def setFilelist(self, filelist):
@@ -124,11 +124,15 @@ class Application(tk.Frame):
         else:
             return microsecstring
 
+    def give_status_texts(self):
+        """The status and file time of the most recently connected client."""
+        status, timestamp = self.server_obj.give_status()
+        return status, self.pretty_print_microseconds(timestamp)
+
     def update_eof_status(self):
         """Show the status of the file."""
         self.statustext.config(text='File status: {}\nFile time: {}'
-                                   .format(self.server_obj.rt_fns.status,
-                                           self.pretty_print_microseconds(self.server_obj.rt_fns.static_data.latest_timestamp)))
+                                   .format(*self.give_status_texts()))
         self.after(10, self.update_eof_status)
 
     def change_collection(self):
@@ -149,6 +153,7 @@ class Application(tk.Frame):
                     self.file_list = file_list
                     self.collection_path = selectedfile
                     self.populate_listbox()
+                    self.server_obj.set_collection(self.file_list)
                 else:
                     mb.showwarning("No files in collection", "Your selected collection doesn't contain any EMA files.")
 
@@ -203,12 +208,11 @@ class Application(tk.Frame):
         self.status = tk.Label(fm, text='Default file running')
         self.status.pack(side="top", anchor=tk.W, fill=tk.X, expand=True)
 
-        self.looptext = tk.Label(fm, text='Looping: {}'.format(self.server_obj.rt_fns.emulator_loop))
+        self.looptext = tk.Label(fm, text='Looping: {}'.format(self.server_obj.server_loop))
         self.looptext.pack(side="top", anchor=tk.W, fill=tk.X, expand=True)
 
         self.statustext = tk.Label(fm, text='File status: {}\nFile time: {}'
-                                   .format(self.server_obj.rt_fns.status,
-                                           self.pretty_print_microseconds(self.server_obj.rt_fns.static_data.latest_timestamp)))
+                                   .format(*self.give_status_texts()))
         self.statustext.after(10, func=self.update_eof_status)
         self.statustext.pack(side='top', anchor=tk.W, fill=tk.X, expand=True)
 
@@ -235,6 +239,7 @@ class Application(tk.Frame):
             self.listbox.insert(tk.END, new_fn)
             self.file_list.append(new_fn)
             self.collection_changed = True
+            self.server_obj.set_collection(self.file_list)
 
     def remove_from_list(self):
         """Remove the selected filename from the list."""
@@ -244,6 +249,7 @@ class Application(tk.Frame):
             self.file_list.pop(file_ind[0])
             self.listbox.delete(file_ind)
             self.collection_changed = True
+            self.server_obj.set_collection(self.file_list)
 
     def quit_all(self):
         """Close the GUI and quit the server."""
@@ -27,7 +27,7 @@ def main(collection=None):
 
     # start the server
     loop_status = True
-    server_thread, server = rts.initialise_server(datafile=files[0], loop=loop_status)
+    server_thread, server = rts.initialise_server(datafile=files[0], loop=loop_status, collection=files)
     server_thread.start()
 
     while server_thread.is_alive():
@@ -1,122 +1,280 @@
-from datetime import datetime
+import bisect
+import heapq
+import itertools
 import threading
-from time import time, sleep
+import traceback
 import sys
+from time import perf_counter
 
 """
-Module with different timer options. These control how often a callable is called.
+Module with the timer that controls how often a callable is called.
+The DeadlineScheduler calls any number of streams from one thread. Each tick is due at an absolute deadline
+(start + n * interval on the monotonic perf_counter clock), so late ticks do not accumulate drift.
+It sleeps until shortly before the next deadline and spins for the rest (the spin window), because a sleep
+can wake late by the timer slack of the system. Ticks that are missed by more than an interval are skipped.
+The lateness of every tick (jitter) and how far each tick ran past the next deadline (overrun)
+are counted in histograms, see ScheduledStream.give_stats.
+RepeatTimer is the old timer interface, calling on the shared scheduler.
 """
 
 
-# this is adapted code from the original gist
-class RepeatTimer(threading.Thread):
+class TickHistogram(object):
+    """Counts of times (in microseconds) in bins, with their number, mean and maximum."""
+
+    EDGES_US = (10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)  # the upper edges of the bins
+
+    def __init__(self, edges=EDGES_US):
+        self.edges = tuple(edges)
+        self.counts = [0] * (len(self.edges) + 1)  # the last bin is at or above the last edge
+        self.n, self.total, self.max = 0, 0.0, 0.0
+
+    def add(self, us):
+        self.counts[bisect.bisect_right(self.edges, us)] += 1
+        self.n += 1
+        self.total += us
+        self.max = max(self.max, us)
+
+    def mean(self):
+        return self.total / self.n if self.n > 0 else 0.0
+
+    def percentile(self, p):
+        """Return the upper edge of the bin holding the p-th percentile (the maximum if in the last bin)."""
+        if self.n == 0:
+            return 0.0
+        rank, cumulative = p / 100 * self.n, 0
+        for edge, count in zip(self.edges, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return min(edge, self.max)
+        return self.max
+
+    def give_bins(self):
+        """Return a dict of the counts by bin label, eg '<50us'."""
+        labels = ['<{}us'.format(e) for e in self.edges] + ['>={}us'.format(self.edges[-1])]
+        return dict(zip(labels, self.counts))
+
+    def __str__(self):
+        return '{}; mean {:.1f}us, max {:.1f}us'.format(
+            ', '.join('{}: {}'.format(label, count) for label, count in self.give_bins().items() if count > 0),
+            self.mean(), self.max)
+
+
+class ScheduledStream(object):
     """
-    This timer creates a thread. When the time limit has passed, execute the callable.
-    It is inspired by:
-    This class created on 2011-02-10
-    @author: Bohdan Mushkevych
-    @author: Brian Curtin
-    http://code.activestate.com/lists/python-ideas/8982/
+    A callback called by a DeadlineScheduler every interval seconds, as callback(deadline, *args),
+    where deadline is the perf_counter time the tick was due. The stream ends when the callback returns False.
     """
 
-    def __init__(self, interval, callable, args=None, kwargs=None):
-        """
-        Initiate the timer, with the interval in seconds, callable function, optional function arguments and kwargs.
-        """
-        threading.Thread.__init__(self)
+    def __init__(self, scheduler, interval, callback, args=(), start=None):
+        self.scheduler = scheduler
+        self.interval = interval
+        self.callback = callback
+        self.args = tuple(args)
+        self.start = perf_counter() if start is None else start  # the deadline of tick 0
+        self.tick = 0  # number of the next tick since start
+        self.cancelled = False
 
-        # note: interval_current and interval_new currently the same, only useful if changing interval implemented
-        # interval_current shows number of seconds in currently triggered <tick>
-        self.interval_current = interval
+        self.jitter = TickHistogram()  # how late each tick was called
+        self.overrun = TickHistogram()  # how far the ticks that ran past the next deadline did so
+        self.ticks_run, self.ticks_skipped = 0, 0
 
-        # interval_new shows number of seconds for next <tick>
-        self.interval_new = interval
+    @property
+    def deadline(self):
+        """The time the next tick is due."""
+        return self.start + self.tick * self.interval
 
-        # the function called when the timer expires and its args
-        self.callable = callable
-        self.args = args
-        self.kwargs = kwargs
+    def change_interval(self, interval):
+        """Call every interval seconds from the next tick on."""
+        with self.scheduler._condition:
+            self.start, self.tick, self.interval = self.deadline, 0, interval
+
+    def cancel(self, wait=True, timeout=None):
+        """Stop calling the callback. If wait, wait (at most timeout seconds) for a tick that is running to finish."""
+        self.scheduler.cancel(self, wait=wait, timeout=timeout)
+
+    def give_stats(self):
+        """Return the tick counters and the jitter and overrun percentiles (in microseconds)."""
+        return {'ticks': self.ticks_run, 'skipped': self.ticks_skipped,
+                'jitter_mean_us': self.jitter.mean(), 'jitter_p99_us': self.jitter.percentile(99),
+                'jitter_max_us': self.jitter.max,
+                'overruns': self.overrun.n, 'overrun_max_us': self.overrun.max}
+
+
+class DeadlineScheduler(object):
+    """Call the ScheduledStreams at their deadlines, from one thread that runs while there are streams."""
 
-        # create and start the timer event
-        self.event = threading.Event()
-        self.event.set()
+    DEFAULT_SPIN_WINDOW = 0.0005  # seconds before a deadline to stop sleeping and spin
 
-        # placeholders for the time each repeattimer was activated, the timer object
-        self.activation_dt = None
-        self.__timer = None
+    _shared = None
+    _shared_lock = threading.Lock()
 
-    def run(self):
+    def __init__(self, spin_window=DEFAULT_SPIN_WINDOW, name='DeadlineScheduler'):
         """
-        Run the timer and execute the callable upon completion, then reset until it is cancelled.
+        :param spin_window: seconds before each deadline spent spinning rather than sleeping, 0 to only sleep
+        :param name: name of the scheduling thread
         """
-        while self.event.is_set():
-            self.activation_dt = datetime.utcnow()
-            print('the time at running is ', self.activation_dt)
-            self.__timer = threading.Timer(self.interval_new,
-                                           self.callable,
-                                           self.args,
-                                           self.kwargs)
-            self.interval_current = self.interval_new
-            self.__timer.start()
-            self.__timer.join()
+        self.spin_window = spin_window
+        self.name = name
+        self._heap = []  # (deadline, sequence number, stream)
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._running = None  # the stream whose callback is being called
+
+    @classmethod
+    def shared(cls):
+        """Return the scheduler shared by the streams of the server sessions, making it on first use."""
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def add_stream(self, interval, callback, args=(), start=None):
+        """
+        Call callback(deadline, *args) every interval seconds, the first tick at start (a perf_counter time, or now),
+        until it returns False or the returned ScheduledStream is cancelled.
+        """
+        stream = ScheduledStream(self, interval, callback, args, start)
+        with self._condition:
+            self._push(stream)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name)
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify_all()
+        return stream
+
+    def cancel(self, stream, wait=True, timeout=None):
+        """Stop calling the stream. If wait (and not called by the stream's own callback),
+        wait (at most timeout seconds) for its running tick to finish."""
+        with self._condition:
+            stream.cancelled = True
+            self._condition.notify_all()
+            if wait and threading.current_thread() is not self._thread:
+                self._condition.wait_for(lambda: self._running is not stream, timeout=timeout)
+
+    def _push(self, stream):
+        heapq.heappush(self._heap, (stream.deadline, next(self._sequence), stream))
+
+    def _wait_for_deadline(self):
+        """Sleep until the spin window before the earliest deadline, holding the condition.
+        Returns that deadline, or None (ending the thread) if there are no streams."""
+        while True:
+            while len(self._heap) > 0 and self._heap[0][2].cancelled:
+                heapq.heappop(self._heap)
+            if len(self._heap) == 0:
+                self._thread = None
+                return None
+            deadline = self._heap[0][0]
+            remaining = deadline - perf_counter() - self.spin_window
+            if remaining <= 0:
+                return deadline
+            self._condition.wait(remaining)  # woken early when streams are added or cancelled
+
+    def _run(self):
+        """The scheduling thread: call each stream at its deadlines."""
+        while True:
+            with self._condition:
+                deadline = self._wait_for_deadline()
+                if deadline is None:
+                    break
+
+            while perf_counter() < deadline:
+                pass  # spin, without holding the condition
+
+            with self._condition:
+                deadline, _, stream = heapq.heappop(self._heap)  # the earliest, which may have been added meanwhile
+                if stream.cancelled:
+                    continue
+                self._running = stream
+
+            called = perf_counter()
+            try:
+                keep = stream.callback(deadline, *stream.args)
+            except Exception as e:
+                print("Problem in a scheduled stream: ", e)
+                print(traceback.format_exc(), file=sys.stderr)
+                keep = False
+            finished = perf_counter()
+
+            stream.ticks_run += 1
+            stream.jitter.add((called - deadline) * 1000000)
+            stream.tick += 1
+            late = finished - stream.deadline
+            if late > 0:  # the tick ran past the next deadline, skip those missed by more than an interval
+                stream.overrun.add(late * 1000000)
+                skipped = int(late // stream.interval)
+                stream.tick += skipped
+                stream.ticks_skipped += skipped
+
+            with self._condition:
+                self._running = None
+                if keep is not False and not stream.cancelled:
+                    self._push(stream)
+                self._condition.notify_all()
+
+
+class RepeatTimer(object):
+    """
+    Call callable(*args, **kwargs) every interval seconds on a DeadlineScheduler (by default the shared one),
+    from start until cancel.
+    """
+
+    def __init__(self, interval, callable, args=None, kwargs=None, scheduler=None):
+        self.interval_new = interval
+        self.callable = callable
+        self.args = args if args is not None else []
+        self.kwargs = kwargs if kwargs is not None else {}
+        self.scheduler = scheduler if scheduler is not None else DeadlineScheduler.shared()
+        self.stream = None
+
+    def start(self):
+        self.stream = self.scheduler.add_stream(self.interval_new, lambda deadline: self.trigger())
 
     def cancel(self):
         """
         Cancel the timer.
         """
-        self.event.clear()
-        if self.__timer is not None:
-            self.__timer.cancel()
+        if self.stream is not None:
+            self.stream.cancel()
 
     def trigger(self):
         """
         Perform the callable function with arguments self.args and self.kwargs.
         """
         self.callable(*self.args, **self.kwargs)
-        if self.__timer is not None:
-            self.__timer.cancel()
 
-    # unused in this application
     def change_interval(self, value):
-        """Change the timer interval. Unused in this application."""
+        """Change the timer interval from the next call on."""
         self.interval_new = value
+        if self.stream is not None:
+            self.stream.change_interval(value)
 
 
-class EfficientRepeatTimer(RepeatTimer):
-    """Repeat timer that doesn't waste ms creating stuff outside the timed loop."""
-    def run(self):
-        self.__timer = threading.Timer(self.interval_new,
-                                       self.callable,
-                                       self.args,
-                                       self.kwargs)
-        while self.event.is_set():
-            self.__timer.start()  # starts working timer
-            self.activation_dt = datetime.utcnow()
-            print('the time at running before ', self.activation_dt)
-
-            # while timer is working, next timer is prepared
-            self.new_timer = threading.Timer(self.interval_new,
-                                             self.callable,
-                                             self.args,
-                                             self.kwargs)
-            self.__timer.join()
-            self.__timer = self.new_timer
-
-
-class BusyWaitingRepeatTimer(RepeatTimer):
-    """
-    Timer class that performs busy waiting.
-    This records the starting time, and continually checks until the next execution time is reached.
-    """
-    def run(self):
-        self.activation_dt = time()
-        while self.event.is_set():
-            self.next_exec = self.activation_dt + self.interval_new
-            streamthread = threading.Thread(group=None, target=self.callable, args=[self.args], kwargs=self.kwargs)
-            while time() < self.next_exec:
-                sleep(0)  # sleep for the least possible time
-
-            # when the relevant time is reached, launch the thread to send the data
-            streamthread.start()
-            self.activation_dt = self.next_exec
-            print('threader activation time is', self.activation_dt)
+# the former thread-per-tick and busy-waiting timers, all replaced by the scheduler
+EfficientRepeatTimer = RepeatTimer
+BusyWaitingRepeatTimer = RepeatTimer
+
+
+if __name__ == "__main__":
+    # check the pacing on this machine, eg 400 Hz streams
+    import argparse
+    from time import sleep
+    parser = argparse.ArgumentParser(description='Measure the tick jitter and overruns of the deadline scheduler.')
+    parser.add_argument('-rate', help='Ticks per second of each stream.', type=float, default=400)
+    parser.add_argument('-streams', help='Number of streams.', type=int, default=1)
+    parser.add_argument('-seconds', help='Duration of the measurement.', type=float, default=5)
+    parser.add_argument('-spin', help='Spin window in seconds.', type=float, default=DeadlineScheduler.DEFAULT_SPIN_WINDOW)
+    cl_args = parser.parse_args()
+
+    scheduler = DeadlineScheduler(spin_window=cl_args.spin)
+    start = perf_counter() + 0.1
+    streams = [scheduler.add_stream(1 / cl_args.rate, lambda deadline: None, start=start)
+               for i in range(cl_args.streams)]
+    sleep(cl_args.seconds)
+    for i, stream in enumerate(streams):
+        stream.cancel()
+        print('Stream {}: {}'.format(i, stream.give_stats()))
+        print('  jitter:', stream.jitter)
+        if stream.overrun.n > 0:
+            print('  overrun:', stream.overrun)
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Kristy'
+
+"""
+Microbenchmark of the RTC3D receive and decode path.
+A fake socket hands out a stream of data frame packets; each frame is received and decoded to its coil array
+once with the previous chunk-joining/slicing implementation (reproduced here) and once with the current
+memoryview-based client_server_comms/rtc3d_parser code.
+
+For each path it prints the bytes allocated while handling one frame (measured with tracemalloc,
+so this counts every copy of the payload that is alive at the same time), the number of recv calls and the time.
+
+Run with: python -m ematoblender.scripts.ema_io.rtc3d_benchmark [n_coils]
+"""
+
+import struct
+import sys
+import time
+import tracemalloc
+
+from .rtc3d_parser import RTC3DPacketParser, DataFrame, Component6D, CoilBuilder6D
+from .client_server_comms import BasicConnection
+
+
+class FakeSocket(object):
+    """Serve the same packet again and again, at most maxchunk bytes per call, counting the calls."""
+
+    def __init__(self, packet, maxchunk=2048):
+        self.packet = packet
+        self.maxchunk = maxchunk
+        self.position = 0
+        self.calls = 0
+
+    def _take(self, nbytes):
+        nbytes = min(nbytes, self.maxchunk, len(self.packet) - self.position)
+        start = self.position
+        self.position = (self.position + nbytes) % len(self.packet)
+        self.calls += 1
+        return start, nbytes
+
+    def recv(self, nbytes):
+        start, nbytes = self._take(nbytes)
+        return self.packet[start:start+nbytes]
+
+    def recv_into(self, buffer, nbytes=0):
+        start, nbytes = self._take(nbytes or len(buffer))
+        buffer[:nbytes] = memoryview(self.packet)[start:start+nbytes]
+        return nbytes
+
+
+class FakeConnection(BasicConnection):
+    """Connection using the fake socket."""
+    def __init__(self, sock):
+        super().__init__()
+        self.s = sock
+
+
+def legacy_receive_and_decode(sock):
+    """The receive/decode path before memoryview framing: join chunks, copy the body out, slice components."""
+    h = RTC3DPacketParser.HEADER_LEN
+    chunks = []
+    reply = sock.recv(h); chunks.append(reply)
+    rsize, rtype = struct.unpack('> I I', reply[:h])
+    bytesreceived = h
+    while bytesreceived < rsize:
+        chunk = sock.recv(min(int(rsize-bytesreceived), 2048))
+        chunks.append(chunk)
+        bytesreceived += len(chunk)
+    packet = b''.join(chunks[:rsize])
+
+    size, atype, body = struct.unpack('> I I {}s'.format(str(len(packet)-h)), packet)
+    n, *_ = struct.unpack('> I', body[:4])
+    bytesleft = body[4:]
+    arrays = []
+    for i in range(n):
+        compsize, comptype, framenumber, timestamp = struct.unpack('> 3I Q', bytesleft[:20])
+        compcontent = bytesleft[20:compsize]
+        bytesleft = bytesleft[compsize:]
+        ncoils, *_ = struct.unpack('> I', compcontent[:4])
+        coilbytes = compcontent[4:]
+        arrays.append([struct.unpack('> 7f I', coilbytes[j*32:(j+1)*32]) for j in range(ncoils)])
+    return arrays
+
+
+def receive_and_decode(conn):
+    """The current path: receive into one buffer, decode with memoryview slices into a coil array."""
+    size, atype, body = conn.receive_packet()
+    return DataFrame(rawdf=body).give_coil_array()
+
+
+def make_packet(n_coils):
+    """Pack a data frame with n_coils 6D coils."""
+    component = Component6D(framenum=1, timestamp=1000)
+    component.coils = CoilBuilder6D.from_array(
+        CoilBuilder6D.unpack_array(struct.pack('> I', n_coils) + b'\x3f\x80\x00\x00' * 8 * n_coils))
+    return RTC3DPacketParser.pack_all(DataFrame(components=[component]))
+
+
+def measure(fn, arg, sock, frames):
+    """Return bytes allocated per frame, recv calls per frame and microseconds per frame."""
+    fn(arg)  # warm up
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    fn(arg)
+    peak = tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+
+    calls = sock.calls
+    start = time.perf_counter()
+    for i in range(frames):
+        fn(arg)
+    elapsed = time.perf_counter() - start
+    return peak, (sock.calls - calls) / frames, elapsed / frames * 1000000
+
+
+def main(n_coils=16, frames=20000):
+    packet = make_packet(n_coils)
+    print('Data frame packet with {} coils is {} bytes.'.format(n_coils, len(packet)))
+
+    legacysock = FakeSocket(packet)
+    sock = FakeSocket(packet)
+    for name, fn, arg, s in [('before (join + slicing)', legacy_receive_and_decode, legacysock, legacysock),
+                             ('after (memoryview)', receive_and_decode, FakeConnection(sock), sock)]:
+        peak, calls, micros = measure(fn, arg, s, frames)
+        print('{:24} {:8d} bytes allocated/frame {:6.1f} recv calls/frame {:8.2f} us/frame'
+              .format(name, peak, calls, micros))
+
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:2]])
@@ -22,12 +22,12 @@ Functions to handle the RT server protocol are described in the PDF and coded in
 """
 
 # decode bytes -> ascii -> unicode
-import copy
 import json
-from ..ema_shared.general_maths import average_quaternions
+from ..ema_shared.general_maths import average_quaternion_arrays
 
 
 import struct
+import numpy
 
 
 class BasePacketParser(object):
@@ -41,11 +41,13 @@ class RTC3DPacketParser(BasePacketParser):
     This class contains static methods to pack and unpack the outermost wrapper
     for header (which contains the size and and type(integer) of the message).
     The remainder is the message body.
+    Unpacking works on memoryview slices, so the body is never copied out of the received packet.
     """
 
     PACKET_STRUCT = '> I I {}s'
     HEADER_STRUCT = '> I I'
-    HEADER_LEN = struct.calcsize(HEADER_STRUCT)
+    HEADER_PACKER = struct.Struct(HEADER_STRUCT)  # compiled once, rather than per packet
+    HEADER_LEN = HEADER_PACKER.size
 
     GET_INNER_BUILDER = lambda: MessageBuilder
 
@@ -55,17 +57,19 @@ class RTC3DPacketParser(BasePacketParser):
         if mybytes is None or len(mybytes) == 0:
             return 0, 0
         else:
-            return struct.unpack(cls.HEADER_STRUCT, mybytes[:cls.HEADER_LEN])
+            return cls.HEADER_PACKER.unpack_from(mybytes)
 
     @classmethod
     def unpack_outer(cls, message):
-        """ Gives size, type, message of the packet."""
+        """ Gives size, type, message of the packet.
+        The message is a memoryview on the packet's body, use bytes() on it if a copy must be kept.
+        """
         if message is None or len(message) == 0:
             return None
         else:
             #print("input message was {}".format(message))
-            return struct.unpack(cls.PACKET_STRUCT.format(
-                str(len(message)-cls.HEADER_LEN)), message)
+            size, atype = cls.HEADER_PACKER.unpack_from(message)
+            return size, atype, memoryview(message)[cls.HEADER_LEN:]
 
     @classmethod
     def unpack_all(cls, mbytes):
@@ -79,12 +83,10 @@ class RTC3DPacketParser(BasePacketParser):
         """ Wrap data with the header for general-purpose data packets with ASCII message,
         Returns the byte-packed packet.
         """
-        if type(command) != bytes:
+        if type(command) == str:
             command = bytes(command, 'ascii')
         #  print('headerlen, commandlen', cls.HEADER_LEN, len(command))
-        #  print('packing with string', cls.PACKET_STRUCT.format(str(len(command))))
-        return struct.pack(cls.PACKET_STRUCT.format(str(len(command))),
-                           len(command)+cls.HEADER_LEN, atype, command)
+        return cls.HEADER_PACKER.pack(len(command)+cls.HEADER_LEN, atype) + command
 
     @classmethod
     def pack_all(cls, messageobj):
@@ -100,6 +102,134 @@ class RTC3DPacketParser(BasePacketParser):
         return cls.pack_outer(*args, **kwargs)
 
 
+class RTC3DStreamParser(object):
+    """
+    Incremental (sans-IO) parser for a stream of RTC3D packets, it does no socket reading itself.
+    Either feed it byte chunks of any size, or (to avoid copying) receive straight into get_buffer()
+    and report the number of bytes with buffer_updated(). Both return the list of packets completed so far,
+    as (size, type, body) tuples like RTC3DPacketParser.unpack_outer, where body is a memoryview on the buffer.
+
+    The buffers are bytearrays kept in a small pool. A buffer is only written to again once all memoryviews
+    on it (and arrays made from them) are released, otherwise a fresh buffer is taken,
+    so packets that were handed out are never overwritten.
+    """
+    PROTOCOL = RTC3DPacketParser
+    BUFFER_SIZE = 65536  # bytes per buffer
+    POOL_SIZE = 4  # number of spare buffers kept for reuse
+    MIN_FREE = 4096  # rotate to a new buffer when less than this is free at its end
+
+    def __init__(self, buffer_size=None, pool_size=None):
+        self.buffer_size = self.__class__.BUFFER_SIZE if buffer_size is None else buffer_size
+        self.pool_size = self.__class__.POOL_SIZE if pool_size is None else pool_size
+        self.min_free = max(1, min(self.__class__.MIN_FREE, self.buffer_size // 4))
+
+        self._pool = []
+        self._buffer = bytearray(self.buffer_size)
+        self._view = memoryview(self._buffer)
+        self._start = 0  # first byte of the packet not yet handed out
+        self._end = 0  # end of the bytes received
+
+    def has_partial(self):
+        """True if some bytes of an incomplete packet are buffered."""
+        return self._end > self._start
+
+    def feed(self, data):
+        """Copy the bytes-like data into the buffer, return the completed packets."""
+        data = memoryview(data).cast('B')
+        packets = []
+        while len(data) > 0:
+            target = self.get_buffer()
+            n = min(len(target), len(data))
+            target[:n] = data[:n]
+            target.release()
+            packets.extend(self.buffer_updated(n))
+            data = data[n:]
+        return packets
+
+    def get_buffer(self, sizehint=-1):
+        """Return a writable memoryview to receive into, eg with socket.recv_into.
+        Release it (or let it go out of scope) before calling buffer_updated.
+        The sizehint is ignored, it is accepted for asyncio.BufferedProtocol compatibility."""
+        needed = self._pending_size()
+        free = len(self._buffer) - self._end
+        if free < self.min_free or len(self._buffer) - self._start < needed:
+            self._rotate(needed)
+        return self._view[self._end:]
+
+    def buffer_updated(self, nbytes, whole=False):
+        """Register that nbytes were written to the start of the last get_buffer(), return the completed packets.
+        If whole, each packet is given as one memoryview with its header, rather than as a (size, type, body) tuple."""
+        self._end += nbytes
+        return self._split_packets(whole)
+
+    @classmethod
+    def replay(cls, fileobj, chunksize=65536):
+        """Yield the (size, type, body) packets of a captured byte stream, eg a binary file of received data."""
+        parser = cls()
+        chunk = fileobj.read(chunksize)
+        while chunk:
+            yield from parser.feed(chunk)
+            chunk = fileobj.read(chunksize)
+        if parser.has_partial():
+            raise ValueError("Stream ends in the middle of a packet")
+
+    @staticmethod
+    def _in_use(buffer):
+        """A bytearray cannot be resized while memoryviews on it exist, use this to check for them."""
+        try:
+            buffer.append(0)
+        except BufferError:
+            return True
+        del buffer[-1]
+        return False
+
+    def _pending_size(self):
+        """Return the size of the partially received packet, or the header size if that is not complete."""
+        h = self.PROTOCOL.HEADER_LEN
+        if self._end - self._start < h:
+            return h
+        size, atype = self.PROTOCOL.HEADER_PACKER.unpack_from(self._view, self._start)
+        return max(size, h)
+
+    def _rotate(self, needed):
+        """Move the partial packet to the start of a free buffer with room for at least needed bytes."""
+        newbuffer = None
+        for i, candidate in enumerate(self._pool):
+            if len(candidate) >= needed and not self._in_use(candidate):
+                newbuffer = self._pool.pop(i)
+                break
+        if newbuffer is None:
+            newbuffer = bytearray(max(self.buffer_size, needed))
+
+        partial = self._end - self._start
+        newbuffer[:partial] = self._view[self._start:self._end]
+
+        # release our own view so the old buffer counts as free once handed-out packets are released
+        self._view.release()
+        if len(self._pool) < self.pool_size and len(self._buffer) == self.buffer_size:
+            self._pool.append(self._buffer)
+
+        self._buffer, self._view = newbuffer, memoryview(newbuffer)
+        self._start, self._end = 0, partial
+
+    def _split_packets(self, whole=False):
+        """Hand out every complete packet in the buffer."""
+        packets = []
+        h = self.PROTOCOL.HEADER_LEN
+        while self._end - self._start >= h:
+            size, atype = self.PROTOCOL.HEADER_PACKER.unpack_from(self._view, self._start)
+            if size < h:
+                raise ValueError("Corrupt packet header, size {} is smaller than the header".format(size))
+            if self._end - self._start < size:
+                break
+            if whole:
+                packets.append(self._view[self._start:self._start+size])
+            else:
+                packets.append((size, atype, self._view[self._start+h:self._start+size]))
+            self._start += size
+        return packets
+
+
 class MessageBuilder(object):
     """Give a bytestring to build the relevant message object (either DataFrame or AsciiMessage)"""
 
@@ -128,21 +258,20 @@ class MessageBuilder(object):
 
     @staticmethod
     def average_dataframes(dflist):
-        """Average all of the floating point values in the input dataframes, return a dataframe"""
+        """Average the coil locations and rotations of the input dataframes, return a new (smoothed) dataframe.
+        For each component the frames' coil arrays are stacked to (n_frames, n_coils, fields) and averaged at once,
+        timestamps, frame numbers and coil flags are taken from the last frame.
+        """
+        dflist = list(dflist)
         # check if all of the dataframes have the same attribute structure
-        n = len(dflist)
-        if n > 1 and all(dflist[0].check_same_structure(dflist[n]) for n in range(1, n)):
+        if len(dflist) > 0 and all(dflist[0].check_same_structure(other) for other in dflist[1:]):
 
-            meanobj = DataFrame()
-            meanobj.__dict__ = copy.deepcopy(dflist[-1].__dict__)
+            meanobj = dflist[-1].copy()
             meanobj.smoothed = True
-            # update the components' coils, keep them the same
-            newcoils = meanobj.give_coils()
-
-            smoothedcoils = [CoilBuilder.average(cs) for cs in zip(*[d.give_coils() for d in dflist])]
-
-            for n, s in zip(newcoils, smoothedcoils):
-                n = s  # use list mutability to set new values to soothed
+            for i, comp in enumerate(meanobj.components if len(dflist) > 1 else []):
+                if isinstance(comp, ComponentXD):
+                    stacked = numpy.stack([df.components[i].give_coil_array() for df in dflist])
+                    comp.set_array(comp.__class__.GET_INNER_BUILDER().average_arrays(stacked))
             return meanobj
         else:
             raise KeyError("The DataFrame objects you are trying to average have a different structure")
@@ -177,46 +306,105 @@ class JSONBuilder(MessageBuilder):
 class Message(object):
     """
     Data Frame base class.
+    Messages, components and coils use __slots__, as thousands of them are kept for smoothing and recording.
     """
+    __slots__ = ()
     GET_BUILDER_CLASS = lambda: MessageBuilder
-    pass
 
 
 class DataFrame(Message):
     """Class representing dataframe objects.
     Has attributes:
     - components
+    A lazy data frame keeps a copy of its raw bytes and only decodes the frame number and timestamp,
+    the components are unpacked when first accessed.
     """
+    __slots__ = ('_components', 'smoothed', '_raw', '_header')
     message_type = 3
     GET_INNER_BUILDER = lambda: ComponentBuilder
 
-    def __init__(self, rawdf=None, components=None, fromlist=None):
+    def __init__(self, rawdf=None, components=None, fromlist=None, lazy=False):
         """Initialise Data Frame object from bytestring.
         Make some empty object if no string given.
+        If lazy, only the header is decoded now (see give_timestamp, give_frame_number).
         """
         self.smoothed = None
-
+        self.components = []
 
         if rawdf is not None and len(rawdf) > 0:
             self.smoothed = False
-            self.components = self.__class__.GET_INNER_BUILDER().unpack(rawdf)
+            if lazy:
+                # copy the bytes, so the receive buffer is not held on to until the frame is decoded
+                self._raw = bytes(rawdf)
+                self._header = self.__class__.GET_INNER_BUILDER().unpack_header(self._raw)
+                self._components = None
+            else:
+                self.components = self.__class__.GET_INNER_BUILDER().unpack(rawdf)
 
         if components is not None:
             self.components = components
 
         if fromlist is not None:
             # reassign self's attributes to the average value's
-            self.__dict__ = self.__class__.GET_BUILDER_CLASS().average_dataframes(fromlist).__dict__
-
+            meanobj = self.__class__.GET_BUILDER_CLASS().average_dataframes(fromlist)
+            self.components, self.smoothed = meanobj.components, meanobj.smoothed
 
     def pack_all(self):
         """Return (in bytes) component count, then each component's bytestring"""
         return self.__class__.GET_INNER_BUILDER().pack(self.components)
 
+    @property
+    def components(self):
+        if self._components is None and self._raw is not None:
+            self._components = self.__class__.GET_INNER_BUILDER().unpack(self._raw)
+            self._raw = None
+        return self._components
+
+    @components.setter
+    def components(self, components):
+        self._components = components
+        self._raw = None
+        self._header = None
+
+    def is_decoded(self):
+        """False if this is a lazy data frame whose components have not been unpacked yet."""
+        return self._raw is None
+
+    def give_frame_number(self):
+        """Return the frame number of the first component, without decoding a lazy data frame."""
+        if self._raw is not None:
+            return self._header[0]
+        return self.components[0].frame_number
+
+    def give_timestamp(self):
+        """Return the timestamp (in microseconds) of the first component, without decoding a lazy data frame."""
+        if self._raw is not None:
+            return self._header[1]
+        return self.components[0].timestamp
+
+    def copy(self):
+        """Return a new data frame with copies of the components and coils (coil arrays are shared, not copied)."""
+        newobj = self.__class__()
+        if self._raw is not None:  # still lazy, the raw bytes are immutable so can be shared
+            newobj._components, newobj._raw, newobj._header = None, self._raw, self._header
+        else:
+            newobj.components = [comp.copy() for comp in self.components]
+        newobj.smoothed = self.smoothed
+        return newobj
+
     def give_coils(self):
         """Return a list of the coil objects in a dataframe."""
         return [coil for comp in self.components for coil in comp.coils]
 
+    def give_coil_array(self):
+        """Return the coil data of all components as one (n_coils, fields) big-endian array.
+        Unlike give_coils, no coil objects are built.
+        """
+        arrays = [comp.give_coil_array() for comp in self.components]
+        if len(arrays) == 1:
+            return arrays[0]
+        return numpy.concatenate(arrays)
+
     def __str__(self):
         return "Data frame with {} components;".format(len(self.components))+str(self.components[0])
 
@@ -227,12 +415,11 @@ class DataFrame(Message):
             return False
 
     def check_same_structure(self, other):
-        """Check that there is the same number of coils and they have the same attributes"""
+        """Check that there are the same types of component, with the same number of coils"""
         if len(self.components) == len(other.components) \
-                and all(c.__dict__.keys() == oc.__dict__.keys() \
-                for n in range(len(self.components)) \
-                for (c, oc) in zip(self.components[n].give_coils(), other.components[n].give_coils())
-                ):
+                and all(type(c) == type(oc) and
+                        (not isinstance(c, ComponentXD) or c.give_coil_array().shape == oc.give_coil_array().shape)
+                        for (c, oc) in zip(self.components, other.components)):
             return True
         else:
             print('Objects are not the same')
@@ -241,19 +428,17 @@ class DataFrame(Message):
     def to_tsv(self, relative_timestamp_to=0, closest_sound_sample=[0]):
         """Return a tab-separated string with the coil data in the wave tsv order"""
         outstring = ''
-        if len(self.components) == 0 or len(self.give_coils()) == 0:
+        if len(self.components) == 0 or len(self.give_coil_array()) == 0:
             print('No content in the data frame to write.')
             return ''
         else:
             # fields time (based on wave frames), measid, wavid
-            outstring+='{}\t{}\t{}\t'.format(str(int(self.components[0].timestamp)-relative_timestamp_to),
-                                             str(self.components[0].frame_number), str(closest_sound_sample[0]))
-            for i, c in enumerate(self.give_coils()):
+            outstring+='{}\t{}\t{}\t'.format(str(int(self.give_timestamp())-relative_timestamp_to),
+                                             str(self.give_frame_number()), str(closest_sound_sample[0]))
+            # rotational info then location, straight from the coil array (q0, qx, qy, qz, x, y, z)
+            for i, values in enumerate(self.give_coil_array()[:, :7].tolist()):
                 outstring+='{}\t{}\t'.format('Sensor'+str(i), '55')
-                outstring+='{}\t{}\t{}\t{}\t'\
-                    .format(c.abs_rot[0], c.abs_rot[1], c.abs_rot[2], c.abs_rot[3]) # rotational info
-                outstring+='{}\t{}\t{}\t'\
-                    .format(c.abs_loc[0], c.abs_loc[1], c.abs_loc[2],)
+                outstring+='{}\t{}\t{}\t{}\t{}\t{}\t{}\t'.format(*values)
             outstring+='\n'
         return outstring
 
@@ -262,15 +447,16 @@ class DataFrame(Message):
         RTC3D protocol timestamps are in microseconds by default.
         """
         try:
-             micro_ts = self.components[0].timestamp
+             micro_ts = self.give_timestamp()
              ts = micro_ts * 0.000001
-        except AttributeError:
+        except (AttributeError, IndexError, TypeError):
             ts = None
         return ts
 
 
 class AsciiMessage(Message):
     """Class representing ASCII message objects"""
+    __slots__ = ('message_type', 'string')
 
     def __init__(self, mtype, mbytes):
         self.message_type = mtype
@@ -288,9 +474,11 @@ class ComponentBuilder(object):
     and unpacks it to the relevant object type.
     """
     HEADER = '> I'
-    HEADER_LEN = struct.calcsize(HEADER)
+    HEADER_PACKER = struct.Struct(HEADER)
+    HEADER_LEN = HEADER_PACKER.size
     EACH_HEADER = '> 3I Q'
-    EACH_HEADER_LEN = struct.calcsize(EACH_HEADER)
+    EACH_HEADER_PACKER = struct.Struct(EACH_HEADER)
+    EACH_HEADER_LEN = EACH_HEADER_PACKER.size
 
     COMPONENT_CLASS_MAP = {1: lambda a, b, c: Component3D(a, b, c),
                            2: lambda: ComponentAnalog,
@@ -303,12 +491,13 @@ class ComponentBuilder(object):
     def unpack(cls, mbytes):
         """Return a Component6D object for the bytestring"""
         components = []
-        n, *_ = struct.unpack(cls.HEADER, mbytes[:cls.HEADER_LEN])
-        bytesleft = mbytes[cls.HEADER_LEN:]
+        mbytes = memoryview(mbytes)  # slices below are views, not copies
+        n, = cls.HEADER_PACKER.unpack_from(mbytes)
+        offset = cls.HEADER_LEN
         for i in range(n):
-            compsize, comptype, framenumber, timestamp = struct.unpack(cls.EACH_HEADER, bytesleft[:cls.EACH_HEADER_LEN])
-            compcontent = bytesleft[cls.EACH_HEADER_LEN: compsize]
-            bytesleft = bytesleft[compsize:]  # remove bytes read into variables
+            compsize, comptype, framenumber, timestamp = cls.EACH_HEADER_PACKER.unpack_from(mbytes, offset)
+            compcontent = mbytes[offset+cls.EACH_HEADER_LEN: offset+compsize]
+            offset += compsize  # move past bytes read into variables
 
             #  print('component type is', comptype, 'fn is', cls.COMPONENT_CLASS_MAP[comptype])
             # append the relevant component object to list
@@ -316,11 +505,33 @@ class ComponentBuilder(object):
 
         return components
 
+    @classmethod
+    def unpack_header(cls, mbytes):
+        """Return the frame number and timestamp of the first component, without unpacking any components.
+        Both are None if the data frame has no components.
+        """
+        n, = cls.HEADER_PACKER.unpack_from(mbytes)
+        if n == 0:
+            return None, None
+        compsize, comptype, framenumber, timestamp = cls.EACH_HEADER_PACKER.unpack_from(mbytes, cls.HEADER_LEN)
+        return framenumber, timestamp
+
+    @classmethod
+    def unpack_coil_array(cls, mbytes):
+        """Decode the first component of a data frame body in one call.
+        Returns the frame number, timestamp and a (n_coils, 8) big-endian array view of the coils,
+        the columns being q0, qx, qy, qz, x, y, z, error (error is viewed as float, see CoilBuilder.give_flags).
+        """
+        compsize, comptype, framenumber, timestamp = cls.EACH_HEADER_PACKER.unpack_from(mbytes, cls.HEADER_LEN)
+        start = cls.HEADER_LEN + cls.EACH_HEADER_LEN
+        coilbuilder = CoilBuilder3D if comptype == Component3D.COMPONENT_TYPE else CoilBuilder6D
+        return framenumber, timestamp, coilbuilder.unpack_array(memoryview(mbytes)[start:cls.HEADER_LEN+compsize])
+
     @classmethod
     def pack(cls, components):
         """Return a bytestring for the component"""
-        return struct.pack(cls.HEADER, len(components)) \
-               + b''.join([struct.pack(cls.EACH_HEADER, c.get_sizeb(), c.COMPONENT_TYPE, c.frame_number, c.timestamp)
+        return cls.HEADER_PACKER.pack(len(components)) \
+               + b''.join([cls.EACH_HEADER_PACKER.pack(c.get_sizeb(), c.COMPONENT_TYPE, c.frame_number, c.timestamp)
                + c.pack_data()
                for c in components])
 
@@ -330,16 +541,32 @@ class ComponentBuilder(object):
 
 class ComponentBase(object):
     """Base class for component objects"""
+    __slots__ = ('_coils', 'frame_number', 'timestamp')
     GET_BUILDER_CLASS = lambda: ComponentBuilder
 
     def __init__(self, framenum=None, timestamp=None, fileparser=None):
-        self.coils = NotImplemented
+        self._coils = NotImplemented
         self.frame_number = framenum
         self.timestamp = timestamp
         if fileparser is not None:
             self.extract_attrs_from_fileparser(fileparser)
 
 
+    @property
+    def coils(self):
+        return self._coils
+
+    @coils.setter
+    def coils(self, coils):
+        self._coils = coils
+
+    def copy(self):
+        """Return a new component of the same type, with copies of the coil objects."""
+        newobj = self.__class__.__new__(self.__class__)
+        newobj.frame_number, newobj.timestamp = self.frame_number, self.timestamp
+        newobj._coils = self._coils if type(self._coils) != list else [c.copy() for c in self._coils]
+        return newobj
+
     def __str__(self):
         if type(self.coils) == list:
             return "Component6D with {} coils;".format(len(self.coils))+str(self.coils[0])
@@ -358,82 +585,205 @@ class ComponentBase(object):
 
 
 class ComponentXD(ComponentBase):
-    """Base class for component objects with location"""
+    """Base class for component objects with location.
+    When unpacked from bytes the coil data is held in self.array (a view on the received bytes).
+    When self.coils is first accessed the data is copied once into self.values, a native float32 array
+    with a row per coil (coil fields, then the preallocated ref_loc and bp_corr_loc columns) and self.flags,
+    and the coils are built as lightweight views on these rows.
+    """
+    __slots__ = ('array', 'values', 'flags')
+
     def __init__(self, **kwargs):
+        self.array = None
+        self.values = None
+        self.flags = None
         super().__init__(**kwargs)
         self.coils = NotImplemented
 
+    @property
+    def coils(self):
+        if self._coils is None and self.array is not None:
+            builder = self.__class__.GET_INNER_BUILDER()
+            self.values, self.flags = builder.to_values(self.array)
+            self._coils = builder.views(self.values, self.flags)
+            self.array = None  # no longer needed, so the receive buffer can be reused
+        return self._coils
+
+    @coils.setter
+    def coils(self, coils):
+        """Setting coil objects replaces any array data."""
+        self._coils = coils
+        self.array = None
+        self.values = None
+        self.flags = None
+
+    def set_array(self, array):
+        """Hold the coil data as an array, coil objects are rebuilt from it when needed."""
+        self._coils = None
+        self.array = array
+        self.values = None
+        self.flags = None
+
+    def copy(self):
+        """Return a new component of the same type.
+        An undecoded coil array is shared rather than copied, decoded values are copied with new coil views on them.
+        """
+        newobj = super().copy()
+        newobj.array = self.array
+        newobj.values, newobj.flags = None, None
+        if self.values is not None:
+            newobj.values, newobj.flags = self.values.copy(), self.flags.copy()
+            newobj._coils = self.__class__.GET_INNER_BUILDER().views(newobj.values, newobj.flags)
+        return newobj
+
     def get_sizeb(self):
-        return len(self.pack_data())+ struct.calcsize(self.__class__.GET_BUILDER_CLASS().EACH_HEADER)
+        return len(self.pack_data()) + self.__class__.GET_BUILDER_CLASS().EACH_HEADER_LEN
 
     def pack_data(self):
         """Pack the component header, and the bytestring for each marker/coil"""
         #  print('struct header', self.__class__.GET_BUILDER_CLASS().HEADER)
         #  print('len coils', len(self.coils))
         #  print('each header', self.coils[0].__class__.GET_BUILDER_CLASS().EACH_STRUCT)
-        return struct.pack(self.__class__.GET_BUILDER_CLASS().HEADER, len(self.coils)) + \
-               b''.join([struct.pack(c.__class__.GET_BUILDER_CLASS().EACH_STRUCT, *c.in_packing_order()) for c in self.coils])
+        if self.array is not None or self.values is not None:  # pack the whole array at once
+            array = self.give_coil_array()
+            return self.__class__.GET_BUILDER_CLASS().HEADER_PACKER.pack(len(array)) + \
+                   array.astype(self.__class__.GET_INNER_BUILDER().ARRAY_DTYPE, copy=False).tobytes()
+        return self.__class__.GET_BUILDER_CLASS().HEADER_PACKER.pack(len(self.coils)) + \
+               b''.join([c.__class__.GET_BUILDER_CLASS().EACH_PACKER.pack(*c.in_packing_order()) for c in self.coils])
 
     def give_coils(self):
         return self.coils
 
+    def give_coil_array(self):
+        """Return the coil data as a (n_coils, fields) big-endian array, packing the coil objects if needed."""
+        if self.array is not None:
+            return self.array
+        elif self.values is not None:
+            return self.__class__.GET_INNER_BUILDER().from_values(self.values, self.flags)
+        return self.__class__.GET_INNER_BUILDER().unpack_array(self.pack_data())
+
 
 class Component3D(ComponentXD):
+    __slots__ = ()
     GET_INNER_BUILDER = lambda: CoilBuilder3D
     COMPONENT_TYPE = 1
 
     def __init__(self, framenum=None, timestamp=None, mbytes=None, fileparser=None):
         super().__init__(framenum=framenum, timestamp=timestamp, fileparser=fileparser)
-        self.coils = self.__class__.GET_INNER_BUILDER().unpack(mbytes)
+        if mbytes is not None:
+            self.set_array(self.__class__.GET_INNER_BUILDER().unpack_array(mbytes))
 
 
 class Component6D(ComponentXD):
+    __slots__ = ()
     GET_INNER_BUILDER = lambda: CoilBuilder6D
     COMPONENT_TYPE = 4
 
     def __init__(self, framenum=None, timestamp=None, mbytes=None, fileparser=None):
         super().__init__(framenum=framenum, timestamp=timestamp, fileparser=fileparser)
         if mbytes is not None:
-            self.coils = self.__class__.GET_INNER_BUILDER().unpack(mbytes)
+            self.set_array(self.__class__.GET_INNER_BUILDER().unpack_array(mbytes))
 
 
 class ComponentAnalog(ComponentBase):
+    __slots__ = ()
     COMPONENT_TYPE = 2
 
 
 class ComponentForce(ComponentBase):
+    __slots__ = ()
     COMPONENT_TYPE = 3
 
 
 class ComponentEvent(ComponentBase):
+    __slots__ = ()
     COMPONENT_TYPE = 5
 
 
 class CoilBuilder(object):
     """Given a bytestring representing a coil/marker, make a relevant coil objects."""
     HEADER = '> I'
-    HEADER_LEN = struct.calcsize(HEADER)
+    HEADER_PACKER = struct.Struct(HEADER)
+    HEADER_LEN = HEADER_PACKER.size
     GET_RESULT_CLASS = NotImplementedError
+    GET_VIEW_CLASS = NotImplementedError
     EACH_STRUCT = NotImplementedError
 
+    # each coil is packed as big-endian floats followed by one unsigned integer flag (error/reliability)
+    ARRAY_DTYPE = numpy.dtype('>f4')
+    FLAG_DTYPE = numpy.dtype('>u4')
+    EACH_FIELDS = NotImplementedError
+    LOC_COLUMNS = NotImplementedError  # columns of x, y, z in a coil array
+    ROT_COLUMNS = None  # columns of q0, qx, qy, qz in a coil array
+
     @classmethod
     def unpack(cls, bytestring):
-        n, *_ = struct.unpack(cls.HEADER, bytestring[:cls.HEADER_LEN])
-        bytestring = bytestring[cls.HEADER_LEN:]
-        return [cls.GET_RESULT_CLASS(struct.unpack(cls.EACH_STRUCT, bytestring[i*cls.EACH_LEN: (i+1)*cls.EACH_LEN]))
-                for i in range(n)]
+        return cls.from_array(cls.unpack_array(bytestring))
+
+    @classmethod
+    def unpack_array(cls, bytestring):
+        """Return a (n_coils, fields) array view on the bytestring, without copying or building coil objects.
+        The last column holds the integer flag, use give_flags to read it as integers.
+        """
+        n, = cls.HEADER_PACKER.unpack_from(bytestring)
+        return numpy.frombuffer(bytestring, dtype=cls.ARRAY_DTYPE, count=n*cls.EACH_FIELDS, offset=cls.HEADER_LEN)\
+            .reshape(n, cls.EACH_FIELDS)
+
+    @classmethod
+    def give_flags(cls, array):
+        """Return the integer flag column of a coil array."""
+        return array[:, -1].astype(cls.ARRAY_DTYPE, copy=False).view(cls.FLAG_DTYPE)
+
+    @classmethod
+    def from_array(cls, array):
+        """Build the coil objects for each row of a coil array."""
+        return [cls.GET_RESULT_CLASS(values + [flag])
+                for values, flag in zip(array[:, :-1].tolist(), cls.give_flags(array).tolist())]
+
+    @classmethod
+    def to_values(cls, array):
+        """Copy a coil array into a native float32 values array and uint32 flags array.
+        The values array has the coil fields followed by the ref_loc and bp_corr_loc columns, which are NaN (unset).
+        """
+        nfields = cls.EACH_FIELDS - 1
+        values = numpy.full((len(array), nfields + 6), numpy.nan, dtype=numpy.float32)
+        values[:, :nfields] = array[:, :-1]
+        return values, cls.give_flags(array).astype(numpy.uint32)
+
+    @classmethod
+    def from_values(cls, values, flags):
+        """Return the (n_coils, fields) big-endian coil array for a values and flags array (see to_values)."""
+        array = numpy.empty((len(values), cls.EACH_FIELDS), dtype=cls.ARRAY_DTYPE)
+        array[:, :-1] = values[:, :cls.EACH_FIELDS-1]
+        array[:, -1:].view(cls.FLAG_DTYPE)[:, 0] = flags
+        return array
+
+    @classmethod
+    def views(cls, values, flags):
+        """Build a coil view on each row of the values array."""
+        return [cls.GET_VIEW_CLASS(values, flags, i) for i in range(len(values))]
 
     @staticmethod
     def average(coilobjs):
-        thiscoil = CoilBase(0, 0, 0)
-        n = len(coilobjs)
-        thiscoil.abs_loc = [sum([o.abs_loc[i]/n for o in coilobjs ] ) for i in range(3) ]
+        thiscoil = CoilBase(*numpy.mean([o.abs_loc for o in coilobjs], axis=0).tolist())
 
-        if thiscoil.abs_rot is not None:
-            thiscoil.abs_rot = average_quaternions(o.abs_rot for o in coilobjs)
+        if all(o.abs_rot is not None for o in coilobjs):
+            thiscoil.abs_rot = average_quaternion_arrays([o.abs_rot for o in coilobjs]).tolist()
 
         return thiscoil
 
+    @classmethod
+    def average_arrays(cls, stacked):
+        """Average a (n_frames, n_coils, fields) stack of coil arrays over the frames, return a (n_coils, fields) array.
+        Locations are the mean, rotations the quaternion average, the flags are those of the last frame.
+        """
+        mean = numpy.empty(stacked.shape[1:], dtype=cls.ARRAY_DTYPE)
+        mean[:, cls.LOC_COLUMNS] = stacked[:, :, cls.LOC_COLUMNS].mean(axis=0, dtype=numpy.float64)
+        if cls.ROT_COLUMNS is not None:
+            mean[:, cls.ROT_COLUMNS] = average_quaternion_arrays(stacked[:, :, cls.ROT_COLUMNS])
+        mean[:, -1] = stacked[-1, :, -1]  # same dtype, so the flag bits are copied unchanged
+        return mean
+
     @staticmethod
     def create_coils(n=1, dimensions=6, reordering=None, marker_channels=None):
         coils = []
@@ -464,21 +814,29 @@ class CoilBuilder(object):
 
 class CoilBuilder3D(CoilBuilder):
     EACH_STRUCT = '> 3f I'
-    EACH_LEN = struct.calcsize(EACH_STRUCT)
+    EACH_PACKER = struct.Struct(EACH_STRUCT)
+    EACH_LEN = EACH_PACKER.size
+    EACH_FIELDS = 4
+    LOC_COLUMNS = slice(0, 3)
     GET_RESULT_CLASS = lambda x: Coil3D(*x)
+    GET_VIEW_CLASS = lambda *x: Coil3DView(*x)
 
 
 class CoilBuilder6D(CoilBuilder):
     EACH_STRUCT = '> 7f I'
-    EACH_LEN = struct.calcsize(EACH_STRUCT)
+    EACH_PACKER = struct.Struct(EACH_STRUCT)
+    EACH_LEN = EACH_PACKER.size
+    EACH_FIELDS = 8
+    LOC_COLUMNS = slice(4, 7)
+    ROT_COLUMNS = slice(0, 4)
     GET_RESULT_CLASS = lambda x: Coil6D(*x)
+    GET_VIEW_CLASS = lambda *x: Coil6DView(*x)
 
     @staticmethod
     def build_from_mapping(mapping, measurements):
         """From a list of mapping to wave order and list of measurements,
         create a coil obj.
         """
-        print('Building 6D coil from mapping')
         x = measurements[mapping.xind]
         y = measurements[mapping.yind]
         z = measurements[mapping.zind]
@@ -492,7 +850,11 @@ class CoilBase(object):
     """
     abs_loc is (x,y,z),
     abs_rot is (Q0, Qx, Qy, Qz)
+    ref_loc and bp_corr_loc are the head-corrected locations (in the reference space, and biteplate-corrected),
+    they are unset (so raise AttributeError, as getattr fallbacks expect) until head correction fills them.
     """
+    __slots__ = ('abs_loc', 'abs_rot', 'ref_loc', 'bp_corr_loc')
+    FIELDS = ('abs_loc', 'abs_rot', 'ref_loc', 'bp_corr_loc')
     GET_BUILDER_CLASS = lambda: CoilBuilder
     def __init__(self, x, y, z):
         self.abs_loc = self.__class__.GET_BUILDER_CLASS().to_floats((x, y, z))
@@ -501,14 +863,27 @@ class CoilBase(object):
     def __str__(self):
         return "Coil with location {}".format(str(self.abs_loc))
 
+    def give_fields(self):
+        """Return a dict of the attributes that are set on this coil."""
+        return {name: getattr(self, name) for name in self.__class__.FIELDS if hasattr(self, name)}
+
+    def copy(self):
+        """Return a copy of the coil, the location and rotation lists are copied too."""
+        newobj = self.__class__.__new__(self.__class__)
+        for name, value in self.give_fields().items():
+            setattr(newobj, name, list(value) if type(value) == list else value)
+        return newobj
+
     def __eq__(self, other):
-        if self.__dict__ == other.__dict__:
+        if self.give_fields() == other.give_fields():
             return True
         else:
             return False
 
 
 class Coil3D(CoilBase):
+    __slots__ = ('reliability',)
+    FIELDS = CoilBase.FIELDS + ('reliability',)
     GET_BUILDER_CLASS = lambda: CoilBuilder3D
 
     def __init__(self, x, y, z, reliability):
@@ -521,6 +896,8 @@ class Coil3D(CoilBase):
 
 
 class Coil6D(CoilBase):
+    __slots__ = ('error',)
+    FIELDS = CoilBase.FIELDS + ('error',)
     GET_BUILDER_CLASS = lambda: CoilBuilder6D
 
     def __init__(self, q0, qx, qy, qz, x, y, z, error):
@@ -531,6 +908,75 @@ class Coil6D(CoilBase):
     def in_packing_order(self):
         return self.abs_rot + self.abs_loc + [self.error]
 
+
+def view_property(start, stop, optional=False):
+    """Property reading/writing columns start:stop of the coil's row in the values array, as a list.
+    Optional columns are unset while NaN, then reading raises AttributeError.
+    """
+    def getter(self):
+        values = self._values[self._row, start:stop]
+        if optional and numpy.isnan(values[0]):
+            raise AttributeError('Coil has no value for columns {}:{}'.format(start, stop))
+        return values.tolist()
+
+    def setter(self, value):
+        self._values[self._row, start:stop] = numpy.nan if value is None else value
+
+    return property(getter, setter)
+
+
+def flag_property():
+    """Property reading/writing the coil's integer flag (error or reliability)."""
+    def getter(self):
+        return int(self._flags[self._row])
+
+    def setter(self, value):
+        self._flags[self._row] = 0 if value is None else value
+
+    return property(getter, setter)
+
+
+class CoilView(object):
+    """Mixin for coils that are a view on one row of a component's values and flags arrays (see ComponentXD),
+    so that a frame's coils share one array rather than each holding lists of floats.
+    """
+    __slots__ = ()
+
+    def __init__(self, values, flags, row):
+        self._values = values
+        self._flags = flags
+        self._row = row
+
+    def copy(self):
+        """Return a standalone (non-view) copy of the coil."""
+        standalone = self.__class__.__bases__[1]
+        newobj = standalone.__new__(standalone)
+        for name, value in self.give_fields().items():
+            setattr(newobj, name, value)
+        return newobj
+
+    def __reduce__(self):
+        return self.__class__, (self._values, self._flags, self._row)
+
+
+class Coil3DView(CoilView, Coil3D):
+    __slots__ = ('_values', '_flags', '_row')
+    abs_loc = view_property(0, 3)
+    abs_rot = None
+    ref_loc = view_property(3, 6, optional=True)
+    bp_corr_loc = view_property(6, 9, optional=True)
+    reliability = flag_property()
+
+
+class Coil6DView(CoilView, Coil6D):
+    __slots__ = ('_values', '_flags', '_row')
+    abs_rot = view_property(0, 4)
+    abs_loc = view_property(4, 7)
+    ref_loc = view_property(7, 10, optional=True)
+    bp_corr_loc = view_property(10, 13, optional=True)
+    error = flag_property()
+
+
 def main():
     # some unit tests
     streamdf = b'\x00\x00\x00\x01\x00\x00\x01\xf8\x00\x00\x00\x04\x00\x00\x00\x00\x00\x00\x00\x00\x00\x0b\xe3\xc0\x00\x00\x00\x0f?\x047\x82\xbf<\xa5z\xbeJd\xc3>\xc7\x11\x94A\xb1(9\xc3\t|\x8e\xc2\x8b%\xd0\x00\x00\x00\x00?DL8\xbf#i\xdb=\x8ab$\x00\x00\x00\x00@\x88\xee\x0c\xc1m\x10_\xc2M\x8d\x19\x00\x00\x00\x00?\x0b[\xb4\xbfEb\xe1>\xa9)\x89\x00\x00\x00\x00@\xc1lS\xc0\xa5)\x8c\xc2/H\x85\x00\x00\x00\x00?\x089\x04\xbfW\xf9\xa5=\x92<\xc9\x00\x00\x00\x00@@e\x95\xc0\x15\x05\x8e\xc2\x0c\xa0\xd8\x00\x00\x00\x00?!\xf4\xb2>\xb4(\x91\xbf0\x9c\xd4\x00\x00\x00\x00@6 \xbd\xc1nuK\xc1\x82\x9d5\x00\x00\x00\x00?^\x1cz>\xfe\x93\x9f;\x0b\x97x\x00\x00\x00\x00\xc1\xc9/~?\x91\x82\x1c\xc2\tw)\x00\x00\x00\x00?F\x93)?\x0bO\xa5>\xa3\xa9\xd2\x00\x00\x00\x00?\x8b\xd1\xabA\x13hx\xc1^\xde\'\x00\x00\x00\x00?4"\xcd?"\x03\xf7\xbe\xa5b\x9e\x00\x00\x00\x00\xc1e\x95|\xc3\r\xb5#\xc2\x8eL\xd0\x00\x00\x00\x00>\x97z\xf6>\x87\xd7\xe4?j\xea\xc8\x00\x00\x00\x00B\x83\xc1@\xc1E\x91\xdf\xc3\x17I\xdb\x00\x00\x00\x00?qV\\\xbe\x0c\xc1\x87>\x9b\x9d\x80\x00\x00\x00\x00\xc2m\xa7}\xc0\xff\xfdv\xc3\x10\x86\x88\x00\x00\x00\x00??\x1b\xac?"N\x9c>N\xb1>\x00\x00\x00\x00?\xebw\xa5\xc0\x80\xbe\x12\xc1\xbe\xe9\xee\x00\x00\x00\x00?\x1e\xdd\x8b?GgM=\xb98\x15\x00\x00\x00\x00>\xe6`5@\xca>\x97\xc1\xcd{I\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
@@ -590,9 +1036,44 @@ def main():
 
     assert object1.give_coils() == object1.components[0].coils
 
+    print('Testing the coil array decoding')
+    framenumber, timestamp, coilarray = ComponentBuilder.unpack_coil_array(message_bytes)
+    assert timestamp == object1.components[0].timestamp
+    assert coilarray.shape == (len(object1.give_coils()), CoilBuilder6D.EACH_FIELDS)
+    assert coilarray[:, 4:7].tolist() == [c.abs_loc for c in object1.give_coils()]
+
+    print('Testing lazy decoding')
+    lazy1 = DataFrame(rawdf=message_bytes, lazy=True)
+    assert not lazy1.is_decoded()
+    assert lazy1.give_timestamp() == object1.components[0].timestamp
+    assert lazy1.give_frame_number() == object1.components[0].frame_number
+    assert lazy1.copy().pack_all() == lazy1.pack_all() == object1.pack_all()
+    assert lazy1.is_decoded()
+
+    print('Testing the stream parser')
+    outer_bytes2 = RTC3DPacketParser.pack_outer(streamdf2, 3)
+    stream = outer_bytes1 + ok + outer_bytes2
+    for chunksize in [1, 7, 8, 100, len(stream)]:
+        streamparser = RTC3DStreamParser(buffer_size=1024)
+        packets = []
+        for i in range(0, len(stream), chunksize):
+            packets.extend(streamparser.feed(stream[i:i+chunksize]))
+        assert [(s, t, bytes(m)) for s, t, m in packets] == \
+            [(s, t, bytes(m)) for s, t, m in [RTC3DPacketParser.unpack_outer(outer_bytes1),
+                                              RTC3DPacketParser.unpack_outer(ok),
+                                              RTC3DPacketParser.unpack_outer(outer_bytes2)]]
+        assert not streamparser.has_partial()
+
     print('Testing averaging dfs')
     av = MessageBuilder.average_dataframes([object1, object2])
     print(av)
+    object3 = DataFrame(rawdf=streamdf2, lazy=True)
+    av3 = MessageBuilder.average_dataframes([object1, object3])
+    assert av3.smoothed and av3.give_timestamp() == object3.give_timestamp()
+    for c, c1, c2 in zip(av3.give_coils(), object1.give_coils(), object3.give_coils()):
+        assert numpy.allclose(c.abs_loc, numpy.mean([c1.abs_loc, c2.abs_loc], axis=0), atol=1e-4)
+        assert numpy.allclose(c.abs_rot, c2.abs_rot, atol=1e-2) and c.error == c2.error
+    assert MessageBuilder.average_dataframes([object1]).pack_all() == object1.pack_all()
 
     print(av.to_tsv())
 
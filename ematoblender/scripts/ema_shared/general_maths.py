@@ -1,6 +1,7 @@
 __author__ = 'Kristy'
 import math
 import mathutils
+import numpy
 
 
 def get_intermediate_coords(k1, k2, k3, n=10):
@@ -39,6 +40,48 @@ def average_quaternions(quat_list):
     return mathutils.Quaternion(exp_avg)
 
 
+def average_quaternion_arrays(quats):
+    """Average an (n, ..., 4) array of quaternions over the first axis in one vectorized call, returning (..., 4).
+    The average is the eigenvector of the largest eigenvalue of the summed outer products q q^T (Markley et al. 2007),
+    so q and -q count as the same rotation. Its sign is chosen to agree with the last quaternion.
+    Where all of the quaternions are zero (eg a coil without data) the average is zero.
+    """
+    quats = numpy.asarray(quats, dtype=numpy.float64)
+    return average_quaternions_from_outer_sum(quaternion_outer_products(quats).sum(axis=0), quats[-1])
+
+
+def quaternion_outer_products(quats):
+    """Return the (..., 4, 4) outer products q q^T of a (..., 4) array of quaternions."""
+    return numpy.einsum('...i,...j->...ij', quats, quats)
+
+
+def average_quaternions_from_outer_sum(outer_sum, reference):
+    """Return the (..., 4) average quaternions given the (..., 4, 4) sum of their outer products,
+    with signs agreeing with the (..., 4) reference quaternions. See average_quaternion_arrays.
+    Keeping a running outer_sum allows averaging over a sliding window without revisiting every quaternion.
+    """
+    eigenvalues, eigenvectors = numpy.linalg.eigh(outer_sum)  # ascending eigenvalues
+    mean = eigenvectors[..., -1]
+    sign = numpy.where(numpy.sum(mean * reference, axis=-1, keepdims=True) < 0, -1.0, 1.0)
+    mean = mean * sign
+    mean[eigenvalues[..., -1] <= 0] = 0
+    return mean
+
+
+def euler_to_quaternion_arrays(x, y, z):
+    """Convert arrays of Euler angles in degrees (x is roll, y is pitch, z is yaw) to a (..., 4) array
+    of quaternions q0, qx, qy, qz, in one vectorized call. Uses the same conversion as Mapping.convert_to_quat,
+    from http://www.euclideanspace.com/maths/geometry/rotations/conversions/eulerToQuaternion/
+    """
+    halves = numpy.radians(numpy.stack(numpy.broadcast_arrays(z, y, x))) / 2
+    c1, c2, c3 = numpy.cos(halves)
+    s1, s2, s3 = numpy.sin(halves)
+    return numpy.stack([c1*c2*c3 - s1*s2*s3,
+                        s1*s2*c3 + c1*c2*s3,
+                        s1*c2*c3 + c1*s2*s3,
+                        c1*s2*c3 - s1*c2*s3], axis=-1)
+
+
 
 
 if __name__ == "__main__":